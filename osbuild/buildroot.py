@@ -10,12 +10,14 @@ import importlib
 import importlib.util
 import io
 import os
+import resource
 import select
+import shutil
 import stat
 import subprocess
 import tempfile
 import time
-from typing import Set
+from typing import Dict, Optional, Set
 
 from osbuild.api import BaseAPI
 from osbuild.util import linux
@@ -32,16 +34,36 @@ class CompletedBuild:
     convenience properties to quickly access the `returncode` and
     `output`. The latter is also provided via `stderr`, `stdout`
     properties, making it a drop-in replacement for `CompletedProcess`.
+
+    The resources used by the process and all its descendants, as
+    reported by `wait4(2)`, are available via `rusage` and `usage`.
     """
 
-    def __init__(self, proc: subprocess.CompletedProcess, output: str):
+    def __init__(self, proc: subprocess.CompletedProcess, output: str, rusage: Optional[resource.struct_rusage] = None):
         self.process = proc
         self.output = output
+        self.rusage = rusage
 
     @property
     def returncode(self):
         return self.process.returncode
 
+    @property
+    def usage(self) -> Optional[Dict[str, int]]:
+        """The used CPU time in nanoseconds, memory and I/O in bytes"""
+        ru = self.rusage
+        if not ru:
+            return None
+        return {
+            "utime_ns": int(ru.ru_utime * 1e9),
+            "stime_ns": int(ru.ru_stime * 1e9),
+            # kilobytes on Linux
+            "maxrss": ru.ru_maxrss * 1024,
+            # blocks of 512 bytes, regardless of the file system
+            "read_bytes": ru.ru_inblock * 512,
+            "write_bytes": ru.ru_oublock * 512,
+        }
+
     @property
     def stdout(self):
         return self.output
@@ -96,6 +118,7 @@ class BuildRoot(contextlib.AbstractContextManager):
         self._libdir = libdir
         self._runner = runner
         self._apis = []
+        self._devnodes = set()
         self.dev = None
         self.var = None
         self.proc = None
@@ -153,6 +176,7 @@ class BuildRoot(contextlib.AbstractContextManager):
             self._mknod(self.dev, "urandom", 0o666, 1, 9)
             self._mknod(self.dev, "tty", 0o666, 5, 0)
             self._mknod(self.dev, "zero", 0o666, 1, 5)
+            self._devnodes = set(os.listdir(self.dev))
 
             # Prepare all registered API endpoints
             for api in self._apis:
@@ -177,6 +201,47 @@ class BuildRoot(contextlib.AbstractContextManager):
         if self._exitstack:
             self._exitstack.enter_context(api)
 
+    @contextlib.contextmanager
+    def temporary_api(self, api: BaseAPI):
+        """Register an API endpoint for the duration of the context.
+
+        Like `register_api`, but the endpoint is only bound into the
+        build root, and its context active, as long as the returned
+        context is. Useful for endpoints that carry per-run state.
+        """
+        with api:
+            self._apis.append(api)
+            try:
+                yield api
+            finally:
+                self._apis.remove(api)
+
+    def reset(self):
+        """Reset the state that is persistent across runs.
+
+        Empties `/var` and removes all nodes from `/dev` that were not
+        created during the initial setup, like nodes for devices. This
+        allows to use one build root for independent runs.
+
+        This must be called from within an active context of this buildroot
+        context-manager.
+        """
+
+        if not self._exitstack:
+            raise RuntimeError("No active context")
+
+        shutil.rmtree(self.var)
+        os.makedirs(self.var)
+
+        with os.scandir(self.dev) as it:
+            for entry in it:
+                if entry.name in self._devnodes:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+
     def run(self, argv, monitor, timeout=None, binds=None, readonly_binds=None, extra_env=None):
         """Runs a command in the buildroot.
 
@@ -327,14 +392,29 @@ class BuildRoot(contextlib.AbstractContextManager):
             monitor.log(txt)
 
         poller.unregister(proc.stdout.fileno())
-        buf, _ = proc.communicate()
+        buf = proc.stdout.read()
+        proc.stdout.close()
         txt = buf.decode("utf-8")
         monitor.log(txt)
         data.write(txt)
         output = data.getvalue()
         data.close()
 
-        return CompletedBuild(proc, output)
+        # Reap bubblewrap ourselves to get the resources it used: since
+        # it is the init process of the build root, this includes all
+        # the processes that were spawned in it
+        rusage = self.wait(proc)
+
+        return CompletedBuild(proc, output, rusage)
+
+    @staticmethod
+    def wait(proc: subprocess.Popen) -> resource.struct_rusage:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return rusage
 
     def build_capabilities_args(self):
         """Build the capabilities arguments for bubblewrap"""
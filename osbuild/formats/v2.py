@@ -2,7 +2,7 @@
 
 Second, and current, version of the manifest description
 """
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from osbuild.meta import Index, ModuleInfo, ValidationResult
 
@@ -478,13 +478,15 @@ def validate(manifest: Dict, index: Index) -> ValidationResult:
     schema = index.get_schema("Manifest", version="2")
     result = schema.validate(manifest)
 
+    # All instances of a module, e.g. a stage, are collected together
+    # with their path and then validated in one go, see `validate_all`
+    batches: Dict[Tuple[str, str], List[Tuple[Dict, List]]] = {}
+
     def validate_module(mod, klass, path):
         name = mod.get("type")
         if not name:
             return
-        schema = index.get_schema(klass, name, version="2")
-        res = schema.validate(mod)
-        result.merge(res, path=path)
+        batches.setdefault((klass, name), []).append((mod, path))
 
     def validate_stage_modules(klass, stage, path):
         group = ModuleInfo.MODULES[klass]
@@ -498,9 +500,7 @@ def validate(manifest: Dict, index: Index) -> ValidationResult:
 
     def validate_stage(stage, path):
         name = stage["type"]
-        schema = index.get_schema("Stage", name, version="2")
-        res = schema.validate(stage)
-        result.merge(res, path=path)
+        batches.setdefault(("Stage", name), []).append((stage, path))
 
         for mod in ("Device", "Input", "Mount"):
             validate_stage_modules(mod, stage, path)
@@ -522,4 +522,10 @@ def validate(manifest: Dict, index: Index) -> ValidationResult:
     for i, pipeline in enumerate(pipelines):
         validate_pipeline(pipeline, path=["pipelines", i])
 
+    for (klass, name), instances in batches.items():
+        schema = index.get_schema(klass, name, version="2")
+        results = schema.validate_all([mod for mod, _ in instances])
+        for res, (_, path) in zip(results, instances):
+            result.merge(res, path=path)
+
     return result
@@ -20,7 +20,9 @@ communication with the host.
 
 On the host side a `ServiceManager` can be used to spawn and manage
 concrete services. Specifically it functions as a context manager
-and will shut down services when the context exits.
+and will shut down services when the context exits. Optionally, the
+services can be forked from template processes, kept in a `ServicePool`,
+instead of starting a new interpreter for each one of them.
 
 The `ServiceClient` class provides a client for the services and can
 thus be used to interact with the service from the host side.
@@ -38,10 +40,13 @@ their clean up, independent of any control of osbuild.
 import abc
 import argparse
 import asyncio
+import contextlib
 import fcntl
+import gc
 import importlib
 import io
 import os
+import select
 import signal
 import subprocess
 import sys
@@ -191,8 +196,65 @@ class Service(abc.ABC):
 
         parser = cls.prepare_argument_parser()
         args = parser.parse_args(argv)
+
+        # As a template, this only returns in the forked children
+        if args.template:
+            args = parser.parse_args(cls._fork_from_template(args))
+
         return cls(args)
 
+    @staticmethod
+    def _fork_from_template(args: argparse.Namespace) -> List[str]:
+        """Fork a new service process for each request of the pool
+
+        Wait for requests from a `ServicePool` on the service socket
+        and fork a child for each one of them. The request contains
+        the socket and the stdout of the new service as well as its
+        arguments, which are returned in the child. The parent replies
+        with the pid and a pid file descriptor of the child and exits
+        once the socket is closed.
+        """
+
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        sock = Socket.new_from_fd(args.service_fd)
+
+        while True:
+            msg, fds, _ = sock.recv()
+
+            # Reap the services that exited in the meantime
+            with contextlib.suppress(ChildProcessError):
+                while os.waitpid(-1, os.WNOHANG)[0]:
+                    pass
+
+            if not msg:
+                sys.exit(0)
+
+            service_fd, stdout_fd = fds.steal(0), fds.steal(1)
+            fds.close()
+
+            # Keep the objects of the template out of the garbage
+            # collection of the children, which is faster and avoids
+            # copying their memory pages
+            gc.freeze()
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                os.dup2(stdout_fd, sys.stdout.fileno())
+                os.dup2(stdout_fd, sys.stderr.fileno())
+                os.close(stdout_fd)
+                return ["--service-fd", str(service_fd)] + msg["args"]
+
+            os.close(service_fd)
+            os.close(stdout_fd)
+
+            pidfd = os.pidfd_open(pid)  # type: ignore[attr-defined]
+            try:
+                sock.send({"pid": pid}, fds=[pidfd])
+            finally:
+                os.close(pidfd)
+
     @classmethod
     def prepare_argument_parser(cls):
         """Prepare the command line argument parser"""
@@ -206,6 +268,8 @@ class Service(abc.ABC):
                             help="service file descriptor")
         parser.add_argument("--service-id", metavar="ID", type=str,
                             help="service identifier")
+        parser.add_argument("--template", action="store_true",
+                            help="fork services on request of a pool")
         return parser
 
     @abc.abstractmethod
@@ -394,6 +458,151 @@ class ServiceClient:
         self.proc.wait()
 
 
+class ForkedProcess:
+    """
+    Host service process forked by a `ServicePool`
+
+    Provides the parts of the `subprocess.Popen` interface that are
+    needed for host services. The process is not a child of ours,
+    but of the template it was forked from; therefore it is waited
+    for via its pid file descriptor.
+    """
+
+    def __init__(self, pid: int, pidfd: int, stdout):
+        self.pid = pid
+        self.pidfd = pidfd
+        self.stdout = stdout
+
+    def wait(self):
+        """Wait for the process to exit"""
+        if self.pidfd < 0:
+            return
+
+        select.select([self.pidfd], [], [])
+        os.close(self.pidfd)
+        self.pidfd = -1
+
+
+class ServicePool(contextlib.AbstractContextManager):
+    """
+    Pool of template processes for host services
+
+    Starting a host service means starting a new interpreter that
+    imports osbuild and the service module, which often takes a lot
+    longer than the work done by the service itself. A pool keeps a
+    template process for each service executable that has done all of
+    that once and forks a new process for every service started via
+    it. Each service thus still runs in a process of its own that
+    frees all its resources when it is stopped.
+
+    The pool can be shared by multiple `ServiceManager` instances, also
+    from different threads, and keeps the templates until it is closed.
+    Forking services needs `os.pidfd_open`; if it is not available or
+    the template for an executable failed, `spawn` returns `None` and
+    the service must be started in the usual way.
+    """
+
+    def __init__(self):
+        self.templates: Dict[str, Optional[Tuple[subprocess.Popen, Socket]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(os, "pidfd_open")
+
+    def _template(self, cmd: str, env: Dict[str, str]) -> Optional[Tuple[subprocess.Popen, Socket]]:
+        if cmd in self.templates:
+            return self.templates[cmd]
+
+        ours, theirs = Socket.new_pair()
+        ours.framed = True
+
+        fd = theirs.fileno()
+        argv = [
+            cmd,
+            "--service-id", "template",
+            "--service-fd", str(fd),
+            "--template",
+        ]
+
+        # Errors are not reported here, but when the service is
+        # started in the usual way, after the template failed
+        try:
+            proc = subprocess.Popen(argv,
+                                    env=env,
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL,
+                                    pass_fds=(fd, ),
+                                    close_fds=True)
+        except OSError:
+            ours.close()
+            self.templates[cmd] = None
+            return None
+        finally:
+            theirs.close()
+
+        self.templates[cmd] = proc, ours
+        return proc, ours
+
+    def _discard(self, cmd: str):
+        template = self.templates.get(cmd)
+        self.templates[cmd] = None
+
+        if template:
+            proc, sock = template
+            sock.close()
+            proc.wait()
+
+    def spawn(self, cmd: str, sock: Socket, args: List[str], env: Dict[str, str]) -> Optional[ForkedProcess]:
+        """
+        Fork a new host service
+
+        Fork a new process for the service executable `cmd` with the
+        arguments `args` that communicates via `sock`. The template
+        for `cmd` is started with the environment `env` when it is
+        used for the first time. Returns `None` if the service could
+        not be forked.
+        """
+
+        if not self.supported():
+            return None
+
+        with self._lock:
+            template = self._template(cmd, env)
+            if not template:
+                return None
+
+            _, ctl = template
+            rfd, wfd = os.pipe()
+
+            try:
+                ctl.send({"args": args}, fds=[sock.fileno(), wfd])
+                msg, fds, _ = ctl.recv()
+            except OSError:
+                msg = None
+            finally:
+                os.close(wfd)
+
+            if not msg:
+                os.close(rfd)
+                self._discard(cmd)
+                return None
+
+        stdout = os.fdopen(rfd, "rb", buffering=0)
+        return ForkedProcess(msg["pid"], fds.steal(0), stdout)
+
+    def close(self):
+        """Stop all template processes"""
+        with self._lock:
+            for cmd in list(self.templates):
+                self._discard(cmd)
+            self.templates = {}
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
 class ServiceManager:
     """
     Host service manager
@@ -404,12 +613,18 @@ class ServiceManager:
 
     When a `monitor` is provided, stdout and stderr of the service will
     be forwarded to the monitor via `monitor.log`, otherwise sys.stdout
-    is used.
+    is used. If the monitor implements `service_start` and `service_stop`,
+    it is also notified when services are started and stopped.
+
+    If a `ServicePool` is given as `pool`, services are forked from
+    its templates, if possible.
     """
 
-    def __init__(self, *, monitor=None):
+    def __init__(self, *, monitor=None, pool=None):
         self.services = OrderedDict()
         self.monitor = monitor
+        self.pool = pool
+        self.lock = threading.Lock()
 
         self.barrier = threading.Barrier(2)
         self.event_loop = None
@@ -450,31 +665,38 @@ class ServiceManager:
         if not self.running:
             raise RuntimeError("ServiceManager not running")
 
-        if uid in self.services:
-            raise ValueError(f"{uid} already started")
+        with self.lock:
+            if uid in self.services:
+                raise ValueError(f"{uid} already started")
+            # reserve the uid, services may be started from multiple threads
+            self.services[uid] = None
 
         ours, theirs = Socket.new_pair()
+        # Host services are always part of the same osbuild as we are
+        # and thus understand framed messages
+        ours.framed = True
         env = self.make_env()
 
         try:
             fd = theirs.fileno()
-            argv = [
-                cmd,
-                "--service-id", uid,
-                "--service-fd", str(fd)
-            ]
+            args = ["--service-id", uid]
 
             if extra_args:
-                argv += extra_args
-
-            proc = subprocess.Popen(argv,
-                                    env=env,
-                                    stdin=subprocess.DEVNULL,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
-                                    bufsize=0,
-                                    pass_fds=(fd, ),
-                                    close_fds=True)
+                args += extra_args
+
+            proc: Optional[Union[ForkedProcess, subprocess.Popen]] = None
+            if self.pool:
+                proc = self.pool.spawn(cmd, theirs, args, env)
+
+            if not proc:
+                proc = subprocess.Popen([cmd, "--service-fd", str(fd)] + args,
+                                        env=env,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        bufsize=0,
+                                        pass_fds=(fd, ),
+                                        close_fds=True)
 
             service = ServiceClient(uid, proc, ours)
             self.services[uid] = service
@@ -497,6 +719,10 @@ class ServiceManager:
         finally:
             if ours:
                 ours.close()
+                with self.lock:
+                    del self.services[uid]
+
+        self._notify("service_start", uid, name)
 
         return service
 
@@ -509,8 +735,25 @@ class ServiceManager:
         if not service:
             raise ValueError(f"unknown service: {uid}")
 
+        self._notify("service_stop", uid)
         service.stop()
 
+    def stop_all(self):
+        """
+        Stop all services, in the reverse order they were started
+        """
+
+        while self.services:
+            uid, srv = self.services.popitem()
+            if srv:
+                self._notify("service_stop", uid)
+                srv.stop()
+
+    def _notify(self, event, *args):
+        callback = getattr(self.monitor, event, None)
+        if callback:
+            callback(*args)
+
     def _stdout_ready(self, name, uid, stdout):
         txt = stdout.readline()
         if not txt:
@@ -543,9 +786,7 @@ class ServiceManager:
 
     def __exit__(self, *args):
         # Stop all registered services
-        while self.services:
-            _, srv = self.services.popitem()
-            srv.stop()
+        self.stop_all()
 
         self.event_loop.call_soon_threadsafe(self.event_loop.stop)
         self.thread.join()
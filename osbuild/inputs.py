@@ -41,11 +41,19 @@ class Input:
         self.origin = origin
         self.refs: Dict[str, Dict[str, Any]] = {}
         self.options = options or {}
-        self.id = self.calc_id()
+        self._id: Optional[str] = None
+
+    @property
+    def id(self) -> str:
+        # Calculated on demand, since inputs can have thousands of
+        # references, which are added one after the other
+        if self._id is None:
+            self._id = self.calc_id()
+        return self._id
 
     def add_reference(self, ref, options: Optional[Dict] = None):
         self.refs[ref] = options or {}
-        self.id = self.calc_id()
+        self._id = None
 
     def calc_id(self):
 
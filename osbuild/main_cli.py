@@ -7,14 +7,22 @@ used from tests to run the cli.
 
 
 import argparse
+import collections
+import concurrent.futures
+import functools
 import json
 import os
 import sys
+import time
 
 import osbuild
 import osbuild.meta
 import osbuild.monitor
-from osbuild.objectstore import ObjectStore
+from osbuild import host
+from osbuild.objectstore import ObjectStore, SourceCache
+from osbuild.pipeline import CheckpointPolicy
+from osbuild.util import treecopy
+from osbuild.util.fscache import FsCacheInfo
 from osbuild.util.parsing import parse_size
 from osbuild.util.term import fmt as vt
 
@@ -47,20 +55,47 @@ def show_validation(result, name):
         print(f"  {error.message}\n")
 
 
-def export(name_or_id, output_directory, store, manifest):
+def show_validation_timings(index, duration):
+    schemata = sorted(index.list_schemata(), key=lambda x: x[3].duration, reverse=True)
+
+    print(f"{vt.bold}Validation took {duration * 1000:.1f} ms{vt.reset}")
+    for klass, name, _, schema in schemata:
+        if not schema.count:
+            continue
+        label = f"{klass} {name}" if name else klass
+        print(f"  {schema.duration * 1000:8.1f} ms  {schema.count:5}x  {label}")
+
+
+def export(name_or_id, output_directory, store, manifest, monitor=None, *, move=False):
     pipeline = manifest[name_or_id]
     obj = store.get(pipeline.id)
     dest = os.path.join(output_directory, name_or_id)
 
     os.makedirs(dest, exist_ok=True)
-    obj.export(dest)
+    progress = treecopy.Progress(functools.partial(monitor.export, name_or_id) if monitor else None)
+    obj.export(dest, move=move, progress=progress)
+
+
+def export_all(exports, output_directory, store, manifest, monitor):
+    # The trees of objects that are exported only once, and are
+    # not needed afterwards, can be moved instead of copied
+    ids = collections.Counter(manifest[name].id for name in exports)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(exports)) as executor:
+        futures = [
+            executor.submit(export, name, output_directory, store, manifest, monitor,
+                            move=ids[manifest[name].id] == 1)
+            for name in sorted(exports)
+        ]
+        for future in futures:
+            future.result()
 
 
 def parse_arguments(sys_argv):
     parser = argparse.ArgumentParser(prog="osbuild",
                                      description="Build operating system images")
 
-    parser.add_argument("manifest_path", metavar="MANIFEST",
+    parser.add_argument("manifest_path", metavar="MANIFEST", nargs="?",
                         help="json file containing the manifest that should be built, or a '-' to read from stdin")
     parser.add_argument("--store", metavar="DIRECTORY", type=os.path.abspath,
                         default=".osbuild",
@@ -69,6 +104,15 @@ def parse_arguments(sys_argv):
                         help="directory containing stages, assemblers, and the osbuild library")
     parser.add_argument("--cache-max-size", metavar="SIZE", type=parse_size, default=None,
                         help="maximum size of the cache (bytes) or 'unlimited' for no restriction")
+    parser.add_argument("--source-cache", metavar="DIRECTORY", type=os.path.abspath, default=None,
+                        help="directory where the content of sources is stored, can be shared between stores")
+    parser.add_argument("--source-cache-max-size", metavar="SIZE", type=parse_size, default=None,
+                        help="maximum size of the source cache (bytes) or 'unlimited', see --gc-sources")
+    parser.add_argument("--extra-source-cache", metavar="DIRECTORY", type=os.path.abspath, action="append",
+                        default=[], dest="extra_source_caches",
+                        help="source cache of another store to take content from, can be passed multiple times")
+    parser.add_argument("--gc-sources", action="store_true",
+                        help="remove sources that have not been used recently from the source cache")
     parser.add_argument(
         "--checkpoint",
         metavar="ID",
@@ -76,6 +120,13 @@ def parse_arguments(sys_argv):
         type=str,
         default=None,
         help="stage to commit to the object store during build (can be passed multiple times), accepts globs")
+    parser.add_argument("--auto-checkpoint", action="store_true",
+                        help="commit stages that are expensive to rebuild to the object store automatically, "
+                        "needs a maximum cache size, see --cache-max-size")
+    parser.add_argument("--checkpoint-overlay", action="store_true",
+                        help="resume from checkpoints by mounting them as overlay instead of copying them")
+    parser.add_argument("--checkpoint-delta", action="store_true",
+                        help="store checkpoints as the changes to the previous checkpoint of the same tree")
     parser.add_argument("--export", metavar="ID", action="append", type=str, default=[],
                         help="object to export, can be passed multiple times")
     parser.add_argument("--json", action="store_true",
@@ -84,25 +135,61 @@ def parse_arguments(sys_argv):
                         help="directory where result objects are stored")
     parser.add_argument("--inspect", action="store_true",
                         help="return the manifest in JSON format including all the ids")
+    parser.add_argument("--validate-only", action="store_true",
+                        help="only validate the manifest and report how long that took")
     parser.add_argument("--monitor", metavar="NAME", default=None,
                         help="name of the monitor to be used")
     parser.add_argument("--monitor-fd", metavar="FD", type=int, default=sys.stdout.fileno(),
                         help="file descriptor to be used for the monitor")
+    parser.add_argument("--reuse-buildroot", action="store_true",
+                        help="run all stages of a pipeline in one build root instead of a new one for each")
     parser.add_argument("--stage-timeout", type=int, default=None,
                         help="set the maximal time (in seconds) each stage is allowed to run")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="number of independent pipelines to build concurrently")
+    parser.add_argument("--cpu-budget", metavar="N", type=int, default=None,
+                        help="number of CPUs each stage may use for multithreaded work, like compression")
     parser.add_argument("--version", action="version",
                         help="return the version of osbuild",
                         version="%(prog)s " + osbuild.__version__)
 
-    return parser.parse_args(sys_argv[1:])
+    args = parser.parse_args(sys_argv[1:])
+    if not args.manifest_path and not args.gc_sources:
+        parser.error("the following arguments are required: MANIFEST")
+
+    return args
+
+
+def gc_sources(path, maximum_size, file=sys.stdout):
+    cache = SourceCache(path)
+    if maximum_size is not None:
+        with cache:
+            cache.info = FsCacheInfo(maximum_size=maximum_size)
+
+    try:
+        count, size = cache.collect_garbage()
+    except BlockingIOError:
+        print(f"Source cache {path} is in use, not collecting garbage", file=file)
+        return 1
+
+    print(f"Removed {count} items ({size} bytes) from the source cache {path}", file=file)
+    return 0
 
 
 # pylint: disable=too-many-branches,too-many-return-statements,too-many-statements
 def osbuild_cli():
     args = parse_arguments(sys.argv)
+    source_cache = args.source_cache or os.path.join(args.store, "sources")
+
+    if not args.manifest_path:
+        return gc_sources(source_cache, args.source_cache_max_size)
+
     desc = parse_manifest(args.manifest_path)
 
-    index = osbuild.meta.Index(args.libdir)
+    # Information about the modules is cached in the store, if there
+    # is one already, to not extract it from the modules every time
+    cache = os.path.join(args.store, "meta") if os.path.isdir(args.store) else None
+    index = osbuild.meta.Index(args.libdir, cache=cache)
 
     # detect the format from the manifest description
     info = index.detect_format_info(desc)
@@ -112,7 +199,24 @@ def osbuild_cli():
     fmt = info.module
 
     # first thing is validation of the manifest
+    start = time.monotonic()
     res = fmt.validate(desc, index)
+    duration = time.monotonic() - start
+
+    if args.validate_only:
+        if args.json:
+            timings = {
+                f"{klass} {name}" if name else klass: {"count": schema.count, "duration": schema.duration}
+                for klass, name, _, schema in index.list_schemata()
+                if schema.count
+            }
+            json.dump({**res.as_dict(), "duration": duration, "timings": timings}, sys.stdout)
+            sys.stdout.write("\n")
+        else:
+            show_validation(res, args.manifest_path)
+            show_validation_timings(index, duration)
+        return 0 if res else 2
+
     if not res:
         if args.json or args.inspect:
             json.dump(res.as_dict(), sys.stdout)
@@ -156,27 +260,44 @@ def osbuild_cli():
     monitor = osbuild.monitor.make(monitor_name, args.monitor_fd)
 
     try:
-        with ObjectStore(args.store) as object_store:
+        with ObjectStore(args.store, sources=source_cache) as object_store, host.ServicePool() as service_pool:
             if args.cache_max_size is not None:
                 object_store.maximum_size = args.cache_max_size
+            if args.source_cache_max_size is not None:
+                object_store.source_cache.info = FsCacheInfo(maximum_size=args.source_cache_max_size)
+            object_store.overlay = args.checkpoint_overlay
+            object_store.extra_sources = args.extra_source_caches
+            object_store.delta = args.checkpoint_delta
+
+            checkpoints = None
+            if args.auto_checkpoint:
+                if object_store.maximum_size:
+                    checkpoints = CheckpointPolicy()
+                else:
+                    print("Warning: --auto-checkpoint needs a maximum cache size (--cache-max-size), "
+                          "no stages are committed automatically", file=sys.stderr)
 
             stage_timeout = args.stage_timeout
 
             pipelines = manifest.depsolve(object_store, exports)
 
-            manifest.download(object_store, monitor, args.libdir)
+            manifest.download(object_store, monitor, args.libdir, service_pool=service_pool)
 
             r = manifest.build(
                 object_store,
                 pipelines,
                 monitor,
                 args.libdir,
-                stage_timeout=stage_timeout
+                stage_timeout=stage_timeout,
+                jobs=args.jobs,
+                reuse_buildroot=args.reuse_buildroot,
+                checkpoints=checkpoints,
+                service_pool=service_pool,
+                cpu_budget=args.cpu_budget
             )
 
             if r["success"] and exports:
-                for pid in exports:
-                    export(pid, output_directory, object_store, manifest)
+                export_all(exports, output_directory, object_store, manifest, monitor)
 
             if args.json:
                 r = fmt.output(manifest, r, object_store)
@@ -190,7 +311,10 @@ def osbuild_cli():
                     print()
                     print(f"{vt.reset}{vt.bold}{vt.red}Failed{vt.reset}")
 
-            return 0 if r["success"] else 1
+        if args.gc_sources:
+            gc_sources(source_cache, None, file=sys.stderr if args.json else sys.stdout)
+
+        return 0 if r["success"] else 1
 
     except KeyboardInterrupt:
         print()
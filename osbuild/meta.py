@@ -23,11 +23,15 @@ method called `detect_format_info`
 import ast
 import contextlib
 import copy
+import functools
+import hashlib
 import importlib.util
 import json
 import os
 import pkgutil
 import sys
+import tempfile
+import time
 from collections import deque
 from typing import (Any, Deque, Dict, List, Optional, Sequence, Set, Tuple,
                     Union)
@@ -39,6 +43,10 @@ from .util import osrelease
 FAILED_TITLE = "JSON Schema validation failed"
 FAILED_TYPEURI = "https://osbuild.org/validation-error"
 
+# Version of the module information cache, needs to be increased
+# whenever the information extracted from modules changes
+CACHE_VERSION = 1
+
 
 class ValidationError:
     """Describes a single failed validation
@@ -215,11 +223,20 @@ class Schema:
 
     The truth value of this objects corresponds to it having
     schema data.
+
+    If the schema data is already known to be valid, `checked` can
+    be set to skip its validation, which is comparatively expensive.
+
+    The number of validated targets and the time it took is kept
+    in `count` and `duration`.
     """
 
-    def __init__(self, schema: Optional[Dict], name: Optional[str] = None):
+    def __init__(self, schema: Optional[Dict], name: Optional[str] = None, *, checked: bool = False):
         self.data = schema
         self.name = name
+        self.checked = checked
+        self.count = 0
+        self.duration = 0.0
         self._validator: Optional[jsonschema.Draft4Validator] = None
 
     def check(self) -> ValidationResult:
@@ -244,9 +261,8 @@ class Schema:
             return res
 
         try:
-            Validator = jsonschema.Draft4Validator
-            Validator.check_schema(self.data)
-            self._validator = Validator(self.data)
+            data = json.dumps(self.data, sort_keys=True)
+            self._validator = _compile_schema(data, check=not self.checked)
         except jsonschema.exceptions.SchemaError as err:
             res += ValidationError.from_exception(err)
 
@@ -267,15 +283,89 @@ class Schema:
         if not self._validator:
             raise RuntimeError("Trying to validate without validator.")
 
+        start = time.monotonic()
+
         for error in self._validator.iter_errors(target):
             res += ValidationError.from_exception(error)
 
+        self.count += 1
+        self.duration += time.monotonic() - start
+
         return res
 
+    def validate_all(self, targets: Sequence) -> List[ValidationResult]:
+        """Validate all `targets` against this schema
+
+        Like `validate`, but for many targets at once, returning
+        a `ValidationResult` for each of them. Targets that are
+        equal are only validated once and share the result.
+        """
+        res = self.check()
+
+        if not res:
+            return [res] * len(targets)
+
+        keys = [json.dumps(t, sort_keys=True) for t in targets]
+        results: Dict[str, ValidationResult] = {}
+        for key, target in zip(keys, targets):
+            if key not in results:
+                results[key] = self.validate(target)
+            else:
+                self.count += 1
+
+        return [results[key] for key in keys]
+
     def __bool__(self):
         return self.check().valid
 
 
+def _inline_refs(node, root: Dict, refs: Tuple[str, ...] = ()):
+    """Replace local references in `node` with what they refer to
+
+    Recursive references are kept as they are.
+    """
+    if isinstance(node, list):
+        return [_inline_refs(n, root, refs) for n in node]
+
+    if not isinstance(node, dict):
+        return node
+
+    ref = node.get("$ref")
+    if isinstance(ref, str) and ref.startswith("#/") and ref not in refs:
+        target = root
+        try:
+            for part in ref[2:].split("/"):
+                target = target[part.replace("~1", "/").replace("~0", "~")]
+        except (KeyError, TypeError):
+            return node
+        # NB: in draft 4, everything next to a reference is ignored
+        return _inline_refs(target, root, refs + (ref,))
+
+    return {k: _inline_refs(v, root, refs) for k, v in node.items()}
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_schema(data: str, *, check: bool = True) -> jsonschema.Draft4Validator:
+    """Create a validator for the serialized schema `data`
+
+    The local references of the schema are resolved upfront, since
+    looking them up during validation is comparatively expensive.
+    Validators are cached and shared by all `Schema` objects, also
+    of different `Index` instances, with the same schema data.
+    """
+    Validator = jsonschema.Draft4Validator
+    schema = json.loads(data)
+
+    if check:
+        Validator.check_schema(schema)
+
+    # The root itself is kept, so that the recursive references,
+    # which are not inlined, can still be resolved
+    compiled = {k: _inline_refs(v, schema) for k, v in schema.items()}
+
+    return Validator(compiled)
+
+
 class ModuleInfo:
     """Meta information about a stage
 
@@ -288,6 +378,9 @@ class ModuleInfo:
     `Schema` object.
 
     Normally this class is instantiated via its `load` method.
+
+    The versions of the schema that are known to be valid are
+    kept in `checked`; see `mark_checked`.
     """
 
     # Known modules and their corresponding directory name
@@ -308,7 +401,10 @@ class ModuleInfo:
         self.info = info["info"]
         self.desc = info["desc"]
         self.opts = info["schema"]
-        self.caps = info["caps"]
+        self.caps = set(info["caps"])
+
+        self.checked: Set[str] = set()
+        self._cache: Optional[Tuple[str, Dict]] = None
 
     def _load_opts(self, version, fallback=None):
         raw = self.opts[version]
@@ -408,27 +504,89 @@ class ModuleInfo:
 
         return {e.s for e in node.value.elts}
 
-    @classmethod
-    def load(cls, root, klass, name) -> Optional["ModuleInfo"]:
-        names = ["SCHEMA", "SCHEMA_2", "CAPABILITIES"]
+    def mark_checked(self, version: str):
+        """Record that the schema for `version` is valid
 
-        def filter_type(lst, target):
-            return [x for x in lst if isinstance(x, target)]
+        If the information was loaded via a cache, the cache is
+        updated so that the schema does not need to be checked
+        again, see `Schema`.
+        """
+        if version in self.checked:
+            return
 
-        def targets(a):
-            return [t.id for t in filter_type(a.targets, ast.Name)]
+        self.checked.add(version)
+
+        if self._cache:
+            path, entry = self._cache
+            entry["checked"] = sorted(self.checked)
+            _write_cache(path, entry)
 
+    @classmethod
+    def load(cls, root, klass, name, *, cache: Optional[str] = None) -> Optional["ModuleInfo"]:
+        """Load the information for the module `name` of `klass`
+
+        The module is found in `root`. If `cache` is given, the
+        information is stored in that directory and only extracted
+        from the module again if the module changed, which is
+        detected via its modification time and size, and if those
+        differ, its hash.
+        """
         base = cls.MODULES.get(klass)
         if not base:
             raise ValueError(f"Unsupported type: {klass}")
 
         path = os.path.join(root, base, name)
+
+        if cache:
+            return cls._load_cached(klass, name, path, os.path.join(cache, base, name + ".json"))
+
         try:
             with open(path, encoding="utf8") as f:
                 data = f.read()
         except FileNotFoundError:
             return None
 
+        return cls(klass, name, path, cls._parse(klass, name, data))
+
+    @classmethod
+    def _load_cached(cls, klass, name, path, cachefile) -> Optional["ModuleInfo"]:
+        entry = _read_cache(cachefile)
+
+        try:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                stamp = {"path": path, "mtime": st.st_mtime_ns, "size": st.st_size}
+                data = None
+                if not entry or any(entry.get(k) != v for k, v in stamp.items()):
+                    data = f.read()
+        except FileNotFoundError:
+            return None
+
+        if data is not None:
+            digest = hashlib.sha256(data).hexdigest()
+            if not entry or entry.get("sha256") != digest:
+                info = cls._parse(klass, name, data.decode("utf8"))
+                info["caps"] = sorted(info["caps"])
+                entry = {"sha256": digest, "info": info, "checked": []}
+            entry.update(stamp)
+            _write_cache(cachefile, entry)
+
+        assert entry is not None
+        modinfo = cls(klass, name, path, entry["info"])
+        modinfo.checked = set(entry["checked"])
+        modinfo._cache = cachefile, entry
+        return modinfo
+
+    @classmethod
+    def _parse(cls, klass, name, data) -> Dict:
+        names = ["SCHEMA", "SCHEMA_2", "CAPABILITIES"]
+
+        def filter_type(lst, target):
+            return [x for x in lst if isinstance(x, target)]
+
+        def targets(a):
+            return [t.id for t in filter_type(a.targets, ast.Name)]
+
         tree = ast.parse(data, name)
 
         docstring = ast.get_docstring(tree)
@@ -457,7 +615,39 @@ class ModuleInfo:
             'info': "\n".join(doclist[1:]),
             'caps': parse_caps(values.get("CAPABILITIES"))
         }
-        return cls(klass, name, path, info)
+        return info
+
+
+def _read_cache(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+        return None
+
+    return entry
+
+
+def _write_cache(path: str, entry: Dict):
+    # The cache is merely an optimization, thus it is fine if it
+    # cannot be written, e.g. because it is read-only
+    entry["version"] = CACHE_VERSION
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf8", dir=os.path.dirname(path),
+                                         prefix=".", delete=False) as f:
+            try:
+                json.dump(entry, f)
+                f.flush()
+                os.replace(f.name, path)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+    except OSError:
+        pass
 
 
 class FormatInfo:
@@ -531,10 +721,15 @@ class Index:
 
     Class that can be used to get the meta information about
     osbuild modules as well as JSON schemata.
+
+    If a `cache` directory is given, the information extracted
+    from the modules is stored there and re-used as long as the
+    modules do not change, see `ModuleInfo.load`.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, *, cache: Optional[str] = None):
         self.path = os.path.abspath(path)
+        self.cache = cache
         self._module_info: Dict[Tuple[str, Any], Any] = {}
         self._format_info: Dict[Tuple[str, Any], Any] = {}
         self._schemata: Dict[Tuple[str, Any, str], Schema] = {}
@@ -593,7 +788,7 @@ class Index:
 
         if (klass, name) not in self._module_info:
 
-            info = ModuleInfo.load(self.path, klass, name)
+            info = ModuleInfo.load(self.path, klass, name, cache=self.cache)
             self._module_info[(klass, name)] = info
 
         return self._module_info[(klass, name)]
@@ -609,6 +804,7 @@ class Index:
         """
         cached_schema: Optional[Schema] = self._schemata.get((klass, name, version))
         schema = None
+        info = None
 
         if cached_schema is not None:
             return cached_schema
@@ -625,11 +821,23 @@ class Index:
         else:
             raise ValueError(f"Unknown klass: {klass}")
 
-        schema = Schema(schema, name or klass)
+        checked = info is not None and version in info.checked
+        schema = Schema(schema, name or klass, checked=checked)
         self._schemata[(klass, name, version)] = schema
 
+        if info and not checked and schema.check():
+            info.mark_checked(version)
+
         return schema
 
+    def list_schemata(self) -> List[Tuple[str, Optional[str], str, Schema]]:
+        """List all schemata obtained so far
+
+        Returns a list of tuples of the `klass`, `name` and `version`
+        passed to `get_schema` and the `Schema` itself.
+        """
+        return [(*key, schema) for key, schema in self._schemata.items()]
+
     def list_runners(self, distro: Optional[str] = None) -> List[RunnerInfo]:
         """List all available runner modules
 
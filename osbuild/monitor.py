@@ -9,17 +9,35 @@ are called on the monitor object at certain events. Consult the
 """
 
 import abc
+import contextlib
 import datetime
 import json
 import os
 import sys
+import threading
 import time
-from typing import Dict
+from typing import Dict, List, Optional
 
 import osbuild
+from osbuild.util import treecopy
 from osbuild.util.term import fmt as vt
 
 
+def _monotonic_ns() -> int:
+    """Like `time.monotonic_ns`, which needs Python 3.7"""
+    return int(time.monotonic() * 1e9)
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return f"{size:.1f} {unit}"
+
+
 class TextWriter:
     """Helper class for writing text to file descriptors"""
 
@@ -48,6 +66,34 @@ class TextWriter:
                 data = data[n:]
 
 
+class TextBuffer:
+    """Collects text to be written to a `TextWriter` in one go
+
+    Offers the same methods as `TextWriter`, so that text can be
+    composed by the same code, before it is written at once.
+    """
+
+    def __init__(self, isatty: bool):
+        self.isatty = isatty
+        self.parts: List[str] = []
+
+    def term(self, text, *, clear=False):
+        """Add text if attached to a terminal."""
+        if not self.isatty:
+            return
+
+        if clear:
+            self.write(vt.reset)
+
+        self.write(text)
+
+    def write(self, text: str):
+        self.parts.append(text)
+
+    def getvalue(self) -> str:
+        return "".join(self.parts)
+
+
 class BaseMonitor(abc.ABC):
     """Base class for all pipeline monitors"""
 
@@ -73,6 +119,21 @@ class BaseMonitor(abc.ABC):
     def log(self, message: str):
         """Called for all module log outputs"""
 
+    def export(self, name: str, progress: treecopy.Progress):
+        """Called periodically while `name` is exported, and when it is done"""
+
+    def source(self, source: osbuild.sources.Source):
+        """Called when the items of a source are being downloaded"""
+
+    def source_result(self, source: osbuild.sources.Source, success: bool):
+        """Called when the download of the items of a source is done"""
+
+    def service_start(self, uid: str, name: str):
+        """Called when the host service `name` was started as `uid`"""
+
+    def service_stop(self, uid: str):
+        """Called when the host service `uid` is being stopped"""
+
 
 class NullMonitor(BaseMonitor):
     """Monitor class that does not report anything"""
@@ -88,59 +149,219 @@ class LogMonitor(BaseMonitor):
     The constructor argument `fd` is a file descriptor, where
     the log will get written to. If `fd`  is a `TTY`, escape
     sequences will be used to highlight sections of the log.
+
+    Pipelines can be built concurrently, see `Manifest.build`: the
+    state of a pipeline is kept per thread and each event is written
+    at once. Whenever the output switches to another pipeline, the
+    name of the pipeline is written before it.
     """
 
     def __init__(self, fd: int):
         super().__init__(fd)
-        self.timer_start = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.last_pipeline: Optional[str] = None
+
+    @contextlib.contextmanager
+    def output(self):
+        """Compose text and write it at once, see `TextBuffer`"""
+        buf = TextBuffer(self.out.isatty)
+        yield buf
+
+        pipeline = getattr(self.local, "pipeline", None)
+        with self.lock:
+            if pipeline and self.last_pipeline not in (None, pipeline):
+                self.out.term(vt.bold, clear=True)
+                self.out.write(f"\n[{pipeline}]")
+                self.out.term(vt.reset)
+                self.out.write("\n")
+            if pipeline:
+                self.last_pipeline = pipeline
+            self.out.write(buf.getvalue())
 
     def result(self, result):
-        duration = int(time.time() - self.timer_start)
-        self.out.write(f"\n⏱  Duration: {duration}s\n")
+        now = time.monotonic()
+        duration = now - getattr(self.local, "timer_start", now)
+        with self.output() as out:
+            out.write(f"\n⏱  Duration: {duration:.2f}s\n")
 
     def begin(self, pipeline):
-        self.out.term(vt.bold, clear=True)
-        self.out.write(f"Pipeline {pipeline.name}: {pipeline.id}")
-        self.out.term(vt.reset)
-        self.out.write("\n")
-        self.out.write("Build\n  root: ")
-        if pipeline.build:
-            self.out.write(pipeline.build)
-        else:
-            self.out.write("<host>")
-        self.out.write(f"\n  runner: {pipeline.runner.name} ({pipeline.runner.exec})")
-        source_epoch = pipeline.source_epoch
-        if source_epoch is not None:
-            timepoint = datetime.datetime.fromtimestamp(source_epoch).strftime('%c')
-            self.out.write(f"\n  source-epoch: {timepoint} [{source_epoch}]")
-        self.out.write("\n")
+        # the header names the pipeline, no need to repeat it
+        with self.lock:
+            self.last_pipeline = pipeline.name
+        self.local.pipeline = pipeline.name
+
+        with self.output() as out:
+            out.term(vt.bold, clear=True)
+            out.write(f"Pipeline {pipeline.name}: {pipeline.id}")
+            out.term(vt.reset)
+            out.write("\n")
+            out.write("Build\n  root: ")
+            if pipeline.build:
+                out.write(pipeline.build)
+            else:
+                out.write("<host>")
+            out.write(f"\n  runner: {pipeline.runner.name} ({pipeline.runner.exec})")
+            source_epoch = pipeline.source_epoch
+            if source_epoch is not None:
+                timepoint = datetime.datetime.fromtimestamp(source_epoch).strftime('%c')
+                out.write(f"\n  source-epoch: {timepoint} [{source_epoch}]")
+            out.write("\n")
+
+    def finish(self, result):
+        self.local.pipeline = None
 
     def stage(self, stage):
-        self.module(stage)
+        with self.output() as out:
+            self.module(out, stage)
 
     def assembler(self, assembler):
-        self.out.term(vt.bold, clear=True)
-        self.out.write("Assembler ")
-        self.out.term(vt.reset)
+        with self.output() as out:
+            out.term(vt.bold, clear=True)
+            out.write("Assembler ")
+            out.term(vt.reset)
 
-        self.module(assembler)
+            self.module(out, assembler)
 
-    def module(self, module):
+    def module(self, out, module):
         options = module.options or {}
         title = f"{module.name}: {module.id}"
 
-        self.out.term(vt.bold, clear=True)
-        self.out.write(title)
-        self.out.term(vt.reset)
-        self.out.write(" ")
+        out.term(vt.bold, clear=True)
+        out.write(title)
+        out.term(vt.reset)
+        out.write(" ")
 
-        json.dump(options, self.out, indent=2)
-        self.out.write("\n")
+        json.dump(options, out, indent=2)
+        out.write("\n")
 
-        self.timer_start = time.time()
+        self.local.timer_start = time.monotonic()
+
+    def log(self, message):
+        with self.output() as out:
+            out.write(message)
+
+    def export(self, name, progress):
+        status = f"{format_size(progress.done)} of {format_size(progress.total)}, " \
+                 f"{format_size(progress.rate)}/s"
+
+        with self.output() as out:
+            # on a terminal, the status line is updated until the export is done
+            out.term(vt.clear_line)
+            if not progress.finished:
+                out.term(f"Export {name}: {status}")
+                return
+
+            out.term(vt.bold, clear=True)
+            out.write(f"Export {name}")
+            out.term(vt.reset)
+            out.write(f": {status} in {progress.duration:.1f}s "
+                      f"(copied {format_size(progress.copied)}, reflinked {format_size(progress.cloned)}, "
+                      f"moved {format_size(progress.moved)})\n")
+            if progress.copied and progress.reflink_error:
+                out.write(f"  reflinks not possible: {progress.reflink_error}\n")
+
+
+class JSONSeqMonitor(BaseMonitor):
+    """Monitor that streams machine-readable records
+
+    Every event is written as a JSON object in the JSON text sequence
+    format (RFC 7464), i.e. each record is prefixed with an ASCII record
+    separator and terminated by a newline, so that the records can be
+    parsed while the build is still running.
+
+    All records have a `type` and a `timestamp`, which is the value of
+    the monotonic clock in nanoseconds. Records for the end of a stage,
+    a pipeline or a source download also include the `duration` in
+    nanoseconds and, for stages, the CPU time, peak memory usage and
+    I/O of all processes that were run in the build root, see
+    `CompletedBuild.usage`.
+
+    Pipelines, and the sources, can be built concurrently; events are
+    attributed to the pipeline that is being built in the same thread.
+    """
+
+    def __init__(self, fd: int):
+        super().__init__(fd)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def record(self, kind: str, **kwargs):
+        data = {"type": kind, "timestamp": _monotonic_ns()}
+        data.update(kwargs)
+        text = "\x1e" + json.dumps(data) + "\n"
+        with self.lock:
+            self.out.write(text)
+        return data["timestamp"]
+
+    def begin(self, pipeline):
+        self.local.pipeline = pipeline.id
+        self.local.pipeline_start = self.record("pipeline-begin",
+                                                name=pipeline.name,
+                                                id=pipeline.id,
+                                                build=pipeline.build,
+                                                runner=pipeline.runner.name)
+
+    def finish(self, result):
+        now = _monotonic_ns()
+        self.record("pipeline-end",
+                    timestamp=now,
+                    id=getattr(self.local, "pipeline", None),
+                    success=result["success"],
+                    duration=now - getattr(self.local, "pipeline_start", now))
+        self.local.pipeline = None
+
+    def stage(self, stage):
+        self.local.stage_start = self.record("stage-begin",
+                                             pipeline=getattr(self.local, "pipeline", None),
+                                             name=stage.name,
+                                             id=stage.id)
+
+    def assembler(self, assembler):
+        self.stage(assembler)
+
+    def result(self, result):
+        now = _monotonic_ns()
+        self.record("stage-end",
+                    timestamp=now,
+                    pipeline=getattr(self.local, "pipeline", None),
+                    name=result.name,
+                    id=result.id,
+                    success=result.success,
+                    duration=now - getattr(self.local, "stage_start", now),
+                    usage=result.usage)
 
     def log(self, message):
-        self.out.write(message)
+        self.record("log", pipeline=getattr(self.local, "pipeline", None), message=message)
+
+    def export(self, name, progress):
+        self.record("export",
+                    name=name,
+                    finished=progress.finished,
+                    total=progress.total,
+                    copied=progress.copied,
+                    cloned=progress.cloned,
+                    moved=progress.moved,
+                    duration=int(progress.duration * 1e9))
+
+    def source(self, source):
+        self.local.source_start = self.record("source-begin",
+                                              name=source.info.name,
+                                              items=len(source.items))
+
+    def source_result(self, source, success):
+        now = _monotonic_ns()
+        self.record("source-end",
+                    timestamp=now,
+                    name=source.info.name,
+                    success=success,
+                    duration=now - getattr(self.local, "source_start", now))
+
+    def service_start(self, uid, name):
+        self.record("service-start", id=uid, name=name)
+
+    def service_stop(self, uid):
+        self.record("service-stop", id=uid)
 
 
 def make(name, fd):
@@ -1,14 +1,21 @@
+# pylint: disable=too-many-lines
+
 import contextlib
 import enum
+import hashlib
 import json
 import os
+import re
+import stat
 import subprocess
 import tempfile
+import threading
 import time
-from typing import Any, Optional, Set, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from osbuild.util import jsoncomm
+from osbuild.util import jsoncomm, rmrf, treecopy
 from osbuild.util.fscache import FsCache, FsCacheInfo
+from osbuild.util.fscache import _scan_tree as _scan_usage
 from osbuild.util.mnt import mount, umount
 from osbuild.util.path import clamp_mtime
 from osbuild.util.types import PathLike
@@ -17,9 +24,68 @@ from . import api
 
 __all__ = [
     "ObjectStore",
+    "SourceCache",
 ]
 
 
+# Valid names of sources and checksums, used to guard paths derived from them
+VALID_SOURCE_NAME = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]*$")
+VALID_CHECKSUM = re.compile(r"^(md5|sha1|sha256|sha384|sha512):[0-9a-f]{32,128}$")
+
+# Description of a checkpoint that is stored as delta, see `ObjectStore.commit`
+DELTA_INFO = "delta.json"
+# Suffix of the cache entries of assembled delta checkpoints
+ASSEMBLED_SUFFIX = ".assembled"
+
+
+def _read_delta_info(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(path, DELTA_INFO), "r", encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _load_layers(cache: FsCache, stack: contextlib.ExitStack, object_id: str) -> List[str]:
+    """Load the cache entry of `object_id` and the ones it is based on
+
+    If the entry is a delta checkpoint, the entries of its parents are
+    loaded, too, up to the first one that contains a full tree. Returns
+    the paths of all entries, starting with the one of `object_id`.
+    Raises `FsCache.MissError` if any of them is missing.
+    """
+    layers = []
+    parent: Optional[str] = object_id
+    while parent:
+        name = stack.enter_context(cache.load(parent))
+        path = os.path.join(cache, name)
+        layers.append(path)
+        info = _read_delta_info(path)
+        parent = info["parent"] if info else None
+    return layers
+
+
+def _scan_tree(root: str) -> Dict[str, Tuple[int, int, int]]:
+    """Record the state of all entries of the tree at `root`
+
+    Any change to an entry, be it its data or its metadata, also
+    changes its status change time, which can not be set by other
+    means; entries that are replaced have a different inode. Hence,
+    comparing the state of a tree that is modified in place to an
+    earlier one yields all the entries that were changed.
+    """
+    def state(path):
+        st = os.lstat(path)
+        return st.st_mode, st.st_ino, st.st_ctime_ns
+
+    result = {".": state(root)}
+    for path, dirs, files in os.walk(root):
+        for name in dirs + files:
+            full = os.path.join(path, name)
+            result[os.path.relpath(full, root)] = state(full)
+    return result
+
+
 class PathAdapter:
     """Expose an object attribute as `os.PathLike`"""
 
@@ -31,6 +97,7 @@ class PathAdapter:
         return getattr(self.obj, self.attr)
 
 
+# pylint: disable=too-many-instance-attributes
 class Object:
     class Mode(enum.Enum):
         READ = 0
@@ -114,19 +181,66 @@ class Object:
         self._path = None
         self._meta: Optional[Object.Metadata] = None
         self._stack: Optional[contextlib.ExitStack] = None
+        self._overlay = False
+        self._staged = False
+        self._assembled = False
+        # the last checkpoint of the tree, see `checkpoint()`
+        self._parent: Optional[str] = None
+        self._snapshot: Optional[Dict[str, Tuple[int, int, int]]] = None
+        self.track_changes = False
         self.source_epoch = None  # see finalize()
 
     def _open_for_reading(self):
+        layers = _load_layers(self._cache, self._stack, self.id)
+        if len(layers) == 1:
+            self._path = layers[0]
+            return
+
+        # A delta checkpoint: its tree is assembled only once and then
+        # kept in the cache, next to the delta, for all later reads
+        self._assembled = True
+        assembled = self.id + ASSEMBLED_SUFFIX
+        with contextlib.suppress(FsCache.MissError):
+            name = self._stack.enter_context(self._cache.load(assembled))
+            self._path = os.path.join(self._cache, name)
+            return
+
+        # Starting with the full tree of the first entry, apply the
+        # changes of all following ones to a copy
         name = self._stack.enter_context(
-            self._cache.load(self.id)
+            self._cache.stage()
         )
-        self._path = os.path.join(self._cache, name)
+        self._path = os.path.join(self._cache, name, "assembled")
+        os.makedirs(self._path)
+
+        *deltas, base = layers
+        treecopy.copy_tree(os.path.join(base, "tree"), self.tree)
+        for layer in reversed(deltas):
+            info = _read_delta_info(layer)
+            assert info
+            for path in info["removed"]:
+                target = os.path.join(self.tree, path)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    rmrf.rmtree(target)
+                elif os.path.lexists(target):
+                    os.unlink(target)
+            treecopy.copy_tree(os.path.join(layer, "tree"), self.tree)
+
+        treecopy.copy_tree(os.path.join(layers[0], "meta"), os.path.join(self._path, "meta"))
+
+        # if it can not be cached, the staged copy is used
+        name = self._stack.enter_context(
+            self._cache.move_tree(assembled, self._path)
+        )
+        if name:
+            self._path = os.path.join(self._cache, name)
 
     def _open_for_writing(self):
         name = self._stack.enter_context(
             self._cache.stage()
         )
         self._path = os.path.join(self._cache, name)
+        self._staged = True
         os.makedirs(os.path.join(self._path, "tree"))
 
     def __enter__(self):
@@ -166,23 +280,138 @@ class Object:
     def mode(self) -> Mode:
         return self._mode
 
-    def init(self, base: "Object"):
-        """Initialize the object with the base object"""
+    @property
+    def assembled(self) -> bool:
+        """Whether the tree was assembled from a delta checkpoint"""
+        return self._assembled
+
+    def init(self, base: "Object", *, overlay: bool = False):
+        """Initialize the object with the base object
+
+        The tree and the metadata of `base` are copied into this
+        object. If `overlay` is `True`, the tree is not copied but
+        used as the read-only lower layer of an overlay mount, so
+        that only changes to it need to be stored. If the overlay
+        cannot be mounted, the tree is copied instead.
+        """
         self._check_mode(Object.Mode.WRITE)
         assert self.active
         assert self._path
 
+        source, target = base.path, self.path
+        if overlay and self._mount_overlay(base):
+            # only the metadata is left to be copied
+            source, target = base.meta, self.meta
+
         subprocess.run(
             [
                 "cp",
                 "--reflink=auto",
                 "-a",
-                os.fspath(base.path) + "/.",
-                os.fspath(self.path),
+                os.fspath(source) + "/.",
+                os.fspath(target),
             ],
             check=True,
         )
 
+        if self.track_changes:
+            self.checkpoint(base.id)
+
+    def checkpoint(self, object_id: str):
+        """Record the current state of the tree as checkpoint `object_id`
+
+        Later changes to the tree can then be stored as delta to the
+        checkpoint, see `changes()`.
+        """
+        self._parent = object_id
+        self._snapshot = _scan_tree(self.tree)
+
+    def changes(self) -> Optional[Tuple[str, List[str], List[str]]]:
+        """Changes to the tree since the last checkpoint
+
+        Returns the id of the checkpoint, the paths of all entries that
+        were added or changed and the ones that were removed, or `None`
+        if no checkpoint was recorded. Entries that were replaced with
+        ones of a different type are in both lists; of removed trees
+        only the top-level directory is included.
+        """
+        if not self._parent or self._snapshot is None:
+            return None
+
+        old, new = self._snapshot, _scan_tree(self.tree)
+        changed = [path for path, state in new.items() if path != "." and old.get(path) != state]
+        removed = {
+            path for path, state in old.items()
+            if path not in new or stat.S_IFMT(new[path][0]) != stat.S_IFMT(state[0])
+        }
+        removed = {path for path in removed if os.path.dirname(path) not in removed}
+        return self._parent, changed, sorted(removed)
+
+    def _mount_overlay(self, base: "Object") -> bool:
+        """Internal: mount an overlay with the tree of `base` as lower layer"""
+        assert self._stack
+
+        # The upper and work directories are in a separate staging
+        # entry, so that they are not part of the object's data
+        scratch = self._stack.enter_context(self._cache.stage())
+        upper = os.path.join(self._cache, scratch, "upper")
+        work = os.path.join(self._cache, scratch, "work")
+        os.makedirs(upper)
+        os.makedirs(work)
+
+        # the root of the overlay is the root of the upper layer
+        st = os.lstat(base.tree)
+        os.chown(upper, st.st_uid, st.st_gid)
+        os.chmod(upper, stat.S_IMODE(st.st_mode))
+
+        options = f"lowerdir={base.tree},upperdir={upper},workdir={work}"
+        r = subprocess.run(
+            ["mount", "-t", "overlay", "-o", options, "overlay", self.tree],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        if r.returncode != 0:
+            return False
+
+        self._stack.callback(umount, self.tree)
+        os.utime(self.tree, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self._overlay = True
+        return True
+
+    def move_to_cache(self, object_id: str) -> bool:
+        """Move the object into the cache as `object_id`
+
+        Instead of copying, the data of the object is moved into
+        the cache, and from then on the object refers to the new
+        cache entry. Only objects in the READ mode can be moved,
+        since they must not be modified anymore. Returns `False`
+        if the object could not be moved, in which case it stays
+        untouched, see `FsCache.move_tree` for details.
+        """
+        self._check_mode(Object.Mode.READ)
+        assert self._stack
+
+        # the tree of an overlay is a mount point and can't be moved
+        if self._overlay:
+            return False
+
+        with contextlib.ExitStack() as stack:
+            name = stack.enter_context(
+                self._cache.move_tree(object_id, self.path)
+            )
+            if not name:
+                return False
+
+            # the data was moved out of our staging entry, so it
+            # can be released; the cache entry is kept open instead
+            self._stack.close()
+            self._stack = stack.pop_all()
+            self._path = os.path.join(self._cache, name)
+            self._staged = False
+
+        return True
+
     @property
     def path(self) -> str:
         assert self.active
@@ -244,18 +473,20 @@ class Object:
         if self.mode != want:
             raise ValueError(f"Wrong object mode: {self.mode}, want {want}")
 
-    def export(self, to_directory: PathLike):
-        """Copy object into an external directory"""
-        subprocess.run(
-            [
-                "cp",
-                "--reflink=auto",
-                "-a",
-                os.fspath(self.tree) + "/.",
-                os.fspath(to_directory),
-            ],
-            check=True,
-        )
+    def export(self, to_directory: PathLike, *, move: bool = False,
+               progress: Optional[treecopy.Progress] = None) -> treecopy.Progress:
+        """Copy object into an external directory
+
+        The files of the tree are copied concurrently, and reflinked if
+        possible; the `progress` is reported, see `treecopy.copy_tree`.
+        If `move` is set, the contents of the tree are moved instead,
+        if possible, which is only done for objects that are not in
+        the cache; the tree must not be used afterwards.
+        """
+        assert self.active
+
+        move = move and self._staged and not self._overlay
+        return treecopy.copy_tree(self.tree, to_directory, move=move, progress=progress)
 
     def __fspath__(self):
         return self.tree
@@ -308,9 +539,218 @@ class HostTree:
         return self.tree
 
 
+class SourceCache(FsCache):
+    """Cache for the content of sources, can be shared between stores
+
+    The items of sources are stored in one directory per content type,
+    e.g. `org.osbuild.files`, named by their checksum. Next to those,
+    the scaffolding of `FsCache` coordinates the stores sharing the
+    cache: while a store is active it holds a read-lock on `cache.lock`
+    and garbage collection requires the write-lock. The items used by
+    a manifest are recorded in `refs/`, where the modification time of
+    a reference is the last time it was used.
+
+    Content that is shared by several items, like the layers of container
+    images, can be kept in a `blobs/` directory of the content type and
+    hardlinked into the items; blobs that are not linked into any item
+    anymore are removed along with the items.
+    """
+
+    _dirname_refs = "refs"
+    _dirname_blobs = "blobs"
+
+    # Items that have not been used for that long are always collected
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, path: PathLike):
+        super().__init__("osbuild", path)
+
+    def add_ref(self, checksums: Iterable[str]):
+        """Record that the items `checksums` are being used"""
+        assert self._is_active()
+
+        data = json.dumps(sorted(set(checksums)))
+        name = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        path = self._path(self._dirname_refs, name)
+        os.makedirs(self._path(self._dirname_refs), exist_ok=True)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._atomic_file(os.path.join(self._dirname_refs, name), self._dirname_stage, replace=True) as f:
+                f.write(data)
+
+    def _load_refs(self, now: float) -> Tuple[Dict[str, float], List[str]]:
+        last_used: Dict[str, float] = {}
+        expired = []
+
+        with contextlib.suppress(FileNotFoundError):
+            for entry in os.scandir(self._path(self._dirname_refs)):
+                mtime = entry.stat().st_mtime
+                if now - mtime > self.max_age:
+                    expired.append(entry.path)
+                    continue
+                with open(entry.path, "r", encoding="utf8") as f:
+                    for checksum in json.load(f):
+                        last_used[checksum] = max(mtime, last_used.get(checksum, 0))
+
+        return last_used, expired
+
+    def _scan_items(self, last_used: Dict[str, float]) -> List[Tuple[float, str, int, Dict[Tuple[int, int], int]]]:
+        """Scan the items and return when they were last used, and their disk usage
+
+        The disk usage of an item is split into its files with a single link and
+        those with multiple links, like the ones shared with the blobs, indexed by
+        device and inode, to account each of them only once, see `_scan_usage`.
+        """
+        items: List[Tuple[float, str, int, Dict[Tuple[int, int], int]]] = []
+        scaffolding = {self._dirname_objects, self._dirname_stage, self._dirname_refs}
+
+        for content in os.scandir(self._path_cache):
+            if content.name in scaffolding or content.name.endswith(".verified") or not content.is_dir():
+                continue
+
+            for entry in os.scandir(content.path):
+                if entry.name == self._dirname_blobs:
+                    continue
+                if entry.name.startswith((".journal-", ".unverified-")):
+                    # no download is in progress, see `collect_garbage`, but the journal
+                    # might refer to items that are about to be removed
+                    items.append((0.0, entry.path, 0, {}))
+                    continue
+                if not VALID_CHECKSUM.match(entry.name):
+                    continue
+
+                st = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    size, links, _ = _scan_usage(entry.path)
+                elif st.st_nlink > 1:
+                    size, links = 0, {(st.st_dev, st.st_ino): min(st.st_size, st.st_blocks * 512)}
+                else:
+                    size, links = min(st.st_size, st.st_blocks * 512), {}
+                items.append((last_used.get(entry.name, st.st_mtime), entry.path, size, links))
+
+        return items
+
+    def _prune_blobs(self, accounted: Set[Tuple[int, int]]) -> Tuple[int, int]:
+        count, freed = 0, 0
+
+        for content in os.scandir(self._path_cache):
+            blobs = os.path.join(content.path, self._dirname_blobs)
+            if content.name == self._dirname_refs or not os.path.isdir(blobs):
+                continue
+
+            for path, _, files in os.walk(blobs):
+                for name in files:
+                    full = os.path.join(path, name)
+                    st = os.lstat(full)
+                    if st.st_nlink > 1:
+                        continue
+                    os.unlink(full)
+                    count += 1
+                    # blobs of removed items were accounted along with them
+                    if (st.st_dev, st.st_ino) not in accounted:
+                        freed += min(st.st_size, st.st_blocks * 512)
+
+        return count, freed
+
+    def _prune_verified(self, removed: Set[str]):
+        for index in os.scandir(self._path_cache):
+            if not index.name.endswith(".verified") or not index.is_dir():
+                continue
+            for key in os.scandir(index.path):
+                for name in removed.intersection(os.listdir(key.path)):
+                    os.unlink(os.path.join(key.path, name))
+
+    def collect_garbage(self) -> Tuple[int, int]:
+        """Remove items that have not been used recently
+
+        Items that have not been used by a manifest for `max_age` are
+        removed, as are the least recently used ones until the cache
+        fits its maximum size, if it has one. Items are kept as long as
+        no use has ever been recorded in the cache. Returns the number
+        of removed items and their size. This needs exclusive access to
+        the cache and must thus be called without an active context;
+        `BlockingIOError` is raised if the cache is in use.
+        """
+        assert not self._is_active()
+
+        self._create_scaffolding()
+        with self._atomic_open(self._filename_cache_lock, write=True, wait=False):
+            self._load_cache_info()
+            maximum = self._info.maximum_size
+            if not isinstance(maximum, int):
+                maximum = -1
+
+            now = time.time()
+            last_used, expired = self._load_refs(now)
+            for path in expired:
+                os.unlink(path)
+
+            # Without any references, e.g. in a cache of an older version,
+            # it is unknown when the items were used last; keep them until
+            # that has been recorded
+            recorded = os.path.isdir(self._path(self._dirname_refs))
+
+            items = sorted(self._scan_items(last_used), key=lambda item: item[:2])
+
+            # files with multiple links are only freed with the last item
+            # that links to them, blobs are pruned separately below
+            shared: Dict[Tuple[int, int], int] = {}
+            usage: Dict[Tuple[int, int], int] = {}
+            for _, _, _, links in items:
+                usage.update(links)
+                for key in links:
+                    shared[key] = shared.get(key, 0) + 1
+
+            total = sum(size for _, _, size, _ in items) + sum(usage.values())
+            count, freed = 0, 0
+            removed = set()
+            accounted = set()
+
+            for used, path, size, links in items:
+                name = os.path.basename(path)
+                if VALID_CHECKSUM.match(name) and (
+                        not recorded or now - used <= self.max_age and (maximum < 0 or total - freed <= maximum)):
+                    break
+                if os.path.isdir(path) and not os.path.islink(path):
+                    rmrf.rmtree(path)
+                else:
+                    os.unlink(path)
+                for key in links:
+                    shared[key] -= 1
+                    if not shared[key]:
+                        size += usage[key]
+                        accounted.add(key)
+                if VALID_CHECKSUM.match(name):
+                    count += 1
+                freed += size
+                removed.add(name)
+
+            self._prune_verified(removed)
+
+            # the blobs of the removed items are not needed anymore
+            blobs, size = self._prune_blobs(accounted)
+            count += blobs
+            freed += size
+
+            self._info = FsCacheInfo()
+
+        return count, freed
+
+
 class ObjectStore(contextlib.AbstractContextManager):
-    def __init__(self, store: PathLike):
+    # How many delta checkpoints can be stacked onto a full one
+    max_delta_depth = 8
+
+    def __init__(self, store: PathLike, *, sources: Optional[PathLike] = None):
         self.cache = FsCache("osbuild", store)
+        # keep the entries that were looked up, they are likely to be used
+        self.cache.retain = True
+        # the content of sources, can be shared with other stores
+        self.source_cache = SourceCache(sources or os.path.join(store, "sources"))
+        # read-only source caches of other stores, sources may use their content
+        self.extra_sources: List[str] = []
         self.tmp = os.path.join(store, "tmp")
         os.makedirs(self.store, exist_ok=True)
         os.makedirs(self.objects, exist_ok=True)
@@ -318,12 +758,20 @@ class ObjectStore(contextlib.AbstractContextManager):
         self._objs: Set[Object] = set()
         self._host_tree: Optional[HostTree] = None
         self._stack = contextlib.ExitStack()
+        # resume from checkpoints via overlay mounts, see `Object.init`
+        self.overlay = False
+        # store checkpoints as delta to the previous one, see `commit`
+        self.delta = False
+        # Pipelines can be built concurrently, see `Manifest.build`,
+        # so guard the bookkeeping of objects and the host tree
+        self._lock = threading.RLock()
 
     def _get_floating(self, object_id: str) -> Optional[Object]:
         """Internal: get a non-committed object"""
-        for obj in self._objs:
-            if obj.mode == Object.Mode.READ and obj.id == object_id:
-                return obj
+        with self._lock:
+            for obj in self._objs:
+                if obj.mode == Object.Mode.READ and obj.id == object_id:
+                    return obj
         return None
 
     @property
@@ -349,12 +797,17 @@ class ObjectStore(contextlib.AbstractContextManager):
     def objects(self):
         return os.path.join(self.cache, "objects")
 
+    @property
+    def sources(self):
+        return os.fspath(self.source_cache)
+
     @property
     def host_tree(self) -> HostTree:
         assert self.active
 
-        if not self._host_tree:
-            self._host_tree = HostTree(self)
+        with self._lock:
+            if not self._host_tree:
+                self._host_tree = HostTree(self)
         return self._host_tree
 
     def contains(self, object_id):
@@ -365,11 +818,66 @@ class ObjectStore(contextlib.AbstractContextManager):
             return True
 
         try:
-            with self.cache.load(object_id):
+            with contextlib.ExitStack() as stack:
+                _load_layers(self.cache, stack, object_id)
                 return True
         except FsCache.MissError:
             return False
 
+    def contains_many(self, object_ids: Iterable[str]) -> Set[str]:
+        """Return which of `object_ids` are in the store
+
+        Like `contains`, but the cache is searched for all of the
+        objects at once, see `FsCache.contains_many`.
+        """
+        object_ids = set(filter(None, object_ids))
+        found = {object_id for object_id in object_ids if self._get_floating(object_id)}
+
+        # delta checkpoints also need their parents
+        for object_id in self.cache.contains_many(object_ids - found):
+            if self.contains(object_id):
+                found.add(object_id)
+
+        return found
+
+    def tree_size(self, obj: Object) -> int:
+        """Return the amount of storage `obj` would take in the cache"""
+        # pylint: disable=protected-access
+        return self.cache._calculate_size(obj.tree)
+
+    def cached_tree(self, name: str) -> Optional[str]:
+        """Return the path of the tree cached as `name`
+
+        Besides objects, the cache holds trees that are expensive to
+        create, like checkouts of OSTree commits, see `cache_tree`.
+        The entry is kept loaded while the store is active; `None` is
+        returned if there is no such entry.
+        """
+        assert self.active
+
+        try:
+            # the cache retains the entry, see `__init__`
+            with self.cache.load(name) as rpath:
+                return os.path.join(self.cache, rpath)
+        except FsCache.MissError:
+            return None
+
+    def cache_tree(self, name: str, tree: PathLike) -> Optional[str]:
+        """Move the directory `tree` into the cache as `name`
+
+        The tree must be on the file system of the store, e.g. in one
+        of its `tempdir`s, and must not be modified afterwards. Returns
+        the path of the cached tree, or `None` if it was not cached,
+        in which case `tree` is left in place.
+        """
+        assert self.active
+
+        with self.cache.move_tree(name, tree) as rpath:
+            if not rpath:
+                return None
+            # load the entry before `move_tree` releases it
+            return self.cached_tree(name)
+
     def tempdir(self, prefix=None, suffix=None):
         """Return a tempfile.TemporaryDirectory within the store"""
         return tempfile.TemporaryDirectory(dir=self.tmp,
@@ -385,7 +893,11 @@ class ObjectStore(contextlib.AbstractContextManager):
 
         try:
             obj = Object(self.cache, object_id, Object.Mode.READ)
-            self._stack.enter_context(obj)
+            with self._lock:
+                self._stack.enter_context(obj)
+                # assembling a delta checkpoint is expensive, keep it
+                if obj.assembled:
+                    self._objs.add(obj)
             return obj
         except FsCache.MissError:
             return None
@@ -400,13 +912,14 @@ class ObjectStore(contextlib.AbstractContextManager):
         assert self.active
 
         obj = Object(self.cache, object_id, Object.Mode.WRITE)
-        self._stack.enter_context(obj)
-
-        self._objs.add(obj)
+        obj.track_changes = self.delta
+        with self._lock:
+            self._stack.enter_context(obj)
+            self._objs.add(obj)
 
         return obj
 
-    def commit(self, obj: Object, object_id: str):
+    def commit(self, obj: Object, object_id: str, *, move: bool = False):
         """Commits the Object to the object cache as `object_id`.
 
         Attempts to store the contents of `obj` and its metadata
@@ -415,6 +928,15 @@ class ObjectStore(contextlib.AbstractContextManager):
         and how much free space is left or can be made available.
         Therefore the caller should not assume that the stored
         object can be retrived at all.
+
+        If `move` is `True`, the finalized `obj` is moved into the
+        cache if possible, instead of being copied. See the method
+        `Object.move_to_cache` for details.
+
+        If `delta` is enabled for the store and `obj` was committed
+        before or initialized from a checkpoint, only the changes to
+        that checkpoint are stored, unless there are `max_delta_depth`
+        delta checkpoints stacked already.
         """
 
         assert self.active
@@ -424,8 +946,43 @@ class ObjectStore(contextlib.AbstractContextManager):
         # goes through the same code path
         obj.clamp_mtime()
 
+        if self.delta and self._commit_delta(obj, object_id):
+            return
+
+        if move and obj.move_to_cache(object_id):
+            return
+
         self.cache.store_tree(object_id, obj.path + "/.")
 
+        if obj.track_changes:
+            obj.checkpoint(object_id)
+
+    def _commit_delta(self, obj: Object, object_id: str) -> bool:
+        """Internal: store the changes of `obj` to its last checkpoint"""
+        changes = obj.changes()
+        if not changes:
+            return False
+        parent, changed, removed = changes
+
+        with contextlib.ExitStack() as stack:
+            try:
+                layers = _load_layers(self.cache, stack, parent)
+            except FsCache.MissError:
+                return False
+            if len(layers) > self.max_delta_depth:
+                return False
+
+            # the parent is kept loaded, so it can not be evicted meanwhile
+            with self.cache.store(object_id) as name:
+                path = os.path.join(self.cache, name)
+                treecopy.copy_entries(obj.tree, os.path.join(path, "tree"), changed)
+                treecopy.copy_tree(os.fspath(obj.meta), os.path.join(path, "meta"))
+                with open(os.path.join(path, DELTA_INFO), "w", encoding="utf8") as f:
+                    json.dump({"parent": parent, "removed": removed}, f)
+
+        obj.checkpoint(object_id)
+        return True
+
     def cleanup(self):
         """Cleanup all created Objects that are still alive"""
         if self._host_tree:
@@ -441,6 +998,7 @@ class ObjectStore(contextlib.AbstractContextManager):
     def __enter__(self):
         assert not self.active
         self._stack.enter_context(self.cache)
+        self._stack.enter_context(self.source_cache)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -464,6 +1022,17 @@ class StoreServer(api.BaseAPI):
         self._stack.close()
         self._stack = None
 
+    def reset(self):
+        """Unmount all trees and remove all temporary directories
+
+        Releases everything that was handed out to clients so far,
+        while keeping the server itself running.
+        """
+        self._stack.close()
+        self._stack = contextlib.ExitStack()
+        self.tmproot.cleanup()
+        self.tmproot = self.store.tempdir(prefix="store-server-")
+
     def _read_tree(self, msg, sock):
         object_id = msg["object-id"]
         obj = self.store.get(object_id)
@@ -495,6 +1064,57 @@ class StoreServer(api.BaseAPI):
 
         sock.send({"path": target})
 
+    @staticmethod
+    def _cached_tree_name(msg) -> str:
+        name, key = msg["name"], msg["key"]
+        if not VALID_SOURCE_NAME.match(name) or not VALID_SOURCE_NAME.match(key):
+            raise ValueError("Invalid cached tree", name, key)
+        return f"{name}-{key}"
+
+    def _read_cached_tree_at(self, msg, sock):
+        name = self._cached_tree_name(msg)
+        target = msg["target"]
+
+        path = self.store.cached_tree(name)
+        if not path:
+            sock.send({"path": None})
+            return
+
+        try:
+            mount(path, target)
+            self._stack.callback(umount, target)
+
+        # pylint: disable=broad-except
+        except Exception as e:
+            sock.send({"error": str(e)})
+            return
+
+        sock.send({"path": target})
+
+    def _cache_tree_at(self, msg, sock):
+        name = self._cached_tree_name(msg)
+        tree = os.path.realpath(msg["tree"])
+        target = msg["target"]
+
+        # only trees that were handed out via `mkdtemp` can be moved
+        tmproot = os.path.realpath(self.tmproot.name)
+        if os.path.commonpath([tree, tmproot]) != tmproot or tree == tmproot:
+            sock.send({"error": f"{tree} is not a temporary directory of the store"})
+            return
+
+        try:
+            # if it can not be cached, the tree is mounted in place
+            path = self.store.cache_tree(name, tree) or tree
+            mount(path, target)
+            self._stack.callback(umount, target)
+
+        # pylint: disable=broad-except
+        except Exception as e:
+            sock.send({"error": str(e)})
+            return
+
+        sock.send({"path": target})
+
     def _mkdtemp(self, msg, sock):
         args = {
             "suffix": msg.get("suffix"),
@@ -507,8 +1127,7 @@ class StoreServer(api.BaseAPI):
 
     def _source(self, msg, sock):
         name = msg["name"]
-        base = self.store.store
-        path = os.path.join(base, "sources", name)
+        path = os.path.join(self.store.sources, name)
         sock.send({"path": path})
 
     def _message(self, msg, _fds, sock):
@@ -516,6 +1135,10 @@ class StoreServer(api.BaseAPI):
             self._read_tree(msg, sock)
         elif msg["method"] == "read-tree-at":
             self._read_tree_at(msg, sock)
+        elif msg["method"] == "read-cached-tree-at":
+            self._read_cached_tree_at(msg, sock)
+        elif msg["method"] == "cache-tree-at":
+            self._cache_tree_at(msg, sock)
         elif msg["method"] == "mkdtemp":
             self._mkdtemp(msg, sock)
         elif msg["method"] == "source":
@@ -572,6 +1195,55 @@ class StoreClient:
 
         return msg["path"]
 
+    def read_cached_tree_at(self, name: str, key: str, target: str) -> Optional[str]:
+        """Mount the tree cached for `key` by `name` read-only at `target`
+
+        Returns `target`, or `None` if no such tree is cached. See
+        `cache_tree_at`.
+        """
+        msg = {
+            "method": "read-cached-tree-at",
+            "name": name,
+            "key": key,
+            "target": os.fspath(target)
+        }
+
+        self.client.send(msg)
+        msg, _, _ = self.client.recv()
+
+        err = msg.get("error")
+        if err:
+            raise RuntimeError(err)
+
+        return msg["path"]
+
+    def cache_tree_at(self, name: str, key: str, tree: str, target: str) -> str:
+        """Cache `tree` for `key` by `name` and mount it read-only at `target`
+
+        Inputs and others can cache trees that are expensive to create,
+        e.g. `name` can be the name of the input and `key` the checksum
+        of the content. The `tree` must be created within a directory
+        obtained via `mkdtemp`; it is moved into the cache and must not
+        be used afterwards. If it can not be cached, it is mounted as
+        is. Returns `target`.
+        """
+        msg = {
+            "method": "cache-tree-at",
+            "name": name,
+            "key": key,
+            "tree": os.fspath(tree),
+            "target": os.fspath(target)
+        }
+
+        self.client.send(msg)
+        msg, _, _ = self.client.recv()
+
+        err = msg.get("error")
+        if err:
+            raise RuntimeError(err)
+
+        return msg["path"]
+
     def source(self, name: str) -> str:
         msg = {
             "method": "source",
@@ -582,3 +1254,94 @@ class StoreClient:
         msg, _, _ = self.client.recv()
 
         return msg["path"]
+
+
+class VerifiedIndexServer(api.BaseAPI):
+    """Index of the items of sources that were verified already
+
+    Stages can record items of sources, e.g. packages, whose
+    signatures they checked, and skip the check for them in later
+    builds. Unlike `StoreServer`, this endpoint is bound into the
+    build root of stages, therefore it only gives access to the index
+    and never to any tree; since entries can be added, it is only
+    available to the stages that opted in to use it, see
+    `pipeline.VERIFIED_INDEX_STAGES`. The entries are kept in
+    `sources/<source>.verified/<key>/<checksum>` of the store.
+    """
+
+    endpoint = "verified-index"
+
+    def __init__(self, store: ObjectStore, *, socket_address=None):
+        super().__init__(socket_address)
+        self.store = store
+
+    def _index(self, msg):
+        name, key = msg["name"], msg["key"]
+        if not VALID_SOURCE_NAME.match(name) or not re.fullmatch(r"[0-9a-f]{64}", key):
+            raise ValueError("Invalid index", name, key)
+
+        checksums = [c for c in msg["checksums"] if VALID_CHECKSUM.match(c)]
+        index = os.path.join(self.store.sources, f"{name}.verified", key)
+        return index, checksums
+
+    def _verified(self, msg, sock):
+        index, checksums = self._index(msg)
+        have = [c for c in checksums if os.path.exists(os.path.join(index, c))]
+        sock.send({"checksums": have})
+
+    def _mark_verified(self, msg, sock):
+        index, checksums = self._index(msg)
+        os.makedirs(index, exist_ok=True)
+        for checksum in checksums:
+            with open(os.path.join(index, checksum), "wb"):
+                pass
+        sock.send({"checksums": checksums})
+
+    def _message(self, msg, _fds, sock):
+        if msg["method"] == "verified":
+            self._verified(msg, sock)
+        elif msg["method"] == "mark-verified":
+            self._mark_verified(msg, sock)
+        else:
+            raise ValueError("Invalid RPC call", msg)
+
+
+class VerifiedIndexClient:
+    def __init__(self, connect_to="/run/osbuild/api/verified-index"):
+        self.client = jsoncomm.Socket.new_client(connect_to)
+
+    def __del__(self):
+        if self.client is not None:
+            self.client.close()
+
+    def verified(self, name: str, key: str, checksums: List[str]) -> List[str]:
+        """Return the `checksums` of the source `name` verified with `key`
+
+        Sources can have an index of items that were verified already,
+        e.g. by checking their signatures; `key` identifies what they
+        were verified with, like the fingerprint of a keyring. Items
+        are identified via their checksum. See `mark_verified`.
+        """
+        msg = {
+            "method": "verified",
+            "name": name,
+            "key": key,
+            "checksums": checksums
+        }
+
+        self.client.send(msg)
+        msg, _, _ = self.client.recv()
+
+        return msg["checksums"]
+
+    def mark_verified(self, name: str, key: str, checksums: List[str]):
+        """Record the `checksums` of the source `name` as verified with `key`"""
+        msg = {
+            "method": "mark-verified",
+            "name": name,
+            "key": key,
+            "checksums": checksums
+        }
+
+        self.client.send(msg)
+        self.client.recv()
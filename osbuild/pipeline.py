@@ -1,19 +1,29 @@
 import collections
+import concurrent.futures
 import contextlib
 import hashlib
+import itertools
 import json
 import os
+import threading
+import time
 from fnmatch import fnmatch
-from typing import Dict, Generator, Iterable, Iterator, List, Optional
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Set
 
 from . import buildroot, host, objectstore, remoteloop
 from .api import API
 from .devices import Device, DeviceManager
 from .inputs import Input, InputManager
 from .mounts import Mount, MountManager
-from .objectstore import ObjectStore
-from .sources import Source
-from .util import osrelease
+from .objectstore import Object, ObjectStore
+from .sources import MAX_WORKERS, JobServer, Source
+from .util import compress, osrelease
+
+# Stages that may record the items of sources they verified, if the
+# given option is set, see `objectstore.VerifiedIndexServer`
+VERIFIED_INDEX_STAGES = {
+    "org.osbuild.rpm": "checksig_index",
+}
 
 DEFAULT_CAPABILITIES = {
     "CAP_AUDIT_WRITE",
@@ -44,17 +54,19 @@ def cleanup(*objs):
 
 
 class BuildResult:
-    def __init__(self, origin, returncode, output, error):
+    def __init__(self, origin, returncode, output, error, usage=None):
         self.name = origin.name
         self.id = origin.id
         self.success = returncode == 0
         self.output = output
         self.error = error
+        self.usage = usage
 
     def as_dict(self):
         return vars(self)
 
 
+# pylint: disable=too-many-instance-attributes
 class Stage:
     def __init__(self, info, source_options, build, base, options, source_epoch):
         self.info = info
@@ -67,18 +79,53 @@ class Stage:
         self.inputs = {}
         self.devices = {}
         self.mounts = {}
+        self._id = None
+        self._id_key = None
 
     @property
     def name(self):
         return self.info.name
 
+    @property
+    def options(self):
+        """The options of the stage
+
+        NB: The serialized options are cached for the `id`, thus
+        they must be replaced, not modified in place.
+        """
+        return self._options
+
+    @options.setter
+    def options(self, value):
+        self._options = value
+        self._options_json = None
+        self._id = None
+
     @property
     def id(self):
+        # The id is only re-calculated if any of its parts changed;
+        # inputs and mounts keep their own ids up to date
+        key = (
+            self.build,
+            self.base,
+            self.source_epoch,
+            tuple((n, i.id) for n, i in self.inputs.items()),
+            tuple(m.id for m in self.mounts.values()),
+        )
+        if self._id is None or key != self._id_key:
+            self._id = self.calc_id()
+            self._id_key = key
+        return self._id
+
+    def calc_id(self):
+        if self._options_json is None:
+            self._options_json = json.dumps(self.options, sort_keys=True).encode()
+
         m = hashlib.sha256()
         m.update(json.dumps(self.name, sort_keys=True).encode())
         m.update(json.dumps(self.build, sort_keys=True).encode())
         m.update(json.dumps(self.base, sort_keys=True).encode())
-        m.update(json.dumps(self.options, sort_keys=True).encode())
+        m.update(self._options_json)
         if self.source_epoch is not None:
             m.update(json.dumps(self.source_epoch, sort_keys=True).encode())
         if self.inputs:
@@ -142,11 +189,18 @@ class Stage:
         with open(location, "w", encoding="utf-8") as fp:
             json.dump(args, fp)
 
-    def run(self, tree, runner, build_tree, store, monitor, libdir, timeout=None):
+    def run(self, tree, runner, build_tree, store, monitor, libdir, timeout=None, *,
+            shared=None, service_pool=None, cpu_budget=None):
         with contextlib.ExitStack() as cm:
 
-            build_root = buildroot.BuildRoot(build_tree, runner.path, libdir, store.tmp)
-            cm.enter_context(build_root)
+            # Unless a build root is shared between stages, set up
+            # a new one that is only used for this stage
+            if not shared:
+                shared = SharedBuildRoot(build_tree, runner, store, monitor, libdir,
+                                         service_pool=service_pool)
+                cm.enter_context(shared)
+
+            build_root = shared.build_root
 
             # if we have a build root, then also bind-mount the boot
             # directory from it, since it may contain efi binaries
@@ -158,6 +212,10 @@ class Stage:
             tmpdir = store.tempdir(prefix="buildroot-tmp-")
             tmpdir = cm.enter_context(tmpdir)
 
+            # release everything that was set up for this stage,
+            # like mounts into `tmpdir`, before removing the latter
+            cm.callback(shared.reset)
+
             inputs_tmpdir = os.path.join(tmpdir, "inputs")
             os.makedirs(inputs_tmpdir)
             inputs_mapped = "/run/osbuild/inputs"
@@ -202,13 +260,9 @@ class Stage:
                 f"{mounts_tmpdir}:{mounts_mapped}"
             ]
 
-            storeapi = objectstore.StoreServer(store)
-            cm.enter_context(storeapi)
-
-            mgr = host.ServiceManager(monitor=monitor)
-            cm.enter_context(mgr)
+            mgr = shared.service_manager
 
-            ipmgr = InputManager(mgr, storeapi, inputs_tmpdir)
+            ipmgr = InputManager(mgr, shared.storeapi, inputs_tmpdir)
             for key, ip in self.inputs.items():
                 data = ipmgr.map(ip, store)
                 inputs[key] = data
@@ -224,15 +278,22 @@ class Stage:
 
             self.prepare_arguments(args, args_path)
 
-            api = API()
-            build_root.register_api(api)
+            # the main API carries the error of this very stage,
+            # thus it is never shared with other stages
+            api = cm.enter_context(build_root.temporary_api(API()))
 
-            rls = remoteloop.LoopServer()
-            build_root.register_api(rls)
+            # the index of verified items can be written to, so only
+            # stages that use it get access to it
+            option = VERIFIED_INDEX_STAGES.get(self.name)
+            if option and self.options.get(option):
+                index = objectstore.VerifiedIndexServer(store)
+                cm.enter_context(build_root.temporary_api(index))
 
             extra_env = {}
             if self.source_epoch is not None:
                 extra_env["SOURCE_DATE_EPOCH"] = str(self.source_epoch)
+            if cpu_budget is not None:
+                extra_env[compress.CPU_BUDGET_ENV] = str(cpu_budget)
 
             r = build_root.run([f"/run/osbuild/bin/{self.name}"],
                                monitor,
@@ -241,7 +302,54 @@ class Stage:
                                readonly_binds=ro_binds,
                                extra_env=extra_env)
 
-        return BuildResult(self, r.returncode, r.output, api.error)
+        return BuildResult(self, r.returncode, r.output, api.error, r.usage)
+
+
+class SharedBuildRoot(contextlib.AbstractContextManager):
+    """A build root and its API endpoints, shared between stages
+
+    Bundles the `BuildRoot` that stages are run in together with the
+    API endpoints that do not carry any per-stage state: the store
+    API, the loopback API and the host `ServiceManager`. Setting
+    all of this up for every single stage is expensive, therefore
+    consecutive stages that use the same build tree can be run in
+    one instance of this. Everything a stage acquired is released
+    via `reset` so that the next stage starts from a clean state.
+    Host services are forked from the templates of `service_pool`,
+    if given.
+    """
+
+    def __init__(self, build_tree, runner, store, monitor, libdir, *, service_pool=None):
+        self.build_root = buildroot.BuildRoot(build_tree, runner.path, libdir, store.tmp)
+        self.storeapi = objectstore.StoreServer(store)
+        self.service_manager = host.ServiceManager(monitor=monitor, pool=service_pool)
+        self.loop_server = remoteloop.LoopServer()
+        self._stack = None
+
+    def __enter__(self):
+        with contextlib.ExitStack() as cm:
+            cm.enter_context(self.build_root)
+            cm.enter_context(self.storeapi)
+            cm.enter_context(self.service_manager)
+            self.build_root.register_api(self.loop_server)
+            self._stack = cm.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._stack.close()
+        self._stack = None
+
+    def reset(self):
+        """Release all resources acquired by the last stage
+
+        Loopback devices are released, host services, i.e. inputs,
+        devices and mounts, are stopped in reverse order, trees of
+        the store are unmounted and the build root is reset.
+        """
+        self.loop_server.reset()
+        self.service_manager.stop_all()
+        self.storeapi.reset()
+        self.build_root.reset()
 
 
 class Runner:
@@ -258,6 +366,68 @@ class Runner:
         return os.path.basename(self.info.path)
 
 
+class CheckpointPolicy:
+    """Policy to automatically checkpoint stages
+
+    Decides after a stage has been built if its tree should be committed
+    to the store, so that a later build can resume from it. A tree is
+    worth committing if it is expensive to rebuild but cheap to store:
+    the cost to rebuild it is the time spent building the stages since
+    the last checkpoint, the cost to store it is its size, which also
+    determines how long it takes to restore it. Trees are thus only
+    committed if rebuilding them takes at least `min_time` seconds and
+    longer than restoring them at `throughput` bytes per second.
+
+    In total, automatic checkpoints never take up more than the fraction
+    `budget` of the maximum size of the cache; if the cache does not have
+    a maximum size, no checkpoints are committed at all.
+    """
+
+    def __init__(self, *, min_time: float = 10, throughput: int = 100 * 1024 * 1024, budget: float = 0.5):
+        self.min_time = min_time
+        self.throughput = throughput
+        self.budget = budget
+        self.used = 0
+        self._sizes: Dict[Optional[str], int] = {}
+        self._lock = threading.Lock()
+
+    def check(self, store: ObjectStore, tree: Object, elapsed: float) -> bool:
+        """Check if `tree` should be committed
+
+        The `elapsed` time is the time spent building `tree` since it
+        was last committed. If `True` is returned, the size of `tree`
+        is accounted against the budget.
+        """
+        if elapsed < self.min_time:
+            return False
+
+        maximum = store.maximum_size
+        if not maximum:
+            return False
+
+        # The size of a tree rarely shrinks; thus the last known size
+        # is used to avoid scanning trees that are not worth it anyway
+        with self._lock:
+            known = self._sizes.get(tree.id, 0)
+        if elapsed * self.throughput < known:
+            return False
+
+        size = store.tree_size(tree)
+
+        with self._lock:
+            self._sizes[tree.id] = size
+
+            if elapsed * self.throughput < size:
+                return False
+
+            if isinstance(maximum, int) and self.used + size > maximum * self.budget:
+                return False
+
+            self.used += size
+
+        return True
+
+
 class Pipeline:
     def __init__(self, name: str, runner: Runner, build=None, source_epoch=None):
         self.name = name
@@ -290,7 +460,9 @@ class Pipeline:
             self.assembler.base = stage.id
         return stage
 
-    def build_stages(self, object_store, monitor, libdir, stage_timeout=None):
+    # pylint: disable=too-many-branches
+    def build_stages(self, object_store, monitor, libdir, stage_timeout=None, *,
+                     reuse_buildroot=False, checkpoints=None, service_pool=None, cpu_budget=None):
         results = {"success": True}
 
         # If there are no stages, just return here
@@ -323,10 +495,11 @@ class Pipeline:
         tree.source_epoch = self.source_epoch
 
         todo = collections.deque()
+        present = object_store.contains_many(stage.id for stage in self.stages)
         for stage in reversed(self.stages):
-            base = object_store.get(stage.id)
+            base = object_store.get(stage.id) if stage.id in present else None
             if base:
-                tree.init(base)
+                tree.init(base, overlay=object_store.overlay)
                 break
             todo.append(stage)  # append right side of the deque
 
@@ -337,42 +510,76 @@ class Pipeline:
         # trees will be based on the winner.
         results["stages"] = []
 
-        while todo:
-            stage = todo.pop()
-
-            monitor.stage(stage)
-
-            r = stage.run(tree,
-                          self.runner,
-                          build_tree,
-                          object_store,
-                          monitor,
-                          libdir,
-                          stage_timeout)
-
-            monitor.result(r)
+        with contextlib.ExitStack() as cm:
 
-            results["stages"].append(r)
-            if not r.success:
-                cleanup(build_tree, tree)
-                results["success"] = False
-                return results
+            # All stages share the same build tree, and can thus
+            # share the build root, if requested
+            shared = None
+            if reuse_buildroot and todo:
+                shared = SharedBuildRoot(build_tree, self.runner, object_store, monitor, libdir,
+                                         service_pool=service_pool)
+                cm.enter_context(shared)
+
+            # the time it took to build the tree since it was last
+            # committed, for automatic checkpoints
+            since = time.monotonic()
+
+            while todo:
+                stage = todo.pop()
+
+                monitor.stage(stage)
+
+                r = stage.run(tree,
+                              self.runner,
+                              build_tree,
+                              object_store,
+                              monitor,
+                              libdir,
+                              stage_timeout,
+                              shared=shared,
+                              service_pool=service_pool,
+                              cpu_budget=cpu_budget)
+
+                monitor.result(r)
+
+                results["stages"].append(r)
+                if not r.success:
+                    cleanup(build_tree, tree)
+                    results["success"] = False
+                    return results
+
+                # the tree of the last stage is committed below
+                if not todo:
+                    break
 
-            if stage.checkpoint:
-                object_store.commit(tree, stage.id)
+                elapsed = time.monotonic() - since
+                if stage.checkpoint or (checkpoints and checkpoints.check(object_store, tree, elapsed)):
+                    object_store.commit(tree, stage.id)
+                    since = time.monotonic()
 
+        elapsed = time.monotonic() - since
         tree.finalize()
 
+        # The finalized tree will not be modified anymore, so it
+        # can be moved into the store instead of being copied
+        if self.stages[-1].checkpoint or (checkpoints and checkpoints.check(object_store, tree, elapsed)):
+            object_store.commit(tree, self.id, move=True)
+
         return results
 
-    def run(self, store, monitor, libdir, stage_timeout=None):
+    def run(self, store, monitor, libdir, stage_timeout=None, *,
+            reuse_buildroot=False, checkpoints=None, service_pool=None, cpu_budget=None):
 
         monitor.begin(self)
 
         results = self.build_stages(store,
                                     monitor,
                                     libdir,
-                                    stage_timeout)
+                                    stage_timeout,
+                                    reuse_buildroot=reuse_buildroot,
+                                    checkpoints=checkpoints,
+                                    service_pool=service_pool,
+                                    cpu_budget=cpu_budget)
 
         monitor.finish(results)
 
@@ -385,6 +592,9 @@ class Manifest:
     def __init__(self):
         self.pipelines = collections.OrderedDict()
         self.sources = []
+        # pipeline ids to pipelines, re-built on a miss since
+        # the ids change when stages are added
+        self._ids: Dict[str, Pipeline] = {}
 
     def add_pipeline(
         self,
@@ -404,10 +614,32 @@ class Manifest:
         self.sources.append(source)
         return source
 
-    def download(self, store, monitor, libdir):
-        with host.ServiceManager(monitor=monitor) as mgr:
-            for source in self.sources:
-                source.download(mgr, store, libdir)
+    def download(self, store, monitor, libdir, *, workers=None, service_pool=None):
+        """Download the items of all sources
+
+        All sources are downloaded concurrently, but at most `workers`
+        items in total at any given time, see `JobServer`.
+        """
+        # record the items as used, before they are downloaded, so that
+        # they are not collected as garbage, see `SourceCache`
+        store.source_cache.add_ref(c for source in self.sources for c in source.items)
+
+        workers = workers or MAX_WORKERS
+        with JobServer.new(workers) as jobs, \
+                host.ServiceManager(monitor=monitor, pool=service_pool) as mgr, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.sources), 1)) as executor:
+            def download(source):
+                monitor.source(source)
+                success = False
+                try:
+                    source.download(mgr, store, libdir, jobs)
+                    success = True
+                finally:
+                    monitor.source_result(source, success)
+
+            futures = [executor.submit(download, source) for source in self.sources]
+            for future in futures:
+                future.result()
 
     def depsolve(self, store: ObjectStore, targets: Iterable[str]) -> List[str]:
         """Return the list of pipelines that need to be built
@@ -420,6 +652,11 @@ class Manifest:
         # A stack of pipelines to check if they need to be built
         check = list(map(self.get, targets))
 
+        # Look up all pipelines and stages in the store at once
+        present = store.contains_many(
+            itertools.chain.from_iterable([pl.id] + [s.id for s in pl.stages] for pl in self.pipelines.values())
+        )
+
         # The ordered result "set", will be reversed at the end
         build = collections.OrderedDict()
 
@@ -429,7 +666,7 @@ class Manifest:
             if not pl:
                 raise RuntimeError("Could not find pipeline.")
 
-            if store.contains(pl.id):
+            if pl.id in present:
                 continue
 
             # The store does not have this pipeline, it needs to
@@ -453,7 +690,7 @@ class Manifest:
 
                 # we stop if we have a checkpoint, i.e. we don't
                 # need to build any stages after that checkpoint
-                if store.contains(stage.id):
+                if stage.id in present:
                     break
 
                 pls = map(self.get, stage.dependencies)
@@ -461,11 +698,66 @@ class Manifest:
 
         return list(map(lambda x: x.name, reversed(build.values())))
 
-    def build(self, store, pipelines, monitor, libdir, stage_timeout=None):
+    def dependencies(self, pipelines: Iterable[str]) -> Dict[str, Set[str]]:
+        """Return the dependency graph between `pipelines`
+
+        Map the name of each of the given pipelines to the names of
+        the pipelines it depends on, either as its build pipeline or
+        via pipeline inputs of its stages. Only dependencies that are
+        themselves part of `pipelines` are included; all others are
+        assumed to be available in the store already, which is what
+        `depsolve` guarantees for its result.
+        """
+        pls = list(map(self.__getitem__, pipelines))
+        provides = {pl.id: pl.name for pl in pls}
+
+        graph = collections.OrderedDict()
+        for pl in pls:
+            refs = set(itertools.chain.from_iterable(
+                stage.dependencies for stage in pl.stages
+            ))
+            if pl.build:
+                refs.add(pl.build)
+
+            graph[pl.name] = {
+                provides[ref] for ref in refs
+                if ref in provides and provides[ref] != pl.name
+            }
+
+        return graph
+
+    def build(self, store, pipelines, monitor, libdir, stage_timeout=None, *,
+              jobs=1, reuse_buildroot=False, checkpoints=None, service_pool=None, cpu_budget=None):
+        """Build the given pipelines
+
+        The `pipelines` must be ordered such that all dependencies
+        of a pipeline come before it, as returned by `depsolve`. If
+        `jobs` is bigger than one, independent pipelines are built
+        concurrently, in separate build roots, with at most `jobs`
+        pipelines being built at the same time. With `reuse_buildroot`
+        all stages of a pipeline share one build root, see the
+        `SharedBuildRoot` class. Stages are committed to the store,
+        in addition to the marked checkpoints, if the `CheckpointPolicy`
+        passed as `checkpoints` deems them worth it. Host services are
+        forked from the templates of `service_pool`, if given, which can
+        thus be shared by all stages and pipelines. The number of CPUs
+        each stage may use for multithreaded work, like compression, can
+        be limited via `cpu_budget`; it does not change the result.
+        """
+        options = {
+            "reuse_buildroot": reuse_buildroot,
+            "checkpoints": checkpoints,
+            "service_pool": service_pool,
+            "cpu_budget": cpu_budget,
+        }
+
+        if jobs > 1:
+            return self._build_parallel(store, pipelines, monitor, libdir, stage_timeout, jobs, options)
+
         results = {"success": True}
 
         for pl in map(self.get, pipelines):
-            res = pl.run(store, monitor, libdir, stage_timeout)
+            res = pl.run(store, monitor, libdir, stage_timeout, **options)
             results[pl.id] = res
             if not res["success"]:
                 results["success"] = False
@@ -473,6 +765,59 @@ class Manifest:
 
         return results
 
+    def _build_parallel(self, store, pipelines, monitor, libdir, stage_timeout, jobs, options):
+        """Internal: schedule the pipelines according to their dependencies"""
+        results = {"success": True}
+        failed = []
+
+        # pipeline names mapped to the ones they are still waiting for
+        pending = self.dependencies(pipelines)
+        running: Dict[concurrent.futures.Future, Pipeline] = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+
+                # Once a pipeline failed we do not start new ones,
+                # but still wait for the running ones to finish
+                ready = [] if failed else [
+                    name for name, deps in pending.items() if not deps
+                ]
+
+                for name in ready[:jobs - len(running)]:
+                    del pending[name]
+                    pl = self[name]
+                    f = executor.submit(pl.run, store, monitor, libdir, stage_timeout, **options)
+                    running[f] = pl
+
+                if not running:
+                    if not failed:
+                        raise RuntimeError("Cycle detected in pipeline dependencies")
+                    break
+
+                done, _ = concurrent.futures.wait(running,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for f in done:
+                    pl = running.pop(f)
+                    res = f.result()
+
+                    if not res["success"]:
+                        failed.append((pl, res))
+                        continue
+
+                    results[pl.id] = res
+                    for deps in pending.values():
+                        deps.discard(pl.name)
+
+        # The result of the first failed pipeline must be the last
+        # entry of the results, which is where the output formats
+        # expect the failure to be.
+        for pl, res in reversed(failed):
+            results[pl.id] = res
+            results["success"] = False
+
+        return results
+
     def mark_checkpoints(self, patterns):
         """Match pipeline names, stage ids, and stage names against an iterable
         of `fnmatch`-patterns."""
@@ -502,10 +847,18 @@ class Manifest:
         pl = self.pipelines.get(name_or_id)
         if pl:
             return pl
+
+        pl = self._ids.get(name_or_id)
+        if pl and pl.id == name_or_id:
+            return pl
+
+        # The first pipeline with the id wins, like for a linear search
+        self._ids = {}
         for pl in self.pipelines.values():
-            if pl.id == name_or_id:
-                return pl
-        return None
+            if pl.id is not None:
+                self._ids.setdefault(pl.id, pl)
+
+        return self._ids.get(name_or_id)
 
     def __contains__(self, name_or_id: str) -> bool:
         return self.get(name_or_id) is not None
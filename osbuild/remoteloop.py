@@ -77,9 +77,14 @@ class LoopServer(api.BaseAPI):
         devname = self._create_device(fd, dir_fd, offset, sizelimit)
         sock.send({"devname": devname})
 
-    def _cleanup(self):
+    def reset(self):
+        """Release all loopback devices created so far"""
         for lo in self.devs:
             lo.close()
+        self.devs = []
+
+    def _cleanup(self):
+        self.reset()
         self.ctl.close()
 
 
@@ -1,15 +1,138 @@
 import abc
 import concurrent.futures
 import contextlib
+import fcntl
+import hashlib
 import json
 import os
+import shutil
 import tempfile
-from typing import ClassVar, Dict, Tuple
+import threading
+from typing import ClassVar, Dict, List, Optional, Set, Tuple
 
 from . import host
 from .objectstore import ObjectStore
 from .util.types import PathLike
 
+# Default for the number of items that are downloaded concurrently,
+# across all sources
+MAX_WORKERS = 2 * (os.cpu_count() or 1)
+
+
+class JobServer(contextlib.AbstractContextManager):
+    """Limit the number of concurrent jobs across processes
+
+    Like the jobserver of make(1): a pipe is filled with one token per
+    job that may run at the same time. A job takes a token out of the
+    pipe before it starts and puts it back when it is done. The `fds`
+    of the pipe can be passed to other processes, e.g. host services,
+    which then share the same budget.
+    """
+
+    def __init__(self, rfd: int, wfd: int):
+        self.rfd = rfd
+        self.wfd = wfd
+
+    @classmethod
+    def new(cls, jobs: int) -> "JobServer":
+        """Create a new job server that allows for `jobs` concurrent jobs"""
+        rfd, wfd = os.pipe()
+        os.write(wfd, b"+" * max(jobs, 1))
+        return cls(rfd, wfd)
+
+    @property
+    def fds(self):
+        return [self.rfd, self.wfd]
+
+    @contextlib.contextmanager
+    def job(self):
+        """Run a job, i.e. wait for a token and return it when done"""
+        token = os.read(self.rfd, 1)
+        try:
+            yield
+        finally:
+            os.write(self.wfd, token)
+
+    def close(self):
+        for fd in self.fds:
+            if fd >= 0:
+                os.close(fd)
+        self.rfd = self.wfd = -1
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+class Journal(contextlib.AbstractContextManager):
+    """Record the items of a download that have been completed
+
+    The journal for a set of `items` is kept in `cache`, along with a
+    directory, `tmpdir`, for the partial transfers of these items. Both
+    are kept if the download fails or is interrupted and removed once
+    it completes. A later download of the same items can thus skip the
+    ones in `done` and resume the partial transfers.
+
+    The journal is locked while it is open. If another download of
+    the same items holds the lock, it is not used, i.e. `done` stays
+    empty and a private `tmpdir` is used.
+    """
+
+    def __init__(self, cache: PathLike, name: str, items: Dict):
+        data = json.dumps([name, items], sort_keys=True)
+        key = hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+        self.cache = os.fspath(cache)
+        self.path = os.path.join(self.cache, f".journal-{key}")
+        self.tmpdir = os.path.join(self.cache, f".unverified-{key}")
+        self.done: Set[str] = set()
+        self._fd = -1
+
+    def open(self):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # the journal might have been removed by the previous
+                # owner of the lock, after we opened it
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    break
+            except (BlockingIOError, FileNotFoundError):
+                os.close(fd)
+                fd = -1
+                break
+            os.close(fd)
+
+        if fd < 0:
+            self.tmpdir = tempfile.mkdtemp(prefix=".unverified-", dir=self.cache)
+            return self
+
+        self._fd = fd
+        with open(fd, "r", encoding="utf-8", closefd=False) as f:
+            # only complete lines have been recorded
+            self.done = {l[:-1] for l in f if l.endswith("\n")}
+        os.makedirs(self.tmpdir, exist_ok=True)
+        return self
+
+    def record(self, checksum: str):
+        """Record the item `checksum` as completed"""
+        if self._fd >= 0:
+            os.write(self._fd, f"{checksum}\n".encode("utf-8"))
+
+    def close(self, *, completed=False):
+        """Close the journal, remove it if the download `completed`"""
+        if completed or self._fd < 0:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        if self._fd >= 0:
+            if completed:
+                os.unlink(self.path)
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close(completed=exc_type is None)
+
 
 class Source:
     """
@@ -21,13 +144,15 @@ class Source:
         self.items = items or {}
         self.options = options
 
-    def download(self, mgr: host.ServiceManager, store: ObjectStore, libdir: PathLike):
+    def download(self, mgr: host.ServiceManager, store: ObjectStore, libdir: PathLike,
+                 jobs: Optional[JobServer] = None):
         source = self.info.name
-        cache = os.path.join(store.store, "sources")
+        cache = store.sources
 
         args = {
             "options": self.options,
             "cache": cache,
+            "extra-caches": list(store.extra_sources),
             "output": None,
             "checksums": [],
             "libdir": os.fspath(libdir)
@@ -37,6 +162,8 @@ class Source:
 
         with self.make_items_file(store.tmp) as fd:
             fds = [fd]
+            if jobs:
+                fds += jobs.fds
             reply = client.call_with_fds("download", args, fds)
 
         return reply
@@ -54,14 +181,22 @@ class SourceService(host.Service):
 
     max_workers = 1
 
+    max_per_host = 6
+    """How many items are downloaded from the same host concurrently"""
+
     content_type: ClassVar[str]
     """The content type of the source."""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.cache = None
+        self.extra_caches: List[str] = []
         self.options = None
         self.tmpdir = None
+        self.jobs: Optional[JobServer] = None
+        self.journal: Optional[Journal] = None
+        self._hosts: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
 
     @abc.abstractmethod
     def fetch_one(self, checksum, desc) -> None:
@@ -76,12 +211,46 @@ class SourceService(host.Service):
         """Modify the input data before downloading. By default only transforms an item object to a Tupple."""
         return checksum, desc
 
+    # pylint: disable=[no-self-use]
+    def origin(self, _checksum, _desc) -> Optional[str]:
+        """Return the host a (transformed) item is downloaded from, if any"""
+        return None
+
+    def _host_limit(self, name: Optional[str]):
+        if not name:
+            # a no-op context, `contextlib.nullcontext` needs Python 3.7
+            return contextlib.ExitStack()
+        with self._lock:
+            sem = self._hosts.get(name)
+            if not sem:
+                sem = self._hosts[name] = threading.Semaphore(self.max_per_host)
+        return sem
+
+    def _job(self):
+        """A slot of the job server, if there is one, for a download"""
+        if not self.jobs:
+            return contextlib.ExitStack()
+        return self.jobs.job()
+
+    def _fetch(self, checksum, desc):
+        with self._host_limit(self.origin(checksum, desc)):
+            with self._job():
+                self.fetch_one(checksum, desc)
+        if self.journal:
+            self.journal.record(checksum)
+
+    def pending(self, items: Dict) -> List[Tuple]:
+        """Return the transformed items that need to be downloaded"""
+        done = self.journal.done if self.journal else set()
+        # discards items already in cache, or downloaded by a previous, interrupted run
+        filtered = filter(lambda i: i[0] not in done and not self.exists(i[0], i[1]), items.items())
+        return [self.transform(checksum, desc) for checksum, desc in filtered]  # prepare each item to be downloaded
+
     def download(self, items: Dict) -> None:
-        filtered = filter(lambda i: not self.exists(i[0], i[1]), items.items())  # discards items already in cache
-        transformed = map(lambda i: self.transform(i[0], i[1]), filtered)  # prepare each item to be downloaded
+        transformed = self.pending(items)
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            for _ in executor.map(self.fetch_one, *zip(*transformed)):
+            for _ in executor.map(self._fetch, *zip(*transformed)):
                 pass
 
     @staticmethod
@@ -93,13 +262,20 @@ class SourceService(host.Service):
     def setup(self, args):
         self.cache = os.path.join(args["cache"], self.content_type)
         os.makedirs(self.cache, exist_ok=True)
+        # source caches of other stores, that might have the content already
+        self.extra_caches = [os.path.join(c, self.content_type) for c in args.get("extra-caches", [])]
         self.options = args["options"]
 
     def dispatch(self, method: str, args, fds):
         if method == "download":
             self.setup(args)
-            with tempfile.TemporaryDirectory(prefix=".unverified-", dir=self.cache) as self.tmpdir:
-                self.download(SourceService.load_items(fds))
-                return None, None
+            items = SourceService.load_items(fds)
+            with contextlib.ExitStack() as stack:
+                if len(fds) > 2:
+                    self.jobs = stack.enter_context(JobServer(fds.steal(1), fds.steal(2)))
+                self.journal = stack.enter_context(Journal(self.cache, type(self).__name__, items))
+                self.tmpdir = self.journal.tmpdir
+                self.download(items)
+            return None, None
 
         raise host.ProtocolError("Unknown method")
@@ -4,6 +4,7 @@ Small convenience functions to work with checksums.
 """
 import hashlib
 import os
+from typing import BinaryIO
 
 from .types import PathLike
 
@@ -47,3 +48,37 @@ def verify_file(path: PathLike, checksum: str) -> bool:
     have = hexdigest_file(path, algorithm)
 
     return have == want
+
+
+class HashingWriter:
+    """Write to a file and hash the written data at the same time
+
+    All data written via `write` is passed on to the file object `f`
+    and fed to a hash using `algorithm`. Thus the checksum of data
+    that is received incrementally, e.g. via the network, can be
+    verified once it has been written, without reading it again.
+    If the specified `algorithm` is not supported a `ValueError`
+    will be raised.
+    """
+
+    def __init__(self, f: BinaryIO, algorithm: str):
+        self.file = f
+        self.algorithm = algorithm
+        self.hasher = hashlib.new(algorithm)
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self) -> str:
+        """Return the hexdigest of all data written so far"""
+        return self.hasher.hexdigest()
+
+    def verify(self, checksum: str) -> bool:
+        """Return if the specified `checksum` matches the written data
+
+        Like `verify_file`, where `checksum` consists of the algorithm
+        and the digest joined via `:`, e.g. `sha256:abcd...`.
+        """
+        algorithm, want = checksum.split(":", 1)
+        return algorithm == self.algorithm and self.hexdigest() == want
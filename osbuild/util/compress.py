@@ -0,0 +1,107 @@
+"""Compression
+
+Compress files with the multithreaded implementations of the common
+compression programs, using as many threads as the CPU budget of the
+stage allows. The compressed data only depends on the format, the
+level and the programs available in the build root, but not on the
+number of threads, so that the result is reproducible.
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+from typing import List, Optional
+
+from .types import PathLike
+
+__all__ = [
+    "FORMATS",
+    "command",
+    "compress",
+    "cpu_budget",
+    "format_for",
+    "tar_argument",
+]
+
+
+# Environment variable via which osbuild passes the number of CPUs
+# a stage may use, see `cpu_budget`
+CPU_BUDGET_ENV = "OSBUILD_CPU_BUDGET"
+
+FORMATS = ("gzip", "xz", "zstd")
+
+# File name suffixes of compressed (tar) files
+SUFFIXES = {
+    ".gz": "gzip",
+    ".tgz": "gzip",
+    ".xz": "xz",
+    ".txz": "xz",
+    ".zst": "zstd",
+    ".tzst": "zstd",
+}
+
+
+def cpu_budget() -> int:
+    """Return the number of threads to compress with
+
+    This is the number of CPUs the process may run on, limited by the
+    budget given via the `OSBUILD_CPU_BUDGET` environment variable.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    budget = os.getenv(CPU_BUDGET_ENV)
+    if budget:
+        cpus = min(cpus, int(budget))
+    return max(cpus, 1)
+
+
+def format_for(filename: str) -> Optional[str]:
+    """Return the compression format indicated by the suffix of `filename`"""
+    _, suffix = os.path.splitext(filename)
+    return SUFFIXES.get(suffix)
+
+
+def command(fmt: str, level: Optional[int] = None, threads: Optional[int] = None) -> List[str]:
+    """Return the command to compress standard input to standard output
+
+    The data is compressed as `fmt`, one of `FORMATS`, with `level`, or
+    the default level of the program if `None`, by up to `threads`
+    threads, by default as many as `cpu_budget` returns.
+
+    For gzip, `pigz` is used if it is available in the build root,
+    otherwise `gzip`, which is single-threaded. The multithreaded mode
+    of `xz` produces different data than its single-threaded mode, hence
+    it always uses at least two threads. `zstd` uses long distance
+    matching, which pays off for large files, like images.
+    """
+    threads = threads or cpu_budget()
+    args = [f"-{level}"] if level is not None else []
+
+    if fmt == "gzip":
+        if shutil.which("pigz"):
+            return ["pigz", "--no-name", f"--processes={threads}", *args]
+        return ["gzip", "--no-name", *args]
+
+    if fmt == "xz":
+        return ["xz", f"--threads={max(threads, 2)}", *args]
+
+    if fmt == "zstd":
+        return ["zstd", "--quiet", f"--threads={threads}", "--long", *args]
+
+    raise ValueError(f"Unsupported compression format '{fmt}'")
+
+
+def tar_argument(fmt: str, level: Optional[int] = None, threads: Optional[int] = None) -> str:
+    """Return the argument for `tar --use-compress-program`, see `command`"""
+    return " ".join(shlex.quote(arg) for arg in command(fmt, level, threads))
+
+
+def compress(fmt: str, source: PathLike, target: PathLike, *,
+             level: Optional[int] = None,
+             threads: Optional[int] = None):
+    """Compress the file `source` as `fmt` into `target`, see `command`"""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        subprocess.run(command(fmt, level, threads),
+                       stdin=src,
+                       stdout=dst,
+                       check=True)
@@ -0,0 +1,272 @@
+"""HTTP Downloads
+
+Download files via HTTP(S) without spawning a new process for each file.
+Connections are kept alive and re-used for subsequent requests to the same
+host, and the content is hashed while it is received, so that it does not
+have to be read again for verification.
+"""
+
+import contextlib
+import http.client
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+from .checksum import HashingWriter
+from .types import PathLike
+
+__all__ = [
+    "ConnectionPool",
+    "DownloadError",
+    "UnsupportedURLError",
+    "supported",
+]
+
+
+# How many bytes to read in one go
+BLOCKSIZE = 65536
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class DownloadError(RuntimeError):
+    """A download failed"""
+
+
+class UnsupportedURLError(DownloadError):
+    """A URL, e.g. the target of a redirect, is not `supported`"""
+
+
+def supported(url: str) -> bool:
+    """Check if `url` can be downloaded via a `ConnectionPool`
+
+    Only plain http and https URLs are supported; URLs that need to
+    be accessed via a proxy, as configured via the environment, or
+    that contain credentials are not.
+    """
+    purl = urllib.parse.urlsplit(url)
+    if purl.scheme not in ("http", "https"):
+        return False
+
+    if purl.username is not None or purl.password is not None:
+        return False
+
+    proxies = urllib.request.getproxies()
+    if purl.scheme in proxies or "all" in proxies:
+        return bool(urllib.request.proxy_bypass(purl.hostname or ""))
+
+    return True
+
+
+class ConnectionPool(contextlib.AbstractContextManager):
+    """A pool of keep-alive HTTP(S) connections
+
+    Idle connections are kept per host, port and TLS configuration and
+    re-used for later requests. A connection is taken out of the pool
+    for the duration of a request, which makes it safe to use the pool
+    from multiple threads concurrently; the number of connections to a
+    single host is thus bounded by the number of concurrent downloads.
+
+    Stalled connections are aborted after `timeout` seconds, and at
+    most `max_redirects` redirects are followed. Like curl does with
+    `--speed-limit` and `--speed-time`, a download is aborted if less
+    than `speed_limit` bytes per second were received over a period of
+    `speed_time` seconds, so that a trickle does not hold it forever.
+    """
+
+    def __init__(self, *, timeout: float = 30, max_redirects: int = 10,
+                 speed_limit: int = 1000, speed_time: float = 30):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.speed_limit = speed_limit
+        self.speed_time = speed_time
+        self._idle: Dict[Tuple, List[http.client.HTTPConnection]] = {}
+        self._contexts: Dict[Tuple, ssl.SSLContext] = {}
+        self._lock = threading.Lock()
+
+    def _ssl_context(self, tls: Tuple) -> ssl.SSLContext:
+        with self._lock:
+            ctx = self._contexts.get(tls)
+            if ctx:
+                return ctx
+
+            cafile, certfile, keyfile, insecure = tls
+            ctx = ssl.create_default_context(cafile=cafile)
+            if certfile:
+                ctx.load_cert_chain(certfile, keyfile or None)
+            if insecure:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+
+            self._contexts[tls] = ctx
+            return ctx
+
+    def _connect(self, key: Tuple) -> http.client.HTTPConnection:
+        scheme, host, port, tls = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout,
+                                               context=self._ssl_context(tls))
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key: Tuple) -> Optional[http.client.HTTPConnection]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def _release(self, key: Tuple, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse):
+        if resp.will_close:
+            conn.close()
+            return
+
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _request(self, key: Tuple, target: str,
+                 headers: Dict[str, str]) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        conn = self._acquire(key)
+
+        # A re-used connection might have been closed by the server in
+        # the meantime; in that case retry with a new connection
+        if conn:
+            try:
+                conn.request("GET", target, headers=headers)
+                return conn, conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+
+        conn = self._connect(key)
+        try:
+            conn.request("GET", target, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def fetch(self, url: str, path: PathLike, algorithm: str, *,
+              cafile: Optional[str] = None,
+              certfile: Optional[str] = None,
+              keyfile: Optional[str] = None,
+              insecure: bool = False,
+              resume: bool = False) -> str:
+        """Download `url` to `path` and return its hexdigest
+
+        The content is hashed with `algorithm` while it is written to
+        `path`. Redirects are followed. For https URLs the server is
+        verified against the CA certificates in `cafile`, or the default
+        ones if not given, unless `insecure` is set; a client certificate
+        can be specified via `certfile` and `keyfile`.
+
+        If `resume` is set and `path` already contains the first part
+        of the content, e.g. from an earlier, interrupted download, only
+        the remaining part is requested, if the server supports it.
+
+        A `DownloadError` is raised if the server does not respond with
+        the content, `OSError` for errors on the connection. If `url`, or
+        the target of a redirect, is not `supported`, `UnsupportedURLError`
+        is raised.
+        """
+        tls = (cafile or None, certfile or None, keyfile or None, bool(insecure))
+
+        offset = 0
+        if resume:
+            with contextlib.suppress(FileNotFoundError):
+                offset = os.stat(path).st_size
+
+        for _ in range(self.max_redirects + 1):
+            if not supported(url):
+                raise UnsupportedURLError(f"{url}: not supported")
+
+            purl = urllib.parse.urlsplit(url)
+            key = (purl.scheme, purl.hostname, purl.port, tls if purl.scheme == "https" else None)
+            target = urllib.parse.urlunsplit(("", "", purl.path or "/", purl.query, ""))
+
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            conn, resp = self._request(key, target, headers)
+
+            try:
+                if resp.status in REDIRECTS:
+                    location = resp.getheader("Location")
+                    resp.read()
+                    if not location:
+                        raise DownloadError(f"{url}: redirect without location")
+                    self._release(key, conn, resp)
+                    url = urllib.parse.urljoin(url, location)
+                    continue
+
+                if resp.status == 416 and offset:
+                    # the partial content does not fit, start over
+                    resp.read()
+                    self._release(key, conn, resp)
+                    offset = 0
+                    continue
+
+                if resp.status == 200:
+                    offset = 0
+                elif resp.status != 206 or not offset or \
+                        not (resp.getheader("Content-Range") or "").startswith(f"bytes {offset}-"):
+                    resp.read()
+                    raise DownloadError(f"{url}: {resp.status} {resp.reason}")
+
+                digest = self._receive(url, resp, path, algorithm, offset)
+
+            except BaseException:
+                conn.close()
+                raise
+
+            self._release(key, conn, resp)
+            return digest
+
+        raise DownloadError(f"{url}: too many redirects")
+
+    def _receive(self, url: str, resp: http.client.HTTPResponse, path: PathLike, algorithm: str, offset: int) -> str:
+        buf = bytearray(BLOCKSIZE)
+        view = memoryview(buf)
+
+        with open(path, "r+b" if offset else "wb") as f:
+            writer = HashingWriter(f, algorithm)
+
+            # hash the content received before and append to it
+            while f.tell() < offset:
+                data = f.read(min(BLOCKSIZE, offset - f.tell()))
+                if not data:
+                    raise DownloadError(f"{os.fspath(path)}: truncated")
+                writer.hasher.update(data)
+            f.truncate(offset)
+
+            # the bytes received since the start of the current period
+            start, received = time.monotonic(), 0
+
+            while True:
+                n = resp.readinto(buf)
+                if not n:
+                    break
+                writer.write(view[:n])
+
+                received += n
+                elapsed = time.monotonic() - start
+                if elapsed >= self.speed_time:
+                    if received < self.speed_limit * elapsed:
+                        raise DownloadError(f"{url}: less than {self.speed_limit} bytes/s "
+                                            f"for {self.speed_time} seconds")
+                    start, received = time.monotonic(), 0
+
+        return writer.hexdigest()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
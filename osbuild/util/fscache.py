@@ -8,13 +8,16 @@ the cache under a given limit.
 
 # pylint: disable=too-many-lines
 
+import concurrent.futures
 import contextlib
 import errno
 import json
 import os
 import subprocess
+import threading
 import uuid
-from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+from typing import (Any, Dict, Iterable, List, NamedTuple, Optional, Set,
+                    Tuple, Union)
 
 from osbuild.util import ctx, linux, rmrf
 
@@ -26,6 +29,48 @@ __all__ = [
 
 MaximumSizeType = Optional[Union[int, str]]
 
+# Depth of the directory tree up to which `FsCache._calculate_size()` scans
+# directories itself, before it scans the directories below in parallel.
+_SIZE_FANOUT_DEPTH = 3
+
+
+def _scan_tree(path: str, recursive: bool = True) -> Tuple[int, Dict[Tuple[int, int], int], List[str]]:
+    """Scan a directory tree for its disk usage
+
+    Scan the directory at `path` and return a tuple consisting of the disk
+    usage of all files with a single link, the disk usage of all files with
+    multiple links (indexed by device and inode, to account them only once)
+    and, unless `recursive` is set, the sub-directories that were not
+    scanned. Directories that cannot be read are skipped, like `os.walk()`
+    does.
+    """
+
+    size = 0
+    links = {}
+    dirs: List[str] = []
+    todo = [path]
+
+    while todo:
+        try:
+            it = os.scandir(todo.pop())
+        except OSError:
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    (todo if recursive else dirs).append(entry.path)
+                    continue
+
+                st = entry.stat(follow_symlinks=False)
+                usage = min(st.st_size, st.st_blocks * 512)
+                if st.st_nlink > 1:
+                    links[(st.st_dev, st.st_ino)] = usage
+                else:
+                    size += usage
+
+    return size, links, dirs
+
 
 class FsCacheInfo(NamedTuple):
     """File System Cache Information
@@ -100,6 +145,7 @@ class FsCacheInfo(NamedTuple):
         return data
 
 
+# pylint: disable=too-many-instance-attributes
 class FsCache(contextlib.AbstractContextManager, os.PathLike):
     """File System Cache
 
@@ -139,7 +185,9 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
     has a separate subdirectory there. To guard access, a read-lock on
     `object.lock` is required for all readers, a write-lock is required for all
     writers. Static information about the object is available in the
-    `object.info` file.
+    `object.info` file. The modification time of `object.info` records when
+    the entry was last loaded. It is used to evict the least recently used
+    entries in case the cache runs out of space.
 
     As an optimization, entries in the object store consisting of a single
     file can be stored directly underneath `objects` without a separate
@@ -154,6 +202,11 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
     treated as a `write-once` cache, cache efficiency will decrease when taking
     write-locks.
 
+    If `retain` is set, the read-lock of an entry is kept once it was loaded,
+    until the context is left. Subsequent loads of the entry are then served
+    without accessing the file-system at all, but the entry can not be evicted
+    while the context is active, not even by this very instance.
+
     The `data/` directory contains the content of a cache entry. Its content
     is solely defined by the creator of the entry and the cache makes no
     assumptions about its layout. Note that the `data/` directory itself can be
@@ -221,6 +274,8 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
     _lock: Optional[int]
     _info: FsCacheInfo
     _info_maximum_size: int
+    _handles: Dict[str, int]
+    _handles_lock: threading.Lock
 
     def __init__(self, appid: str, path_cache: Any):
         """Create File System Cache
@@ -250,6 +305,9 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
         self._lock = None
         self._info = FsCacheInfo()
         self._info_maximum_size = 0
+        self._handles = {}
+        self._handles_lock = threading.Lock()
+        self.retain = False
 
     def _trace(self, trace: str):
         """Trace execution
@@ -277,7 +335,14 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
 
         Calculate the total amount of storage required for a directory tree in
         bytes. This does not account for metadata, but only for stored file
-        content.
+        content. Files are accounted with the blocks they occupy, but never
+        with more than their size. Hence, holes in sparse files are not
+        accounted. Files with multiple hard-links in the tree are accounted
+        only once.
+
+        Every entry of the tree is visited exactly once. The directories in
+        the first levels of the tree are scanned by the caller, everything
+        below them is scanned in parallel, one worker per directory.
 
         Parameters:
         -----------
@@ -285,13 +350,28 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
             File-system path to the directory to operate on.
         """
 
-        return sum(
-            os.lstat(
-                os.path.join(path, f)
-            ).st_size for path, dirs, files in os.walk(
-                path_target
-            ) for f in files
-        )
+        size = 0
+        links: Dict[Tuple[int, int], int] = {}
+
+        def account(result):
+            nonlocal size
+            size += result[0]
+            links.update(result[1])
+            return result[2]
+
+        level = [path_target]
+        for _ in range(_SIZE_FANOUT_DEPTH):
+            level = [
+                d for path in level
+                for d in account(_scan_tree(path, recursive=False))
+            ]
+
+        if level:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                for result in executor.map(_scan_tree, level):
+                    account(result)
+
+        return size + sum(links.values())
 
     def __fspath__(self) -> Any:
         """Return cache path
@@ -709,6 +789,11 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         # Discard any state of this context and reset to original state.
+        with self._handles_lock:
+            handles, self._handles = self._handles, {}
+        for fd in handles.values():
+            linux.fcntl_flock(fd, linux.fcntl.F_UNLCK)
+            os.close(fd)
         if self._lock is not None:
             linux.fcntl_flock(self._lock, linux.fcntl.F_UNLCK)
             os.close(self._lock)
@@ -760,6 +845,102 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
 
             return True
 
+    def _last_used_objects(self) -> List[str]:
+        """List committed objects ordered by last use
+
+        Return the names of all committed entries in the object store,
+        ordered from the least to the most recently used one. Entries without
+        object-information are not committed (or already being deleted) and
+        thus are not included.
+
+        This does not acquire any locks. The result is merely a snapshot and
+        entries might be created, used or deleted concurrently at any time.
+        """
+
+        objs = []
+
+        with ctx.suppress_oserror(errno.ENOENT):
+            for entry in os.scandir(self._path(self._dirname_objects)):
+                path_info = os.path.join(entry.path, self._filename_object_info)
+                try:
+                    st = os.lstat(path_info)
+                except OSError as e:
+                    if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+                        continue
+                    raise
+                objs.append((st.st_mtime_ns, entry.name))
+
+        return [name for _, name in sorted(objs)]
+
+    def _evict_object(self, name: str) -> bool:
+        """Evict object
+
+        Try to delete the committed entry with the given name and de-account
+        its size from the cache. The entry is only deleted if a write-lock can
+        be acquired without waiting, i.e. no reader or writer is currently
+        using it. Returns `True` if the entry was deleted, `False` otherwise.
+
+        Parameters:
+        -----------
+        name
+            Name of the entry to evict.
+        """
+
+        rpath_dir = os.path.join(self._dirname_objects, name)
+        rpath_lock = os.path.join(rpath_dir, self._filename_object_lock)
+        path_info = self._path(rpath_dir, self._filename_object_info)
+
+        try:
+            with self._atomic_open(rpath_lock, write=True, wait=False):
+                try:
+                    with open(path_info, "r", encoding="utf8") as f:
+                        info = json.load(f)
+                except OSError as e:
+                    if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+                        return False
+                    raise
+
+                self._rm_r_object(rpath_dir)
+
+                size = info.get("size") if isinstance(info, dict) else None
+                if isinstance(size, int):
+                    self._update_cache_size(-size)
+
+                return True
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.ENOENT, errno.ENOTDIR]:
+                return False
+            raise
+
+    def _reserve_cache_size(self, size: int) -> bool:
+        """Reserve cache size
+
+        Account `size` bytes in the total cache size, like
+        `_update_cache_size()` does. If the cache limits would be exceeded,
+        entries are evicted in least-recently-used order until the new size
+        fits. Entries that are in use, i.e. locked, are never evicted.
+
+        Returns `True` if the size was accounted, `False` if not enough space
+        could be made available. Nothing is evicted if `size` exceeds the
+        maximum cache size on its own.
+
+        This operation requires an active context.
+        """
+
+        if self._update_cache_size(size):
+            return True
+
+        if 0 <= self._info_maximum_size < size:
+            return False
+
+        for name in self._last_used_objects():
+            if not self._evict_object(name):
+                continue
+            if self._update_cache_size(size):
+                return True
+
+        return False
+
     def _rm_r_object(self, rpath_dir: str):
         """Remove object
 
@@ -869,10 +1050,12 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
         committed with the specified name.
 
         The final commit is skipped if an entry with the given name already
-        exists, or its name is claimed for other reasons. Furthermore, the
-        commit is skipped if cache limits are exceeded, or if cache maintenance
-        refuses the commit. Hence, a commit can never be relied upon and the
-        entry might be deleted from the cache as soon as the commit was invoked.
+        exists, or its name is claimed for other reasons. If the cache limits
+        would be exceeded, the least recently used entries that are not in use
+        are evicted to make room; the commit is skipped if that does not free
+        enough space, or if cache maintenance refuses the commit. Hence, a
+        commit can never be relied upon and the entry might be deleted from
+        the cache as soon as the commit was invoked.
 
         Parameters:
         -----------
@@ -902,85 +1085,192 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
             # Create and lock a new anonymous object in the staging area.
             uuidname, lockfd = self._atomic_dir(self._dirname_objects)
 
-            rpath_uuid = os.path.join(
+            rpath_data = os.path.join(
                 self._dirname_objects,
                 uuidname,
-            )
-            rpath_data = os.path.join(
-                rpath_uuid,
                 self._dirname_data,
             )
-            rpath_info = os.path.join(
-                rpath_uuid,
-                self._filename_object_info,
-            )
-            path_uuid = self._path(rpath_uuid)
-            path_data = self._path(rpath_data)
-            path_info = self._path(rpath_info)
 
             # Prepare an empty data directory and yield it to the caller.
-            os.mkdir(path_data)
+            os.mkdir(self._path(rpath_data))
             yield rpath_data
 
-            # Collect metadata about the new entry.
-            info: Dict[str, Any] = {}
-            info["creation-boot-id"] = self._bootid
-            info["size"] = self._calculate_size(path_data)
+            if self._commit(uuidname, name):
+                uuidname = None
+        finally:
+            if lockfd is not None:
+                if uuidname is not None:
+                    self._rm_r_object(os.path.join(self._dirname_objects, uuidname))
+                linux.fcntl_flock(lockfd, linux.fcntl.F_UNLCK)
+                os.close(lockfd)
+
+    def _commit(self, uuidname: str, name: str) -> bool:
+        """Commit anonymous object
+
+        Account the anonymous entry `uuidname` in the object store and commit
+        it under the specified name. The caller must hold the write-lock of the
+        anonymous entry.
+
+        Returns `True` if the entry was committed. Otherwise, the anonymous
+        entry is left in place, unaccounted and without object-information,
+        and it is up to the caller to clean it up.
+
+        Parameters:
+        -----------
+        uuidname
+            Name of the anonymous entry in the object store.
+        name
+            Name to commit the entry under.
+        """
+
+        rpath_uuid = os.path.join(
+            self._dirname_objects,
+            uuidname,
+        )
+        path_uuid = self._path(rpath_uuid)
+        path_data = self._path(rpath_uuid, self._dirname_data)
+        path_info = self._path(rpath_uuid, self._filename_object_info)
+
+        # Collect metadata about the new entry.
+        info: Dict[str, Any] = {}
+        info["creation-boot-id"] = self._bootid
+        info["size"] = self._calculate_size(path_data)
+
+        # Update the total cache-size, evicting old entries if needed. If
+        # it still exceeds the limits, bail out but do not trigger an
+        # error. It behaves as if the entry was committed and immediately
+        # deleted by racing cache management. No need to tell the caller
+        # about it (if that is ever needed, we can provide for it).
+        #
+        # Note that if we crash after updating the total cache size, but
+        # before committing the object information, the total cache size
+        # will be out of sync. However, it is never overcommitted, so we
+        # will never violate any cache invariants. The cache-size will be
+        # re-synchronized by any full cache-management operation.
+        if not self._reserve_cache_size(info["size"]):
+            return False
+
+        committed = False
 
-            # Update the total cache-size. If it exceeds the limits, bail out
-            # but do not trigger an error. It behaves as if the entry was
-            # committed and immediately deleted by racing cache management. No
-            # need to tell the caller about it (if that is ever needed, we can
-            # provide for it).
+        try:
+            # Commit the object-information, thus marking it as fully
+            # committed and accounted in the cache.
+            with open(path_info, "x", encoding="utf8") as f:
+                json.dump(info, f)
+
+            # As last step move the entry to the desired location. If the
+            # target name is already taken, we bail out and pretend the
+            # entry was immediately overwritten by another one.
             #
-            # Note that if we crash after updating the total cache size, but
-            # before committing the object information, the total cache size
-            # will be out of sync. However, it is never overcommitted, so we
-            # will never violate any cache invariants. The cache-size will be
-            # re-synchronized by any full cache-management operation.
-            if not self._update_cache_size(info["size"]):
-                return
+            # Preferably, we used RENAME_NOREPLACE, but this is not
+            # available on all file-systems. Hence, we rely on the fact
+            # that non-empty directories cannot be replaced, so we
+            # automatically get RENAME_NOREPLACE behavior.
+            path_name = self._path(self._dirname_objects, name)
+            try:
+                os.rename(
+                    src=path_uuid,
+                    dst=path_name,
+                )
+                committed = True
+            except OSError as e:
+                ignore = [errno.EEXIST, errno.ENOTDIR, errno.ENOTEMPTY]
+                if e.errno not in ignore:
+                    raise
+        finally:
+            # If the anonymous entry still exists, it will be cleaned up by
+            # the caller. Hence, make sure to drop the info file again and
+            # de-account it, so we don't overcommit.
+            if not committed:
+                with ctx.suppress_oserror(errno.ENOENT, errno.ENOTDIR):
+                    os.unlink(path_info)
+                self._update_cache_size(-info["size"])
+
+        return committed
+
+    @contextlib.contextmanager
+    def move_tree(self, name: str, tree: Any):
+        """Move file system tree into cache
+
+        Create a new entry in the object store with the directory `tree` as
+        its data. Unlike `store_tree()`, the tree is moved into the cache
+        rather than copied, which requires it to be on the same file-system
+        as the cache. The caller must guarantee that nobody modifies the tree
+        while it is being moved.
+
+        If the entry was committed, `tree` no longer exists. A read-lock on
+        the entry is retained and its relative path is yielded to the caller,
+        like `load()` does. Once control returns, the entry is released.
+
+        If the entry could not be committed, e.g. because the cache limits
+        are exceeded, the name is already taken, or `tree` is on another
+        file-system, `tree` is left in place and `None` is yielded.
+
+        Parameters:
+        -----------
+        name
+            Name to store the object under.
+        tree:
+            Path to the directory to move into the cache.
+        """
+
+        assert self._is_active()
+        assert self._bootid is not None
+
+        if not name:
+            raise ValueError()
+
+        if not self._is_compatible():
+            yield None
+            return
+
+        uuidname = None
+        lockfd = None
+
+        try:
+            # Create and lock a new anonymous object in the object store and
+            # move the tree into it as its data directory.
+            uuidname, lockfd = self._atomic_dir(self._dirname_objects)
+
+            path_data = self._path(
+                self._dirname_objects,
+                uuidname,
+                self._dirname_data,
+            )
+            rpath_name = None
 
             try:
-                # Commit the object-information, thus marking it as fully
-                # committed and accounted in the cache.
-                with open(path_info, "x", encoding="utf8") as f:
-                    json.dump(info, f)
-
-                # As last step move the entry to the desired location. If the
-                # target name is already taken, we bail out and pretend the
-                # entry was immediately overwritten by another one.
-                #
-                # Preferably, we used RENAME_NOREPLACE, but this is not
-                # available on all file-systems. Hence, we rely on the fact
-                # that non-empty directories cannot be replaced, so we
-                # automatically get RENAME_NOREPLACE behavior.
-                path_name = self._path(self._dirname_objects, name)
-                try:
+                os.rename(
+                    src=os.fspath(tree),
+                    dst=path_data,
+                )
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            else:
+                if self._commit(uuidname, name):
+                    uuidname = None
+
+                    # Convert our write-lock into a read-lock. This is atomic,
+                    # so the entry cannot be evicted in-between, but it can be
+                    # loaded by others from now on.
+                    linux.fcntl_flock(lockfd, linux.fcntl.F_RDLCK)
+
+                    rpath_name = os.path.join(
+                        self._dirname_objects,
+                        name,
+                        self._dirname_data,
+                    )
+                else:
                     os.rename(
-                        src=path_uuid,
-                        dst=path_name,
+                        src=path_data,
+                        dst=os.fspath(tree),
                     )
-                except OSError as e:
-                    ignore = [errno.EEXIST, errno.ENOTDIR, errno.ENOTEMPTY]
-                    if e.errno not in ignore:
-                        raise
 
-                uuidname = None
-            finally:
-                # If the anonymous entry still exists, it will be cleaned up by
-                # the outer handler. Hence, make sure to drop the info file
-                # again and de-account it, so we don't overcommit.
-                if os.path.lexists(path_uuid):
-                    with ctx.suppress_oserror(errno.ENOENT, errno.ENOTDIR):
-                        os.unlink(path_info)
-                    self._update_cache_size(-info["size"])
+            yield rpath_name
         finally:
             if lockfd is not None:
                 if uuidname is not None:
-                    # In case this runs after the object was renamed, but before
-                    # `uuidname` was cleared, then `_rm_r_object()` will be a
-                    # no-op.
                     self._rm_r_object(os.path.join(self._dirname_objects, uuidname))
                 linux.fcntl_flock(lockfd, linux.fcntl.F_UNLCK)
                 os.close(lockfd)
@@ -996,6 +1286,9 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
         The returned path is the relative path between the cache and the top
         level directory of the cache entry.
 
+        Loading an entry marks it as used, which protects it from eviction
+        for longer than entries that were used less recently.
+
         Parameters:
         -----------
         name
@@ -1009,6 +1302,15 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
         if not self._is_compatible():
             raise self.MissError()
 
+        if self.retain:
+            self._load_retained(name)
+            yield os.path.join(
+                self._dirname_objects,
+                name,
+                self._dirname_data,
+            )
+            return
+
         with contextlib.ExitStack() as es:
             # Use an ExitStack so we can catch exceptions raised by the
             # `__enter__()` call on the context-manager. We want to catch
@@ -1030,12 +1332,93 @@ class FsCache(contextlib.AbstractContextManager, os.PathLike):
                     raise self.MissError() from None
                 raise e
 
+            # Record the access for the LRU eviction. Failing to do so, e.g.
+            # on a read-only cache, must not turn this into a cache-miss.
+            with ctx.suppress_oserror(errno.ENOENT, errno.EACCES, errno.EPERM, errno.EROFS):
+                os.utime(self._path(self._dirname_objects, name, self._filename_object_info))
+
             yield os.path.join(
                 self._dirname_objects,
                 name,
                 self._dirname_data,
             )
 
+    def _load_retained(self, name: str):
+        """Acquire a read-lock on the entry `name` and keep it
+
+        Does nothing if the lock is held already. Raises `MissError` if the
+        entry does not exist, or can not be locked.
+        """
+
+        with self._handles_lock:
+            if name in self._handles:
+                return
+
+        try:
+            with self._atomic_open(
+                os.path.join(
+                    self._dirname_objects,
+                    name,
+                    self._filename_object_lock,
+                ),
+                write=False,
+                wait=False,
+                closefd=False,
+            ) as fd:
+                pass
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.ENOENT, errno.ENOTDIR]:
+                raise self.MissError() from None
+            raise e
+
+        with self._handles_lock:
+            if name not in self._handles:
+                self._handles[name] = fd
+                fd = None
+
+        # the entry was loaded concurrently by another thread
+        if fd is not None:
+            linux.fcntl_flock(fd, linux.fcntl.F_UNLCK)
+            os.close(fd)
+            return
+
+        with ctx.suppress_oserror(errno.ENOENT, errno.EACCES, errno.EPERM, errno.EROFS):
+            os.utime(self._path(self._dirname_objects, name, self._filename_object_info))
+
+    def contains_many(self, names: Iterable[str]) -> Set[str]:
+        """Check for many entries at once
+
+        Return the subset of `names` that are in the cache. Instead of
+        looking up each entry individually, the object store is listed
+        once and only the entries that are found are loaded, like `load()`
+        does, to verify that they are committed and not being evicted. The
+        result merely reflects the state of the cache at a particular time.
+
+        Parameters:
+        -----------
+        names
+            Names of the cache entries to find.
+        """
+
+        assert self._is_active()
+
+        if not self._is_compatible():
+            return set()
+
+        names = set(names)
+        with ctx.suppress_oserror(errno.ENOENT):
+            names.intersection_update(os.listdir(self._path(self._dirname_objects)))
+
+        found = set()
+        for name in names:
+            try:
+                with self.load(name):
+                    found.add(name)
+            except self.MissError:
+                pass
+
+        return found
+
     @property
     def info(self) -> FsCacheInfo:
         """Query Cache Information
@@ -12,10 +12,16 @@ import errno
 import json
 import os
 import socket
+import struct
 from typing import Any, Optional
 
 from .types import PathLike
 
+# Header of a framed message: a magic that can never start a JSON text
+# followed by the length of the payload
+FRAME_MAGIC = b"\0jcf"
+FRAME_HEADER = struct.Struct("=4sI")
+
 
 class FdSet:
     """File-Descriptor Set
@@ -98,10 +104,21 @@ class Socket(contextlib.AbstractContextManager):
     This socket object represents a communication channel. It allows sending
     and receiving JSON-encoded messages. It uses unix-domain sequenced-packet
     sockets as underlying transport.
+
+    Messages are either sent as plain JSON, or, if `framed` is set, prefixed
+    with a header that contains the size of the payload. This allows the
+    receiver to read the message into a re-usable buffer with a single call,
+    instead of probing for its size first. Framed and plain messages are
+    always accepted; once a framed message has been received, `framed` is
+    set, so that the replies to a peer that uses framing are framed too.
+    Thus only the initiating side needs to opt-in and it must only do so if
+    it knows the peer supports it.
     """
 
     _socket = None
     _unlink = None
+    _buffer = None
+    framed = False
 
     def __init__(self, sock, unlink):
         self._socket = sock
@@ -327,33 +344,30 @@ class Socket(contextlib.AbstractContextManager):
         # since that is the maximum of that sysctl datatype.
         # Anyway, `MSG_TRUNC+MSG_PEEK` usually allows us to easily peek at the
         # incoming buffer. Unfortunately, the python `recvmsg()` wrapper
-        # discards the return code and we cannot use that. Instead, we simply
-        # loop until we know the size. This is slightly awkward, but seems fine
-        # as long as you do not put this into a hot-path.
-        size = 4096
-        while True:
+        # discards the return code and we cannot use that. Framed messages
+        # carry their size in the header, so only that is peeked at. For
+        # plain messages, we simply loop until we know the size.
+        peek = self._socket.recvmsg(FRAME_HEADER.size, 0, socket.MSG_PEEK)
+        if not peek[0]:
+            # Connection was closed
+            return None, None, None
+        if peek[0].startswith(FRAME_MAGIC):
+            return self._recv_framed(peek[0])
+
+        size = FRAME_HEADER.size
+        while peek[2] & socket.MSG_TRUNC:
+            size = max(size * 2, 4096)
             peek = self._socket.recvmsg(size, 0, socket.MSG_PEEK)
-            if not peek[0]:
-                # Connection was closed
-                return None, None, None
-            if not (peek[2] & socket.MSG_TRUNC):
-                break
-            size *= 2
 
         # Fetch a packet from the socket. On linux, the maximum SCM_RIGHTS array
         # size is hard-coded to 253. This allows us to size the ancillary buffer
         # big enough to receive any possible message.
-        fds = array.array("i")
-        msg = self._socket.recvmsg(size, socket.CMSG_LEN(253 * fds.itemsize))
+        msg = self._socket.recvmsg(size, socket.CMSG_LEN(253 * array.array("i").itemsize))
 
         # First thing we do is always to fetch the CMSG FDs into an FdSet. This
         # guarantees that we do not leak FDs in case the message handling fails
         # for other reasons.
-        for level, ty, data in msg[1]:
-            if level == socket.SOL_SOCKET and ty == socket.SCM_RIGHTS:
-                assert len(data) % fds.itemsize == 0
-                fds.frombytes(data)
-        fdset = FdSet(rawfds=fds)
+        fdset = self._fdset_from_ancdata(msg[1])
 
         # Check the returned message flags. If the message was truncated, we
         # have to discard it. This shouldn't happen, but there is no harm in
@@ -370,6 +384,53 @@ class Socket(contextlib.AbstractContextManager):
 
         return (payload, fdset, msg[3])
 
+    def _recv_framed(self, peeked: bytes):
+        assert self._socket is not None
+
+        if len(peeked) < FRAME_HEADER.size:
+            size = len(peeked)
+        else:
+            _, length = FRAME_HEADER.unpack_from(peeked)
+            size = FRAME_HEADER.size + length
+
+        # Receive directly into the buffer, which is kept for later messages
+        # and only grown if it is too small
+        if self._buffer is None or len(self._buffer) < size:
+            capacity = 65536
+            while capacity < size:
+                capacity *= 2
+            self._buffer = bytearray(capacity)
+
+        view = memoryview(self._buffer)[:size]
+        nbytes, ancdata, flags, address = self._socket.recvmsg_into(
+            [view], socket.CMSG_LEN(253 * array.array("i").itemsize))
+
+        fdset = self._fdset_from_ancdata(ancdata)
+
+        if nbytes < FRAME_HEADER.size or nbytes != size:
+            raise BufferError
+        if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+            raise BufferError
+
+        try:
+            payload = json.loads(str(view[FRAME_HEADER.size:], "utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise BufferError from e
+
+        # The peer speaks the framed protocol, use it for replies as well
+        self.framed = True
+
+        return (payload, fdset, address)
+
+    @staticmethod
+    def _fdset_from_ancdata(ancdata) -> FdSet:
+        fds = array.array("i")
+        for level, ty, data in ancdata:
+            if level == socket.SOL_SOCKET and ty == socket.SCM_RIGHTS:
+                assert len(data) % fds.itemsize == 0
+                fds.frombytes(data)
+        return FdSet(rawfds=fds)
+
     def send(self, payload: object, *, fds: Optional[list] = None):
         """Send Message
 
@@ -404,8 +465,12 @@ class Socket(contextlib.AbstractContextManager):
         if fds:
             cmsg.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds)))
 
-        n = self._socket.sendmsg([serialized], cmsg, 0)
-        assert n == len(serialized)
+        buffers = [serialized]
+        if self.framed:
+            buffers.insert(0, FRAME_HEADER.pack(FRAME_MAGIC, len(serialized)))
+
+        n = self._socket.sendmsg(buffers, cmsg, 0)
+        assert n == sum(len(b) for b in buffers)
 
     def send_and_recv(self, payload: object, *, fds: Optional[list] = None):
         """Send a message and wait for a reply
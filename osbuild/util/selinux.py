@@ -1,9 +1,10 @@
 """SELinux utility functions"""
 
+import concurrent.futures
 import errno
 import os
 import subprocess
-from typing import Dict, TextIO
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
 
 # Extended attribute name for SELinux labels
 XATTR_NAME_SELINUX = b"security.selinux"
@@ -35,21 +36,134 @@ def config_get_policy(config: Dict[str, str]):
     return config.get('SELINUXTYPE', None)
 
 
-def setfiles(spec_file: str, root: str, *paths):
+def setfiles(spec_file: str, root: str, *paths, exclude: Iterable[str] = ()):
     """Initialize the security context fields for `paths`
 
     Initialize the security context fields (extended attributes)
     on `paths` using the given specification in `spec_file`. The
     `root` argument determines the root path of the file system
     and the entries in `path` are interpreted as relative to it.
+    Directories in `exclude`, also relative to `root`, and their
+    contents are skipped.
     Uses the setfiles(8) tool to actually set the contexts.
     """
-    for path in paths:
-        subprocess.run(["setfiles", "-F",
-                        "-r", root,
-                        spec_file,
-                        f"{root}{path}"],
-                       check=True)
+    if not paths:
+        return
+
+    excludes = []
+    for path in exclude:
+        excludes += ["-e", f"{root}{path}"]
+
+    subprocess.run(["setfiles", "-F",
+                    "-r", root,
+                    *excludes,
+                    spec_file,
+                    *[os.path.normpath(f"{root}{path}") for path in paths]],
+                   check=True)
+
+
+class _Dir:
+    """A directory and the number of entries below it"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 1
+        self.subdirs: List["_Dir"] = []
+
+
+def _scan(path: str, links: Dict[Tuple[int, int], List[str]]) -> _Dir:
+    node = _Dir(path)
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                sub = _scan(entry.path, links)
+                node.size += sub.size
+                node.subdirs.append(sub)
+                continue
+
+            node.size += 1
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    links.setdefault((st.st_dev, st.st_ino), []).append(entry.path)
+    return node
+
+
+def _split(top: _Dir, links: Dict[Tuple[int, int], List[str]], chunk: int) -> List[_Dir]:
+    """Split the tree below `top` into subtrees of about `chunk` entries
+
+    Subtrees that share files via hardlinks with any other part of the
+    tree are not split off.
+    """
+    parts: Dict[str, _Dir] = {}
+    todo = list(top.subdirs)
+    while todo:
+        node = todo.pop()
+        if node.size > chunk and node.subdirs:
+            todo += node.subdirs
+        else:
+            parts[node.path] = node
+
+    def part_of(path: str) -> Optional[str]:
+        while path != top.path:
+            path = os.path.dirname(path)
+            if path in parts:
+                return path
+        return None
+
+    changed = True
+    while changed:
+        changed = False
+        for paths in links.values():
+            owners = {part_of(p) for p in paths}
+            if len(owners) < 2:
+                continue
+            for owner in owners:
+                if owner:
+                    del parts[owner]
+                    changed = True
+
+    return sorted(parts.values(), key=lambda p: p.size, reverse=True)
+
+
+def setfiles_parallel(spec_file: str, root: str, path: str = "/", *,
+                      workers: Optional[int] = None,
+                      chunk: int = 20000):
+    """Initialize the security context fields for `path` concurrently
+
+    Like `setfiles`, but the tree below `path` is split into subtrees
+    of up to about `chunk` entries, which are labeled by separate
+    setfiles(8) processes, up to `workers` at the same time; smaller
+    subtrees are labeled together. One more process labels the rest
+    of the tree, i.e. everything but these subtrees.
+
+    The labels are the same as if the whole tree was labeled at once:
+    setfiles labels all links of a file like the first one it comes
+    across, hence subtrees that share files with other parts of the
+    tree via hardlinks are labeled as part of the rest of the tree.
+    """
+    workers = workers or os.cpu_count() or 1
+    top = os.path.normpath(f"{root}{path}")
+
+    links: Dict[Tuple[int, int], List[str]] = {}
+    parts = _split(_scan(top, links), links, chunk) if workers > 1 else []
+
+    # small subtrees are labeled together, by one process
+    batches: List[List[str]] = []
+    size = chunk
+    for part in parts:
+        if size + part.size > chunk:
+            batches.append([])
+            size = 0
+        batches[-1].append("/" + os.path.relpath(part.path, root))
+        size += part.size
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(setfiles, spec_file, root, path,
+                                   exclude=[p for batch in batches for p in batch])]
+        futures += [executor.submit(setfiles, spec_file, root, *batch) for batch in batches]
+        for f in futures:
+            f.result()
 
 
 def getfilecon(path: str) -> str:
@@ -11,6 +11,7 @@ class VT:
 
     escape_sequences: Dict[str, str] = {
         "reset": "\033[0m",
+        "clear_line": "\r\033[2K",
 
         "bold": "\033[1m",
 
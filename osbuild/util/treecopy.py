@@ -0,0 +1,328 @@
+"""Tree Copy
+
+Copy file system trees like `cp -a`, but copy the files concurrently
+and report the progress. The data of files is cloned via reflinks if
+the file system supports it; otherwise it is copied in kernel space
+via `copy_file_range(2)`, skipping holes of sparse files. Entries can
+be moved instead, if the source tree is not needed anymore.
+"""
+
+import concurrent.futures
+import errno
+import fcntl
+import os
+import stat
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .types import PathLike
+
+__all__ = [
+    "Progress",
+    "copy_entries",
+    "copy_tree",
+]
+
+
+# `ioctl(2)` to share the data of one file with another, see `ioctl_ficlone(2)`
+FICLONE = 0x40049409
+
+# How many bytes to copy in one go
+BLOCKSIZE = 1024 * 1024
+
+
+# pylint: disable=too-many-instance-attributes
+class Progress:
+    """Progress of a copy
+
+    Accounts for the bytes of `total` that have been `copied`, `cloned`
+    via reflinks or `moved`. A `callback` is invoked with the progress
+    at most every `interval` seconds and once more when it is `finish`ed.
+    If cloning failed, the reason is kept as `reflink_error`.
+    """
+
+    def __init__(self, callback: Optional[Callable[["Progress"], None]] = None, *, interval: float = 1.0):
+        self.callback = callback
+        self.interval = interval
+        self.total = 0
+        self.copied = 0
+        self.cloned = 0
+        self.moved = 0
+        self.reflink_error: Optional[str] = None
+        self.finished = False
+        self.start = time.monotonic()
+        self._last = self.start
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> int:
+        return self.copied + self.cloned + self.moved
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second"""
+        return self.done / max(self.duration, 1e-6)
+
+    def add(self, *, copied: int = 0, cloned: int = 0, moved: int = 0):
+        with self._lock:
+            self.copied += copied
+            self.cloned += cloned
+            self.moved += moved
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+
+        if self.callback:
+            self.callback(self)
+
+    def finish(self):
+        self.finished = True
+        if self.callback:
+            self.callback(self)
+
+
+def _reflink(src: int, dst: int, progress: Progress, size: int) -> bool:
+    # the file systems don't support it, no need to try again
+    if progress.reflink_error:
+        return False
+
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+    except OSError as e:
+        progress.reflink_error = e.strerror or str(e)
+        return False
+
+    progress.add(cloned=size)
+    return True
+
+
+def _copy_range(src: int, dst: int, start: int, end: int, progress: Progress):
+    in_kernel = hasattr(os, "copy_file_range")
+
+    while start < end:
+        count = min(end - start, BLOCKSIZE)
+        n = 0
+        if in_kernel:
+            try:
+                n = os.copy_file_range(src, dst, count, start, start)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                in_kernel = False
+        if not in_kernel:
+            n = os.pwrite(dst, os.pread(src, count, start), start)
+        if not n:
+            break
+        start += n
+        progress.add(copied=n)
+
+
+def _copy_data(src: int, dst: int, size: int, progress: Progress):
+    if not size or _reflink(src, dst, progress, size):
+        return
+
+    # only copy the data of sparse files, not the holes
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(src, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            break
+        hole = os.lseek(src, data, os.SEEK_HOLE)
+        _copy_range(src, dst, data, hole, progress)
+        offset = hole
+
+    os.ftruncate(dst, size)
+
+
+def _copy_metadata(src: str, dst: str, st: os.stat_result):
+    # like `cp -a`, silently ignore what can not be preserved
+    try:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+
+    # changing the owner clears the set-user-id and set-group-id bits
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=False)
+            os.setxattr(dst, name, value, follow_symlinks=False)
+        except OSError:
+            pass
+
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _copy_file(src: str, dst: str, st: os.stat_result, progress: Progress):
+    # replace the file instead of writing to it, it might be a hardlink
+    _unlink(dst)
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        _copy_data(s.fileno(), d.fileno(), st.st_size, progress)
+    _copy_metadata(src, dst, st)
+
+
+def _unlink(path: str):
+    # an existing entry is replaced, like `cp` does
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.unlink(path)
+
+
+def _copy_node(src: str, dst: str, st: os.stat_result):
+    _unlink(dst)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    else:
+        os.mknod(dst, st.st_mode, st.st_rdev)
+    _copy_metadata(src, dst, st)
+
+
+def _move(src: str, dst: str, progress: Progress) -> bool:
+    st = os.lstat(src)
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EEXIST, errno.ENOTEMPTY, errno.EISDIR, errno.ENOTDIR):
+            raise
+        return False
+
+    if stat.S_ISREG(st.st_mode):
+        progress.total += st.st_size
+        progress.add(moved=st.st_size)
+    return True
+
+
+class _Batch:
+    """Entries to copy, the files are copied concurrently"""
+
+    def __init__(self, progress: Progress):
+        self.progress = progress
+        self.dirs: List[Tuple[str, str, os.stat_result]] = []
+        self.files: List[Tuple[str, str, os.stat_result]] = []
+        self.links: List[Tuple[str, str]] = []
+        self.inodes: Dict[Tuple[int, int], str] = {}
+
+    def add(self, src: str, dst: str, st: os.stat_result):
+        """Create directories and nodes, i.e. anything but regular files, right away"""
+        if stat.S_ISDIR(st.st_mode):
+            os.makedirs(dst, mode=0o700, exist_ok=True)
+            self.dirs.append((src, dst, st))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                first = self.inodes.setdefault((st.st_dev, st.st_ino), dst)
+                if first != dst:
+                    self.links.append((first, dst))
+                    return
+            self.files.append((src, dst, st))
+            self.progress.total += st.st_size
+        else:
+            _copy_node(src, dst, st)
+
+    def run(self, workers: Optional[int]):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_copy_file, src, dst, st, self.progress) for src, dst, st in self.files]
+            for future in futures:
+                future.result()
+
+        for first, dst in self.links:
+            _unlink(dst)
+            os.link(first, dst)
+
+        # the contents of a directory changes its modification time,
+        # hence the metadata is copied bottom up
+        for src, dst, st in reversed(self.dirs):
+            _copy_metadata(src, dst, st)
+
+
+def copy_tree(source: PathLike, target: PathLike, *,
+              move: bool = False,
+              workers: Optional[int] = None,
+              progress: Optional[Progress] = None) -> Progress:
+    """Copy the contents of the directory `source` into `target`
+
+    Behaves like `cp -a --reflink=auto source/. target/`: ownership,
+    permissions, extended attributes, which include SELinux labels,
+    timestamps and hardlinks within the tree are preserved. Files are
+    copied by up to `workers` threads concurrently.
+
+    If `move` is set, the entries of `source` are moved into `target`
+    if possible, i.e. if both are on the same file system; `source` is
+    thus modified. Returns `progress`, or a new `Progress` if it is
+    not given, after it was `finish`ed.
+    """
+    source, target = os.fspath(source), os.fspath(target)
+    progress = progress or Progress()
+
+    os.makedirs(target, exist_ok=True)
+
+    entries = sorted(os.listdir(source))
+    if move:
+        entries = [e for e in entries if not _move(os.path.join(source, e), os.path.join(target, e), progress)]
+
+    batch = _Batch(progress)
+
+    def scan(src_dir: str, dst_dir: str, names: List[str]):
+        for name in names:
+            src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+            st = os.lstat(src)
+            batch.add(src, dst, st)
+            if stat.S_ISDIR(st.st_mode):
+                scan(src, dst, sorted(os.listdir(src)))
+
+    scan(source, target, entries)
+    batch.run(workers)
+    _copy_metadata(source, target, os.lstat(source))
+
+    progress.finish()
+    return progress
+
+
+def copy_entries(source: PathLike, target: PathLike, paths: Iterable[str], *,
+                 workers: Optional[int] = None,
+                 progress: Optional[Progress] = None) -> Progress:
+    """Copy the entries `paths` of the directory `source` into `target`
+
+    Like `copy_tree`, but only the given `paths`, which are relative to
+    `source`, are copied to the same location in `target`; directories
+    are copied without their contents. Missing parent directories are
+    created with the metadata of the ones in `source`. Hardlinks among
+    the copied files are preserved.
+    """
+    source, target = os.fspath(source), os.fspath(target)
+    progress = progress or Progress()
+
+    os.makedirs(target, exist_ok=True)
+
+    batch = _Batch(progress)
+    seen = set()
+
+    # parents are sorted before their children
+    for path in sorted(paths):
+        parts = os.path.normpath(path).split(os.sep)
+        for i in range(1, len(parts) + 1):
+            name = os.path.join(*parts[:i])
+            if name in seen:
+                continue
+            seen.add(name)
+            src, dst = os.path.join(source, name), os.path.join(target, name)
+            batch.add(src, dst, os.lstat(src))
+
+    batch.run(workers)
+    _copy_metadata(source, target, os.lstat(source))
+
+    progress.finish()
+    return progress
@@ -3,12 +3,17 @@
 #
 
 import copy
+import hashlib
 import itertools
 import os
+import time
 import unittest
+from unittest import mock
 
 import osbuild
 import osbuild.meta
+from osbuild.inputs import Input
+from osbuild.pipeline import Stage
 
 BASIC_PIPELINE = {
     "version": "2",
@@ -244,6 +249,27 @@ class TestFormatV2(unittest.TestCase):
         res = fmt.validate(desc, self.index)
         self.assert_validation(res)
 
+    def test_validation_errors(self):
+        # the same invalid stage in different places is reported
+        # for each one of them
+        desc = copy.deepcopy(BASIC_PIPELINE)
+        for pipeline in desc["pipelines"]:
+            pipeline["stages"].append({"type": "org.osbuild.mkdir", "options": {"paths": "wrong"}})
+        desc["pipelines"][1]["stages"][0]["inputs"] = {
+            "tree": {"type": "org.osbuild.tree", "origin": "org.osbuild.pipeline"}
+        }
+
+        fmt = self.index.detect_format_info(desc).module
+        res = fmt.validate(desc, self.index)
+        self.assertFalse(res.valid)
+
+        self.assertEqual(sorted(e.id for e in res), [
+            ".pipelines[0].stages[1].options.paths",
+            ".pipelines[1].stages[0].inputs.tree",
+            ".pipelines[1].stages[1].options.paths",
+            ".pipelines[2].stages[1].options.paths",
+        ])
+
     def test_load_bad_ref_manifest(self):
         desc = BAD_REF_PIPELINE
 
@@ -444,3 +470,104 @@ class TestFormatV2(unittest.TestCase):
             {"id": k, "options": {}} for k in refs
         ]
         self.check_input_references(desc)
+
+    def test_large_manifest(self):
+        # Load and inspect a manifest with many packages, where the
+        # stage ids must only be calculated once
+        count = 5000
+        packages = {
+            "sha256:" + hashlib.sha256(str(i).encode()).hexdigest(): f"https://internet/package-{i}.rpm"
+            for i in range(count)
+        }
+
+        def rpm_stage():
+            return {
+                "type": "org.osbuild.rpm",
+                "inputs": {
+                    "packages": {
+                        "type": "org.osbuild.files",
+                        "origin": "org.osbuild.source",
+                        "references": list(packages),
+                    }
+                },
+                "options": {
+                    "gpgkeys": ["key"],
+                    "exclude": {"docs": True},
+                },
+            }
+
+        desc = {
+            "version": "2",
+            "sources": {"org.osbuild.curl": {"items": packages}},
+            "pipelines": [
+                {
+                    "name": "build",
+                    "runner": "org.osbuild.fedora38",
+                    "stages": [rpm_stage()],
+                },
+                {
+                    "name": "os",
+                    "build": "name:build",
+                    "runner": "org.osbuild.fedora38",
+                    "stages": [rpm_stage()] + [
+                        {"type": "org.osbuild.noop", "options": {"n": i}} for i in range(20)
+                    ],
+                },
+                {
+                    "name": "image",
+                    "build": "name:build",
+                    "runner": "org.osbuild.fedora38",
+                    "stages": [
+                        {
+                            "type": "org.osbuild.noop",
+                            "inputs": {
+                                "tree": {
+                                    "type": "org.osbuild.tree",
+                                    "origin": "org.osbuild.pipeline",
+                                    "references": ["name:os"],
+                                }
+                            },
+                        }
+                    ],
+                },
+            ],
+        }
+
+        class Store:
+            def contains(self, _):
+                return False
+
+        def inspect():
+            start = time.monotonic()
+            manifest, fmt = self.load_manifest(desc)
+            res = fmt.describe(manifest, with_id=True)
+            pipelines = manifest.depsolve(Store(), ["image"])
+            for pl in manifest:
+                self.assertIs(manifest[pl.id], pl)
+            return time.monotonic() - start, res, pipelines
+
+        # warm up the module index
+        inspect()
+
+        calc_id = Stage.calc_id
+        with mock.patch.object(Stage, "calc_id", autospec=True, side_effect=calc_id) as calls:
+            cached, res, pipelines = inspect()
+        self.assertEqual(pipelines, ["build", "os", "image"])
+
+        # at most twice for every stage: while it is being loaded
+        # (before and after its inputs were added) and once it is
+        # complete; but never again when inspecting the manifest
+        stages = sum(len(p["stages"]) for p in desc["pipelines"])
+        self.assertLessEqual(calls.call_count, 2 * stages)
+
+        # the same without caching, of stages and inputs
+        def uncached(stage):
+            stage.options = stage.options
+            return stage.calc_id()
+
+        with mock.patch.object(Stage, "id", property(uncached)), \
+                mock.patch.object(Input, "id", property(Input.calc_id)):
+            plain, check, _ = inspect()
+        self.assertEqual(res, check)
+
+        print(f"{count} packages: {cached:.3f}s (cached), {plain:.3f}s (uncached)")
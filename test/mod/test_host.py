@@ -6,8 +6,10 @@
 
 import errno
 import os
+import subprocess
 import sys
 import tempfile
+import threading
 from typing import Any
 
 import pytest
@@ -25,7 +27,7 @@ class ServiceTest(host.Service):
     def register_fds(self, fds):
         self.fds.extend(fds)
 
-    def dispatch(self, method: str, args: Any, fds: FdSet):
+    def dispatch(self, method: str, args: Any, fds: FdSet):  # pylint: disable=too-many-branches
         ret = None
 
         if method == "exception":
@@ -43,6 +45,8 @@ class ServiceTest(host.Service):
 
         elif method == "identify":
             ret = self.id
+        elif method == "print":
+            print(args)
         elif method == "invalid-fd":
             ret = []
             with tempfile.TemporaryFile("w+") as f:
@@ -183,6 +187,77 @@ def test_signals_on_separate_fd():
         assert exec_callback
 
 
+def test_pool():
+    class Monitor:
+        def __init__(self):
+            self.logged = threading.Event()
+            self.lines = []
+
+        def log(self, msg):
+            self.lines.append(msg)
+            self.logged.set()
+
+    with host.ServicePool() as pool:
+        if not pool.supported():
+            pytest.skip("forking services needs os.pidfd_open")
+
+        for _ in range(2):
+            monitor = Monitor()
+            with host.ServiceManager(monitor=monitor, pool=pool) as mgr:
+                for i in range(3):
+                    client = mgr.start(str(i), __file__)
+                    assert isinstance(client.proc, host.ForkedProcess)
+
+                    assert client.call("identify") == str(i)
+                    assert client.call("echo", ["an", "argument"]) == ["an", "argument"]
+
+                pids = {client.proc.pid for client in mgr.services.values()}
+                assert len(pids) == 3
+
+                mgr.services["1"].call("print", "osbuild")
+                assert monitor.logged.wait(10)
+                assert monitor.lines == ["1 (test_host.py): osbuild\n"]
+
+            # all services are forked from one template, for all managers
+            assert len(pool.templates) == 1
+            template, _ = pool.templates[__file__]
+            assert template.poll() is None
+
+    assert template.wait() == 0
+
+
+def test_pool_processes():
+    def parent(pid):
+        with open(f"/proc/{pid}/stat", encoding="utf8") as f:
+            return int(f.read().rsplit(")", 1)[1].split()[1])
+
+    with host.ServicePool() as pool:
+        if not pool.supported():
+            pytest.skip("forking services needs os.pidfd_open")
+
+        with host.ServiceManager(pool=pool) as mgr:
+            forked = mgr.start("forked", __file__)
+            assert forked.call("identify") == "forked"
+
+            # the service is a child of the template, not of ours,
+            # and is waited for via its pid file descriptor
+            template, _ = pool.templates[__file__]
+            proc = forked.proc
+            assert isinstance(proc, host.ForkedProcess)
+            assert parent(proc.pid) == template.pid
+            assert os.fstat(proc.pidfd)
+
+            mgr.stop_all()
+            assert proc.pidfd == -1
+
+    # without a pool, services are started as our children
+    with host.ServiceManager() as mgr:
+        spawned = mgr.start("spawned", __file__)
+        assert spawned.call("identify") == "spawned"
+        assert isinstance(spawned.proc, subprocess.Popen)
+        assert parent(spawned.proc.pid) == os.getpid()
+
+
 def main():
     service = ServiceTest.from_args(sys.argv[1:])
     service.main()
@@ -1,5 +1,6 @@
 import os
 from tempfile import TemporaryDirectory
+from unittest import mock
 
 import pytest
 
@@ -175,3 +176,115 @@ def test_schema():
     assert not res
     res = schema.validate([1, 2, 3])
     assert res
+
+
+def test_schema_refs():
+    # references, also recursive ones, work with the compiled schema
+    schema = osbuild.meta.Schema({
+        "definitions": {
+            "node": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "name": {"$ref": "#/definitions/name"},
+                    "children": {"type": "array", "items": {"$ref": "#/definitions/node"}},
+                },
+            },
+            "name": {"type": "string", "minLength": 1},
+        },
+        "$ref": "#/definitions/node",
+    })
+    assert schema.check().valid
+
+    assert schema.validate({"name": "a", "children": [{"name": "b", "children": [{"name": "c"}]}]})
+
+    res = schema.validate({"name": "a", "children": [{"children": [{"name": ""}]}]})
+    assert not res
+    assert [e.id for e in res] == [".children[0].children[0].name"]
+
+
+def test_schema_validate_all():
+    schema = osbuild.meta.Schema({"type": "array", "minItems": 3})
+
+    targets = [[1, 2], [1, 2, 3], [1, 2], [3, 4, 5]]
+    results = schema.validate_all(targets)
+
+    assert [r.valid for r in results] == [False, True, False, True]
+    assert results[0] is results[2]
+    assert schema.count == 4
+
+    schema = osbuild.meta.Schema(None)
+    results = schema.validate_all(targets)
+    assert len(results) == 4
+    assert not any(r.valid for r in results)
+
+
+def test_module_info_cache(tempdir):
+    libdir = os.path.join(tempdir, "lib")
+    cache = os.path.join(tempdir, "cache")
+    os.makedirs(os.path.join(libdir, "stages"))
+    module = os.path.join(libdir, "stages", "org.osbuild.test")
+
+    def write_module(options):
+        with open(module, "w", encoding="utf8") as f:
+            f.write(f'''#!/usr/bin/python3
+"""
+Test stage
+
+A stage for testing.
+"""
+
+CAPABILITIES = ["CAP_MAC_ADMIN"]
+
+SCHEMA_2 = """
+"options": {{
+  "additionalProperties": false,
+  "properties": {options}
+}}
+"""
+''')
+
+    def load():
+        index = osbuild.meta.Index(libdir, cache=cache)
+        parse_module = osbuild.meta.ModuleInfo._parse  # pylint: disable=protected-access
+        with mock.patch.object(osbuild.meta.ModuleInfo, "_parse", wraps=parse_module) as parse:
+            info = index.get_module_info("Stage", "org.osbuild.test")
+            schema = index.get_schema("Stage", "org.osbuild.test", version="2")
+        return info, schema, parse.call_count
+
+    write_module('{"a": {"type": "string"}}')
+
+    info, schema, parsed = load()
+    assert parsed == 1
+    assert info.desc == "Test stage"
+    assert info.caps == {"CAP_MAC_ADMIN"}
+    assert not schema.checked
+    assert schema.validate({"type": "org.osbuild.test", "options": {"a": "x"}})
+    assert os.path.exists(os.path.join(cache, "stages", "org.osbuild.test.json"))
+
+    # from the cache, incl. the already checked schema
+    cached, schema, parsed = load()
+    assert parsed == 0
+    assert schema.checked
+    assert vars(cached).keys() == vars(info).keys()
+    for key in ("name", "type", "path", "info", "desc", "opts", "caps", "checked"):
+        assert getattr(cached, key) == getattr(info, key)
+    assert schema.validate({"type": "org.osbuild.test", "options": {"a": "x"}})
+    assert not schema.validate({"type": "org.osbuild.test", "options": {"b": "x"}})
+
+    # the same content with a new modification time
+    os.utime(module, ns=(0, 0))
+    _, _, parsed = load()
+    assert parsed == 0
+
+    # a new content is parsed again
+    write_module('{"b": {"type": "string"}}')
+    _, schema, parsed = load()
+    assert parsed == 1
+    assert schema.validate({"type": "org.osbuild.test", "options": {"b": "x"}})
+
+    # a broken cache is ignored
+    with open(os.path.join(cache, "stages", "org.osbuild.test.json"), "w", encoding="utf8") as f:
+        f.write("{")
+    _, _, parsed = load()
+    assert parsed == 1
@@ -2,18 +2,25 @@
 # Test for monitoring classes and integration
 #
 
+import concurrent.futures
+import functools
 import io
+import json
 import os
+import subprocess
 import sys
 import tempfile
 import unittest
 from collections import defaultdict
+from unittest import mock
 
 import osbuild
 import osbuild.meta
-from osbuild.monitor import LogMonitor
+from osbuild.buildroot import BuildRoot, CompletedBuild
+from osbuild.monitor import JSONSeqMonitor, LogMonitor
 from osbuild.objectstore import ObjectStore
-from osbuild.pipeline import Runner
+from osbuild.pipeline import BuildResult, Runner
+from osbuild.util import treecopy
 
 from .. import test
 
@@ -114,3 +121,107 @@ class TestMonitor(unittest.TestCase):
         self.assertIn(pipeline.stages[0].id, tape.stages)
         self.assertIn("isthisthereallife", tape.output)
         self.assertIn("isthisjustfantasy", tape.output)
+
+    def test_log_monitor_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, "log.txt")
+            source = os.path.join(tmpdir, "source")
+            os.makedirs(source)
+            with open(os.path.join(source, "disk.img"), "wb") as f:
+                f.write(b"x" * 4096)
+
+            with open(logfile, "w", encoding="utf8") as log:
+                monitor = LogMonitor(log.fileno())
+                progress = treecopy.Progress(functools.partial(monitor.export, "image"))
+                treecopy.copy_tree(source, os.path.join(tmpdir, "target"), progress=progress)
+
+            with open(logfile, encoding="utf8") as f:
+                log = f.read()
+
+        # only the final status is written, since the log is not a terminal
+        self.assertEqual(log.count("\n"), 1 if not progress.reflink_error else 2)
+        self.assertIn("Export image: 4.0 KiB of 4.0 KiB", log)
+
+    def test_json_seq_monitor(self):
+        index = osbuild.meta.Index(os.curdir)
+        runner = Runner(osbuild.meta.RunnerInfo.from_path("runners/org.osbuild.linux"))
+        pipeline = osbuild.Pipeline("pipeline", runner=runner)
+        info = index.get_module_info("Stage", "org.osbuild.noop")
+        stage = pipeline.add_stage(info, {})
+
+        # a process that does some work, reaped like the build root does
+        proc = subprocess.Popen([sys.executable, "-c", "b'x' * 2**24"], stdout=subprocess.PIPE)
+        proc.stdout.close()
+        r = CompletedBuild(proc, "", BuildRoot.wait(proc))
+        self.assertEqual(r.returncode, 0)
+
+        with tempfile.TemporaryFile() as log:
+            monitor = JSONSeqMonitor(log.fileno())
+            monitor.begin(pipeline)
+            monitor.stage(stage)
+            monitor.log("message\n")
+            monitor.result(BuildResult(stage, r.returncode, r.output, {}, r.usage))
+            monitor.finish({"success": True})
+            monitor.service_start("source/curl", "org.osbuild.curl")
+            monitor.service_stop("source/curl")
+
+            log.seek(0)
+            data = log.read().decode()
+
+        # RFC 7464: each record starts with RS and ends with LF
+        self.assertTrue(data.startswith("\x1e") and data.endswith("\n"))
+        records = [json.loads(r) for r in data.split("\x1e")[1:]]
+        types = [r["type"] for r in records]
+        self.assertEqual(types, ["pipeline-begin", "stage-begin", "log", "stage-end", "pipeline-end",
+                                 "service-start", "service-stop"])
+
+        timestamps = [r["timestamp"] for r in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        begin, _, log, end, finish = records[:5]
+        self.assertEqual(begin["id"], pipeline.id)
+        self.assertEqual(log["pipeline"], pipeline.id)
+        self.assertEqual(log["message"], "message\n")
+        self.assertEqual(end["id"], stage.id)
+        self.assertTrue(end["success"])
+        self.assertEqual(end["duration"], end["timestamp"] - records[1]["timestamp"])
+        self.assertGreater(end["usage"]["utime_ns"] + end["usage"]["stime_ns"], 0)
+        self.assertGreater(end["usage"]["maxrss"], 2**24)
+        self.assertEqual(finish["duration"], finish["timestamp"] - begin["timestamp"])
+
+    def test_log_monitor_concurrent(self):
+        index = osbuild.meta.Index(os.curdir)
+        runner = Runner(osbuild.meta.RunnerInfo.from_path("runners/org.osbuild.linux"))
+        info = index.get_module_info("Stage", "org.osbuild.noop")
+
+        pipelines = [osbuild.Pipeline(name, runner=runner) for name in ("first", "second")]
+        stages = [pl.add_stage(info, {"name": pl.name}) for pl in pipelines]
+
+        with tempfile.TemporaryFile() as log, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as first, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as second:
+            monitor = LogMonitor(log.fileno())
+            first_stage = stages[0]
+            second_stage = stages[1]
+            result = BuildResult(stages[0], 0, "", {})
+
+            # events of both pipelines, in separate threads, take turns
+            with mock.patch("time.monotonic", side_effect=[0.0, 100.0, 1.5, 101.0]):
+                for executor, call in ((first, lambda: monitor.begin(pipelines[0])),
+                                       (second, lambda: monitor.begin(pipelines[1])),
+                                       (first, lambda: monitor.stage(first_stage)),
+                                       (second, lambda: monitor.stage(second_stage)),
+                                       (first, lambda: monitor.log("first log\n")),
+                                       (first, lambda: monitor.result(result)),
+                                       (second, lambda: monitor.result(result))):
+                    executor.submit(call).result()
+
+            log.seek(0)
+            data = log.read().decode()
+
+        # durations are measured from the start of the stage of the same pipeline
+        self.assertEqual(data.count("Duration: 1.50s"), 1)
+        self.assertEqual(data.count("Duration: 1.00s"), 1)
+        # the output is marked when it switches to another pipeline
+        self.assertIn("\n[first]\nnoop", data.replace("org.osbuild.", ""))
+        self.assertIn("\n[second]\n\n⏱  Duration: 1.00s", data)
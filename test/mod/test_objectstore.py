@@ -3,13 +3,17 @@
 #
 
 import contextlib
+import json
 import os
 import tempfile
+import time
 from pathlib import Path
+from unittest import mock
 
 import pytest
 
 from osbuild import objectstore
+from osbuild.util.fscache import FsCacheInfo
 
 from .. import test
 
@@ -201,6 +205,97 @@ def test_host_tree(tmpdir):
         _ = host.tree
 
 
+def in_cache(store: objectstore.ObjectStore, ref: str) -> bool:
+    try:
+        with store.cache.load(ref):
+            return True
+    except objectstore.FsCache.MissError:
+        return False
+
+
+def test_commit_move(object_store):
+    object_store.maximum_size = 1024 * 1024 * 1024
+    stage = os.path.join(object_store, "stage")
+
+    tree = object_store.new("a")
+    Path(tree, "A").touch()
+    tree.meta.set("md", {"a": 1})
+
+    # only finalized objects can be moved
+    with pytest.raises(ValueError):
+        object_store.commit(tree, "a", move=True)
+
+    tree.finalize()
+    object_store.commit(tree, "a", move=True)
+
+    # the object now refers to the cache entry and the
+    # staging entry was released
+    assert in_cache(object_store, "a")
+    assert os.fspath(tree).startswith(object_store.objects)
+    assert os.path.exists(os.path.join(tree, "A"))
+    assert tree.meta.get("md") == {"a": 1}
+    assert len(os.listdir(stage)) == 0
+
+    # the entry is in use and thus must not be evicted
+    object_store.maximum_size = 0
+    cache = object_store.cache
+    assert not cache._evict_object("a")  # pylint: disable=protected-access
+
+    # if the object can't be committed it is left untouched
+    tree = object_store.new("b")
+    Path(tree, "B").touch()
+    tree.finalize()
+    object_store.commit(tree, "b", move=True)
+
+    assert not in_cache(object_store, "b")
+    assert os.fspath(tree).startswith(stage)
+    assert os.path.exists(os.path.join(tree, "B"))
+
+
+@pytest.mark.skipif(not test.TestBase.can_bind_mount(), reason="Need root for overlay mount")
+def test_init_overlay(tmpdir):
+    with objectstore.ObjectStore(tmpdir) as object_store:
+        object_store.maximum_size = 1024 * 1024 * 1024
+
+        base = object_store.new("a")
+        Path(base, "A").write_text("a", encoding="utf8")
+        Path(base, "C").touch()
+        base.meta.set("md", {"a": 1})
+        base.finalize()
+
+        tree = object_store.new("b")
+        tree.init(base, overlay=True)
+
+        mountpoint = os.fspath(tree)
+        if not os.path.ismount(mountpoint):
+            pytest.skip("overlay not supported")
+
+        assert tree.created == base.created
+        assert tree.meta.get("md") == {"a": 1}
+        assert Path(tree, "A").read_text(encoding="utf8") == "a"
+
+        # changes do not affect the base
+        Path(tree, "A").write_text("b", encoding="utf8")
+        Path(tree, "B").touch()
+        os.unlink(Path(tree, "C"))
+        assert Path(base, "A").read_text(encoding="utf8") == "a"
+        assert not os.path.exists(Path(base, "B"))
+        assert os.path.exists(Path(base, "C"))
+
+        # committing copies the merged tree, moving is not possible
+        tree.finalize()
+        object_store.commit(tree, "b", move=True)
+        assert os.path.ismount(mountpoint)
+
+        with object_store.cache.load("b") as rpath:
+            obj = os.path.join(object_store.store, rpath, "tree")
+            assert Path(obj, "A").read_text(encoding="utf8") == "b"
+            assert os.path.exists(Path(obj, "B"))
+            assert not os.path.exists(Path(obj, "C"))
+
+    assert not os.path.exists(mountpoint)
+
+
 def test_source_epoch(object_store):
     tree = object_store.new("a")
     tree.source_epoch = 946688461
@@ -326,3 +421,296 @@ def test_store_server(tmpdir):
 
         with pytest.raises(RuntimeError):
             _ = client.read_tree_at("42", tmpdir, "/nonexistent")
+
+
+@pytest.mark.skipif(not test.TestBase.can_bind_mount(), reason="Need root for bind mount")
+def test_store_server_cached_tree(tmpdir):
+    with objectstore.ObjectStore(tmpdir) as store, \
+            objectstore.StoreServer(store) as server:
+        store.maximum_size = 1024 * 1024 * 1024
+
+        client = objectstore.StoreClient(server.socket_address)
+        name, key = "org.osbuild.ostree.checkout", "a" * 64
+
+        target = Path(tmpdir, "target")
+        target.mkdir()
+        assert client.read_cached_tree_at(name, key, target) is None
+
+        tree = Path(client.mkdtemp(prefix="tree-"), "tree")
+        tree.mkdir()
+        Path(tree, "file").write_text("osbuild", encoding="utf8")
+
+        # the tree is moved into the cache and mounted read-only
+        assert Path(client.cache_tree_at(name, key, tree, target)) == target
+        assert not tree.exists()
+        assert Path(target, "file").read_text(encoding="utf8") == "osbuild"
+        with pytest.raises(OSError):
+            Path(target, "other").touch()
+
+        again = Path(tmpdir, "again")
+        again.mkdir()
+        assert Path(client.read_cached_tree_at(name, key, again)) == again
+        assert Path(again, "file").read_text(encoding="utf8") == "osbuild"
+        assert store.cached_tree(f"{name}-{key}")
+
+        # only temporary directories of the store can be cached
+        with pytest.raises(RuntimeError):
+            client.cache_tree_at(name, "b" * 64, Path(tmpdir, "again"), target)
+
+        server.reset()
+
+        # if the cache is full, the tree is mounted in place
+        store.maximum_size = 0
+        tree = Path(client.mkdtemp(prefix="tree-"), "tree")
+        tree.mkdir()
+        assert Path(client.cache_tree_at(name, "c" * 64, tree, target)) == target
+        assert tree.exists()
+        assert client.read_cached_tree_at(name, "c" * 64, again) is None
+
+
+def test_verified_index(tmpdir):
+    with objectstore.ObjectStore(tmpdir) as store, \
+            objectstore.VerifiedIndexServer(store) as server:
+
+        client = objectstore.VerifiedIndexClient(server.socket_address)
+
+        key = "a" * 64
+        checksums = ["sha256:" + "1" * 64, "sha256:" + "2" * 64]
+        assert client.verified("org.osbuild.files", key, checksums) == []
+
+        client.mark_verified("org.osbuild.files", key, checksums[:1])
+        assert client.verified("org.osbuild.files", key, checksums) == checksums[:1]
+
+        # the index is specific to the key
+        assert client.verified("org.osbuild.files", "b" * 64, checksums) == []
+
+        # and lives next to the cache of the source
+        index = os.path.join(tmpdir, "sources", "org.osbuild.files.verified", key)
+        assert os.listdir(index) == checksums[:1]
+
+        # invalid checksums are never recorded
+        client.mark_verified("org.osbuild.files", key, ["../../escape"])
+        assert os.listdir(index) == checksums[:1]
+
+
+def test_export(object_store, tmpdir):
+    object_store.maximum_size = 1024 * 1024 * 1024
+
+    tree = object_store.new("a")
+    Path(tree, "A").write_bytes(b"a" * 1000)
+    os.makedirs(os.path.join(tree, "B"))
+    tree.finalize()
+
+    # copied, the tree is left untouched
+    target = os.path.join(tmpdir, "copy")
+    progress = tree.export(target)
+    assert sorted(os.listdir(target)) == ["A", "B"]
+    assert sorted(os.listdir(tree)) == ["A", "B"]
+    assert progress.total == progress.done == 1000
+
+    object_store.commit(tree, "a")
+
+    # moved out of the staged tree
+    target = os.path.join(tmpdir, "move")
+    progress = tree.export(target, move=True)
+    assert sorted(os.listdir(target)) == ["A", "B"]
+    assert not os.listdir(tree)
+    assert progress.moved == 1000
+
+    # but never out of the cache
+    with objectstore.ObjectStore(object_store.store) as store:
+        cached = store.get("a")
+        target = os.path.join(tmpdir, "cached")
+        progress = cached.export(target, move=True)
+        assert sorted(os.listdir(target)) == ["A", "B"]
+        assert sorted(os.listdir(cached)) == ["A", "B"]
+        assert progress.moved == 0
+
+
+def test_source_cache(tmpdir):
+    shared = os.path.join(tmpdir, "sources")
+    files = os.path.join(shared, "org.osbuild.files")
+    checksums = ["sha256:" + c * 64 for c in "0123"]
+    old = time.time() - 2 * objectstore.SourceCache.max_age
+
+    with objectstore.ObjectStore(os.path.join(tmpdir, "a"), sources=shared) as a, \
+            objectstore.ObjectStore(os.path.join(tmpdir, "b"), sources=shared) as b:
+        assert a.sources == b.sources == shared
+        os.makedirs(files)
+        for i, checksum in enumerate(checksums):
+            with open(os.path.join(files, checksum), "wb") as f:
+                f.write(b"x" * 4096 * (i + 1))
+            os.utime(os.path.join(files, checksum), (old, old))
+
+        # not an item, e.g. the repository of the ostree source
+        os.makedirs(os.path.join(shared, "org.osbuild.ostree", "repo"))
+        os.makedirs(os.path.join(shared, "org.osbuild.files.verified", "a" * 64))
+        for checksum in checksums:
+            Path(shared, "org.osbuild.files.verified", "a" * 64, checksum).touch()
+        Path(files, ".journal-" + "a" * 32).touch()
+
+        # a manifest of each store uses some of the items
+        a.source_cache.add_ref(checksums[1:3])
+        b.source_cache.add_ref(checksums[2:])
+
+        # the cache is in use
+        with pytest.raises(BlockingIOError):
+            objectstore.SourceCache(shared).collect_garbage()
+
+    # the item that has not been used recently, and the journal, are removed
+    cache = objectstore.SourceCache(shared)
+    assert cache.collect_garbage() == (1, 4096)
+    assert sorted(os.listdir(files)) == checksums[1:]
+    assert os.path.isdir(os.path.join(shared, "org.osbuild.ostree", "repo"))
+    assert sorted(os.listdir(os.path.join(shared, "org.osbuild.files.verified", "a" * 64))) == checksums[1:]
+
+    # the least recently used items are removed to fit the maximum size
+    refs = os.path.join(shared, "refs")
+    for ref in os.listdir(refs):
+        with open(os.path.join(refs, ref), encoding="utf8") as f:
+            if checksums[1] in f.read():
+                os.utime(os.path.join(refs, ref), (old + objectstore.SourceCache.max_age, ) * 2)
+
+    with cache:
+        cache.info = FsCacheInfo(maximum_size=4 * 4096 * 2)
+    assert cache.collect_garbage() == (1, 2 * 4096)
+    assert sorted(os.listdir(files)) == checksums[2:]
+
+    # references expire
+    for ref in os.listdir(refs):
+        os.utime(os.path.join(refs, ref), (old, old))
+    assert cache.collect_garbage() == (2, 7 * 4096)
+    assert not os.listdir(files)
+    assert not os.listdir(refs)
+
+    # shared blobs are removed once no item links to them anymore
+    blobs = os.path.join(shared, "org.osbuild.containers", "blobs", "sha256")
+    image = os.path.join(shared, "org.osbuild.containers", checksums[0], "image")
+    os.makedirs(blobs)
+    os.makedirs(image)
+    for name in "ab":
+        with open(os.path.join(blobs, name * 64), "wb") as f:
+            f.write(b"x" * 4096)
+    os.link(os.path.join(blobs, "a" * 64), os.path.join(image, "a" * 64))
+    with cache:
+        cache.add_ref(checksums[:1])
+
+    assert cache.collect_garbage() == (1, 4096)
+    assert os.listdir(blobs) == ["a" * 64]
+
+    # the content shared by an item and a blob is accounted once
+    for ref in os.listdir(refs):
+        os.utime(os.path.join(refs, ref), (old, old))
+    os.utime(os.path.dirname(image), (old, old))
+    assert cache.collect_garbage() == (2, 4096)
+    assert not os.listdir(blobs)
+
+
+def test_source_cache_without_refs(tmpdir):
+    # the last use of the items of a cache without any references,
+    # e.g. of an older version, is unknown and they are thus kept
+    files = os.path.join(tmpdir, "org.osbuild.files")
+    checksum = "sha256:" + "0" * 64
+    old = time.time() - 2 * objectstore.SourceCache.max_age
+    os.makedirs(files)
+    Path(files, checksum).write_bytes(b"x" * 4096)
+    os.utime(os.path.join(files, checksum), (old, old))
+    Path(files, ".journal-" + "a" * 32).touch()
+
+    cache = objectstore.SourceCache(tmpdir)
+    assert cache.collect_garbage() == (0, 0)
+    assert os.listdir(files) == [checksum]
+
+    with cache:
+        cache.add_ref([])
+    assert cache.collect_garbage() == (1, 4096)
+    assert not os.listdir(files)
+
+
+def test_delta_checkpoints(tmpdir):
+    def describe(root):
+        result = {}
+        for path, dirs, files in os.walk(root):
+            for name in dirs + files:
+                full = os.path.join(path, name)
+                st = os.lstat(full)
+                data = Path(full).read_bytes() if os.path.isfile(full) and not os.path.islink(full) else None
+                result[os.path.relpath(full, root)] = (st.st_mode, st.st_mtime_ns, data)
+        return result
+
+    def entry(store, name):
+        with store.cache.load(name) as path:
+            return os.path.join(store.cache, path)
+
+    with objectstore.ObjectStore(tmpdir) as store:
+        store.maximum_size = 1024 * 1024 * 1024
+        store.delta = True
+
+        tree = store.new("a")
+        os.makedirs(os.path.join(tree, "dir", "sub"))
+        os.makedirs(os.path.join(tree, "gone", "sub"))
+        Path(tree, "big").write_bytes(os.urandom(1024 * 1024))
+        Path(tree, "file").write_bytes(b"file")
+        Path(tree, "gone", "sub", "file").write_bytes(b"file")
+        os.link(os.path.join(tree, "file"), os.path.join(tree, "dir", "link"))
+        os.symlink("file", os.path.join(tree, "symlink"))
+        store.commit(tree, "base")
+        assert not os.path.exists(os.path.join(entry(store, "base"), objectstore.DELTA_INFO))
+
+        # changes are stored as delta
+        Path(tree, "dir", "link").write_bytes(b"changed")
+        Path(tree, "dir", "sub", "new").write_bytes(b"new")
+        objectstore.rmrf.rmtree(os.path.join(tree, "gone"))
+        os.unlink(os.path.join(tree, "symlink"))
+        os.makedirs(os.path.join(tree, "symlink"))
+        store.commit(tree, "one")
+        want_one = describe(tree.tree)
+
+        os.chmod(os.path.join(tree, "file"), 0o600)
+        store.commit(tree, "two")
+        want_two = describe(tree.tree)
+
+        path = entry(store, "one")
+        with open(os.path.join(path, objectstore.DELTA_INFO), encoding="utf8") as f:
+            assert json.load(f) == {"parent": "base", "removed": ["gone", "symlink"]}
+        assert sorted(describe(os.path.join(path, "tree"))) == [
+            "dir", "dir/link", "dir/sub", "dir/sub/new", "file", "symlink"
+        ]
+        # the big file is only in the full checkpoint
+        assert os.path.getsize(os.path.join(entry(store, "base"), "tree", "big")) == 1024 * 1024
+        assert not os.path.exists(os.path.join(path, "tree", "big"))
+
+        # the depth of the stack is limited
+        store.max_delta_depth = 2
+        Path(tree, "three").write_bytes(b"three")
+        store.commit(tree, "three")
+        assert not os.path.exists(os.path.join(entry(store, "three"), objectstore.DELTA_INFO))
+
+    # checkpoints are assembled from all deltas
+    with objectstore.ObjectStore(tmpdir) as store:
+        one, two = store.get("one"), store.get("two")
+        assert one.assembled and two.assembled
+        assert describe(one.tree) == want_one
+        assert describe(two.tree) == want_two
+        assert os.stat(os.path.join(two, "file")).st_ino == os.stat(os.path.join(two, "dir", "link")).st_ino
+        assert store.get("two") is two
+
+        base = store.get("base")
+        assert not base.assembled
+
+    # and only once, then the assembled trees are read from the cache
+    with objectstore.ObjectStore(tmpdir) as store, \
+            mock.patch.object(objectstore.treecopy, "copy_tree") as copy_tree:
+        two = store.get("two")
+        assert two.assembled
+        assert two.path == entry(store, "two" + objectstore.ASSEMBLED_SUFFIX)
+        assert describe(two.tree) == want_two
+        copy_tree.assert_not_called()
+
+    # without its parent, a delta is of no use
+    with objectstore.ObjectStore(tmpdir) as store:
+        objectstore.rmrf.rmtree(os.path.join(tmpdir, "objects", "base"))
+        assert store.contains("three")
+        assert not store.contains("two")
+        assert store.get("two") is None
+        assert store.contains_many(["one", "two", "three", "four", None]) == {"three"}
@@ -5,15 +5,21 @@
 import json
 import os
 import pathlib
+import subprocess
 import sys
 import tempfile
+import threading
 import unittest
+from unittest import mock
 
 import osbuild
 import osbuild.meta
+from osbuild.api import API
+from osbuild.buildroot import BuildRoot, CompletedBuild
 from osbuild.monitor import NullMonitor
 from osbuild.objectstore import ObjectStore
-from osbuild.pipeline import Manifest, Runner
+from osbuild.pipeline import (CheckpointPolicy, Manifest, Runner,
+                              SharedBuildRoot, Stage)
 
 from .. import test
 
@@ -54,6 +60,63 @@ class TestDescriptions(unittest.TestCase):
         self.assertEqual(res.success, True)
         self.assertEqual(res.id, stage.id)
 
+    @unittest.skipUnless(test.TestBase.can_bind_mount(), "root-only")
+    def test_shared_buildroot(self):
+        # The build environment is set up once and re-used by all
+        # stages, with everything a stage acquired released in-between
+        runner = Runner(osbuild.meta.RunnerInfo.from_path("runners/org.osbuild.linux"))
+        monitor = NullMonitor(sys.stderr.fileno())
+        libdir = os.path.abspath(os.curdir)
+
+        def run_stage(shared):
+            root = shared.build_root
+            with root.temporary_api(API()):
+                pathlib.Path(root.var, "data").touch()
+                os.mknod(os.path.join(root.dev, "loop0"))
+            shared.reset()
+            assert not os.listdir(root.var)
+            assert "loop0" not in os.listdir(root.dev)
+            assert "null" in os.listdir(root.dev)
+            return root.var, root.dev
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with ObjectStore(tmpdir) as store, \
+                    mock.patch.object(BuildRoot, "__enter__", autospec=True,
+                                      side_effect=BuildRoot.__enter__) as setup:
+                with SharedBuildRoot("/", runner, store, monitor, libdir) as shared:
+                    roots = {run_stage(shared) for _ in range(3)}
+
+        self.assertEqual(setup.call_count, 1)
+        self.assertEqual(len(roots), 1)
+
+    def test_verified_index_access(self):
+        # Only stages that use the index of verified items get access
+        runner = Runner(osbuild.meta.RunnerInfo.from_path("runners/org.osbuild.linux"))
+        monitor = NullMonitor(sys.stderr.fileno())
+        libdir = os.path.abspath(os.curdir)
+        index = osbuild.meta.Index(os.curdir)
+
+        def endpoints(name, options):
+            info = index.get_module_info("Stage", name)
+            stage = Stage(info, {}, None, None, options, None)
+
+            seen = []
+
+            def run(root, *_args, **_kwargs):
+                seen.extend(api.endpoint for api in root._apis)  # pylint: disable=protected-access
+                return CompletedBuild(subprocess.CompletedProcess([], 0), "")
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with ObjectStore(tmpdir) as store, \
+                        mock.patch.object(BuildRoot, "run", autospec=True, side_effect=run):
+                    tree = store.new(stage.id)
+                    stage.run(tree, runner, "/", store, monitor, libdir)
+            return seen
+
+        self.assertIn("verified-index", endpoints("org.osbuild.rpm", {"checksig_index": True}))
+        self.assertNotIn("verified-index", endpoints("org.osbuild.rpm", {}))
+        self.assertNotIn("verified-index", endpoints("org.osbuild.noop", {"checksig_index": True}))
+
     def test_manifest(self):
         index = osbuild.meta.Index(os.curdir)
 
@@ -121,6 +184,36 @@ class TestDescriptions(unittest.TestCase):
             check = manifest[i.id]
             self.assertEqual(i.name, check.name)
 
+    def test_stage_id(self):
+        index = osbuild.meta.Index(os.curdir)
+        info = index.get_module_info("Stage", "org.osbuild.noop")
+        input_info = index.get_module_info("Input", "org.osbuild.files")
+
+        manifest = Manifest()
+        pl = manifest.add_pipeline("tree", None, None)
+        stage = pl.add_stage(info, {"option": 1})
+
+        first = stage.id
+        ids = {first}
+        self.assertIs(manifest[first], pl)
+
+        # any change to the stage results in a new id
+        stage.options = {"option": 2}
+        ids.add(stage.id)
+
+        ip = stage.add_input("files", input_info, "org.osbuild.source")
+        ids.add(stage.id)
+
+        ip.add_reference("sha256:" + "0" * 64)
+        ids.add(stage.id)
+
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(pl.id, stage.id)
+
+        # the index follows the new id
+        self.assertIs(manifest[pl.id], pl)
+        self.assertIsNone(manifest.get(first))
+
     # pylint: disable=too-many-statements
     def test_on_demand(self):
         index = osbuild.meta.Index(os.curdir)
@@ -263,6 +356,77 @@ class TestDescriptions(unittest.TestCase):
         res = manifest.depsolve(store, names(image))
         assert res == names(build, rootfs, image)
 
+    def test_parallel_build(self):
+        index = osbuild.meta.Index(os.curdir)
+
+        manifest = Manifest()
+        noop = index.get_module_info("Stage", "org.osbuild.noop")
+        noip = index.get_module_info("Input", "org.osbuild.noop")
+
+        build = manifest.add_pipeline("build", None, None)
+        build.add_stage(noop, {"option": 1})
+
+        # two independent pipelines, both only depending on `build`
+        os_tree = manifest.add_pipeline("os", None, build.id)
+        os_tree.add_stage(noop, {"option": 2})
+
+        dep = manifest.add_pipeline("dep", None, build.id)
+        dep.add_stage(noop, {"option": 3})
+
+        image = manifest.add_pipeline("image", None, build.id)
+        stage = image.add_stage(noop, {"option": 4})
+        ip = stage.add_input("tree", noip, "org.osbuild.pipeline")
+        ip.add_reference(os_tree.id)
+        ip = stage.add_input("dep", noip, "org.osbuild.pipeline")
+        ip.add_reference(dep.id)
+
+        pipelines = names(build, os_tree, dep, image)
+
+        graph = manifest.dependencies(pipelines)
+        assert graph == {
+            "build": set(),
+            "os": {"build"},
+            "dep": {"build"},
+            "image": {"build", "os", "dep"},
+        }
+
+        # dependencies that are not being built are left out
+        graph = manifest.dependencies(names(os_tree, dep, image))
+        assert graph == {"os": set(), "dep": set(), "image": {"os", "dep"}}
+
+        # `os` and `dep` must be built at the same time, otherwise
+        # the barrier will time out and break
+        barrier = threading.Barrier(2, timeout=30)
+        done = []
+
+        def make_run(pl, fail=False):
+            def run(_store, _monitor, _libdir, _stage_timeout=None, **_kwargs):
+                if pl in (os_tree, dep):
+                    barrier.wait()
+                done.append(pl.name)
+                return {"success": not fail}
+            return run
+
+        for pl in manifest:
+            pl.run = make_run(pl)
+
+        res = manifest.build(MockStore(), pipelines, None, None, jobs=2)
+        assert res["success"]
+        assert done[0] == "build"
+        assert set(done[1:3]) == {"os", "dep"}
+        assert done[3] == "image"
+
+        # a failure stops dependent pipelines from being built
+        # and the failed pipeline is reported last
+        done.clear()
+        barrier.reset()
+        dep.run = make_run(dep, fail=True)
+
+        res = manifest.build(MockStore(), pipelines, None, None, jobs=2)
+        assert not res["success"]
+        assert "image" not in done
+        assert list(res.keys())[-1] == dep.id
+
     def check_moduleinfo(self, version):
         index = osbuild.meta.Index(os.curdir)
 
@@ -287,6 +451,51 @@ class TestDescriptions(unittest.TestCase):
                 msg = f"{klass} '{name}' has invalid STAGE_OPTS\n\t" + str(e)
                 self.fail(msg)
 
+    def test_checkpoint_policy(self):
+        class Tree:
+            def __init__(self, uid, size):
+                self.id = uid
+                self.size = size
+
+        class Store:
+            def __init__(self):
+                self.maximum_size = 1000
+                self.scanned = []
+
+            def tree_size(self, tree):
+                self.scanned.append(tree.id)
+                return tree.size
+
+        store = Store()
+        policy = CheckpointPolicy(min_time=10, throughput=10, budget=0.5)
+
+        # too quick to rebuild, regardless of its size
+        assert not policy.check(store, Tree("a", 1), 5)
+        assert not store.scanned
+
+        # restoring takes longer than rebuilding
+        assert not policy.check(store, Tree("a", 200), 15)
+        assert store.scanned == ["a"]
+
+        # the tree did not grow enough, no need to scan it again
+        assert not policy.check(store, Tree("a", 50), 19)
+        assert store.scanned == ["a"]
+
+        assert policy.check(store, Tree("a", 200), 20)
+        assert policy.used == 200
+
+        # would exceed the budget of half the cache
+        assert not policy.check(store, Tree("b", 400), 100)
+        assert policy.check(store, Tree("b", 300), 100)
+        assert policy.used == 500
+
+        store.maximum_size = "unlimited"
+        assert policy.check(store, Tree("c", 1000), 100)
+
+        # nothing is committed without a cache
+        store.maximum_size = None
+        assert not policy.check(store, Tree("d", 1), 100)
+
     def test_moduleinfo(self):
         for version in ["1", "2"]:
             with self.subTest(version=version):
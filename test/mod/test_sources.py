@@ -0,0 +1,186 @@
+#
+# Tests for the 'osbuild.sources' module.
+#
+
+import argparse
+import concurrent.futures
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from osbuild import sources
+
+
+class DummySource(sources.SourceService):
+    content_type = "org.osbuild.dummy"
+    max_workers = 8
+    max_per_host = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.fetched = []
+        self.running = {}
+        self.peak = {}
+        self.fail = set()
+        self.exists_calls = 0
+
+    def origin(self, _checksum, desc):
+        return desc.get("host")
+
+    def fetch_one(self, checksum, desc):
+        name = desc.get("host")
+        with self.lock:
+            self.running[name] = self.running.get(name, 0) + 1
+            self.peak[name] = max(self.peak.get(name, 0), self.running[name])
+        try:
+            time.sleep(0.01)
+            if checksum in self.fail:
+                raise RuntimeError(f"failed to fetch {checksum}")
+            with open(os.path.join(self.cache, checksum), "w", encoding="utf8") as f:
+                f.write(checksum)
+            with self.lock:
+                self.fetched.append(checksum)
+        finally:
+            with self.lock:
+                self.running[name] -= 1
+
+    def exists(self, checksum, _desc):
+        self.exists_calls += 1
+        return super().exists(checksum, _desc)
+
+
+@pytest.fixture(name="service")
+def service_fixture(tmp_path):
+    a, b = socket.socketpair()
+    with a:
+        args = argparse.Namespace(service_fd=b.detach(), service_id="source/dummy")
+        service = DummySource(args)
+        service.setup({"cache": os.fspath(tmp_path), "options": {}})
+        yield service
+        service.sock.close()
+
+
+def run_download(service, items):
+    with sources.Journal(service.cache, "DummySource", items) as service.journal:
+        service.tmpdir = service.journal.tmpdir
+        service.download(items)
+
+
+def test_jobserver():
+    jobs = 3
+    lock = threading.Lock()
+    running, peak = 0, 0
+
+    def job(_):
+        nonlocal running, peak
+        with server.job():
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+
+    with sources.JobServer.new(jobs) as server:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(job, range(30)))
+
+        assert os.read(server.rfd, 10) == b"+" * jobs
+
+    assert peak == jobs
+    assert server.rfd == -1 and server.wfd == -1
+
+
+def test_host_limits(service):
+    items = {f"sha256:{i:064x}": {"host": f"host{i % 2}"} for i in range(20)}
+    run_download(service, items)
+
+    assert sorted(service.fetched) == sorted(items)
+    assert service.peak == {"host0": 2, "host1": 2}
+
+
+def test_global_budget(service):
+    items = {f"sha256:{i:064x}": {"host": f"host{i}"} for i in range(20)}
+
+    with sources.JobServer.new(3) as service.jobs:
+        run_download(service, items)
+
+    assert sorted(service.fetched) == sorted(items)
+    assert sum(service.peak.values()) == 20
+    assert max(service.peak.values()) == 1
+
+
+def test_journal(service):
+    items = {f"sha256:{i:064x}": {} for i in range(10)}
+    failed = list(items)[5]
+
+    service.fail = {failed}
+    with pytest.raises(RuntimeError):
+        run_download(service, items)
+
+    # the journal and the partial transfers are kept
+    journal = sources.Journal(service.cache, "DummySource", items)
+    assert os.path.exists(journal.path)
+    assert os.path.isdir(journal.tmpdir)
+    with open(journal.path, encoding="utf8") as f:
+        assert sorted(f.read().split()) == sorted(c for c in items if c != failed)
+
+    # resume, items in the journal are neither checked nor fetched
+    service.fail = set()
+    service.fetched = []
+    service.exists_calls = 0
+    run_download(service, items)
+
+    assert service.fetched == [failed]
+    assert service.exists_calls == 1
+    assert not os.path.exists(journal.path)
+    assert not os.path.exists(journal.tmpdir)
+
+    # a different set of items does not use the journal
+    other = sources.Journal(service.cache, "DummySource", {})
+    assert other.path != journal.path
+
+
+def test_journal_locked(tmp_path):
+    items = {"sha256:" + "0" * 64: {}}
+
+    with sources.Journal(tmp_path, "DummySource", items) as journal:
+        journal.record("sha256:" + "0" * 64)
+
+        # the same items are downloaded concurrently, the journal can not be used
+        with sources.Journal(tmp_path, "DummySource", items) as other:
+            assert not other.done
+            assert other.tmpdir != journal.tmpdir
+            assert os.path.isdir(other.tmpdir)
+            other.record("sha256:" + "1" * 64)
+
+        assert not os.path.exists(other.tmpdir)
+        assert os.path.exists(journal.path)
+
+        with open(journal.path, encoding="utf8") as f:
+            assert f.read() == "sha256:" + "0" * 64 + "\n"
+
+    assert not os.path.exists(journal.path)
+
+
+def test_pending(service):
+    items = {f"sha256:{i:064x}": {} for i in range(3)}
+    present = list(items)[0]
+    with open(os.path.join(service.cache, present), "w", encoding="utf8") as f:
+        f.write(present)
+
+    # an item was downloaded by an interrupted run
+    with pytest.raises(RuntimeError):
+        with sources.Journal(service.cache, "DummySource", items) as journal:
+            journal.record(list(items)[1])
+            raise RuntimeError("interrupted")
+
+    with sources.Journal(service.cache, "DummySource", items) as service.journal:
+        assert service.pending(items) == [(list(items)[2], {})]
+
+    service.setup({"cache": "/cache", "options": {}, "extra-caches": ["/other"]})
+    assert service.extra_caches == ["/other/org.osbuild.dummy"]
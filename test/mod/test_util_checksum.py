@@ -32,3 +32,23 @@ def test_verify_file(algorithm, tempfile):
     digest = TEST_RESULT[algorithm]
     full_digest = f"{algorithm}:{digest}"
     assert checksum.verify_file(tempfile.name, full_digest), "checksums mismatch"
+
+
+@pytest.mark.parametrize("algorithm", TEST_RESULT.keys())
+def test_hashing_writer(algorithm, tempfile):
+    with open(tempfile.name, "wb") as f:
+        writer = checksum.HashingWriter(f, algorithm)
+        data = TEST_STRING.encode()
+        # write in pieces, like data that is being received
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+
+    digest = TEST_RESULT[algorithm]
+    assert writer.hexdigest() == digest
+    assert writer.verify(f"{algorithm}:{digest}")
+    assert not writer.verify(f"{algorithm}:{'0' * len(digest)}")
+    # the data must have been written as well
+    assert checksum.verify_file(tempfile.name, f"{algorithm}:{digest}")
+
+    other = "sha1" if algorithm != "sha1" else "md5"
+    assert not writer.verify(f"{other}:{TEST_RESULT[other]}")
@@ -0,0 +1,79 @@
+#
+# Tests for the 'osbuild.util.compress' module.
+#
+
+import os
+import random
+import shutil
+import subprocess
+from unittest import mock
+
+import pytest
+
+from osbuild.util import checksum, compress
+
+
+def test_cpu_budget(monkeypatch):
+    cpus = len(os.sched_getaffinity(0))
+
+    monkeypatch.delenv(compress.CPU_BUDGET_ENV, raising=False)
+    assert compress.cpu_budget() == cpus
+
+    monkeypatch.setenv(compress.CPU_BUDGET_ENV, "1")
+    assert compress.cpu_budget() == 1
+
+    monkeypatch.setenv(compress.CPU_BUDGET_ENV, str(cpus + 1))
+    assert compress.cpu_budget() == cpus
+
+
+def test_command():
+    with mock.patch("shutil.which", return_value="/usr/bin/pigz"):
+        assert compress.command("gzip", 1, 4) == ["pigz", "--no-name", "--processes=4", "-1"]
+    with mock.patch("shutil.which", return_value=None):
+        assert compress.command("gzip", 1, 4) == ["gzip", "--no-name", "-1"]
+
+    # the multithreaded mode of xz is always used
+    assert compress.command("xz", 0, 1) == ["xz", "--threads=2", "-0"]
+    assert compress.command("xz", None, 8) == ["xz", "--threads=8"]
+
+    assert compress.command("zstd", 1, 3) == ["zstd", "--quiet", "--threads=3", "--long", "-1"]
+    assert compress.tar_argument("zstd", 1, 3) == "zstd --quiet --threads=3 --long -1"
+
+    with pytest.raises(ValueError):
+        compress.command("bzip2")
+
+    assert compress.format_for("image.tar.xz") == "xz"
+    assert compress.format_for("image.tgz") == "gzip"
+    assert compress.format_for("image.tar") is None
+
+
+@pytest.mark.parametrize("fmt", compress.FORMATS)
+def test_compress_threads(tmp_path, fmt):
+    if not shutil.which(compress.command(fmt, threads=1)[0]):
+        pytest.skip(f"{fmt} not available")
+
+    # about 9 MiB, so that it is split into several blocks of xz
+    # (3 MiB at level 1) and jobs of zstd (2 MiB at level 1)
+    rng = random.Random(0)
+    words = [bytes(rng.choices(b"abcdefgh", k=8)) for _ in range(256)]
+    source = tmp_path / "source"
+    source.write_bytes(b"\n".join(rng.choices(words, k=1024 * 1024)))
+
+    digests = set()
+    for threads in (1, 2, 4):
+        target = tmp_path / f"target.{threads}"
+        compress.compress(fmt, source, target, level=1, threads=threads)
+        digests.add(checksum.hexdigest_file(target, "sha256"))
+
+    # the result does not depend on the number of threads
+    assert len(digests) == 1
+
+    if fmt == "xz":
+        info = subprocess.run(["xz", "--robot", "--list", tmp_path / "target.4"],
+                              stdout=subprocess.PIPE, encoding="utf8", check=True).stdout
+        blocks = int(info.splitlines()[1].split("\t")[2])
+        assert blocks > 1
+
+    with open(tmp_path / "target.1", "rb") as f:
+        data = subprocess.run([fmt, "-d", "-c"], stdin=f, stdout=subprocess.PIPE, check=True).stdout
+    assert data == source.read_bytes()
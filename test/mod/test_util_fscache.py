@@ -39,6 +39,26 @@ def test_calculate_size(tmpdir):
 
     assert fscache.FsCache._calculate_size(os.path.join(tmpdir, "dir")) == 6
 
+    # Hard-links are only accounted once
+    os.link(os.path.join(tmpdir, "dir", "file"), os.path.join(tmpdir, "dir", "link"))
+
+    assert fscache.FsCache._calculate_size(os.path.join(tmpdir, "dir")) == 6
+
+    # Nested directories, deeper than the directories scanned in parallel
+    nested = os.path.join(tmpdir, "dir", *["nested"] * 5)
+    os.makedirs(nested)
+    with open(os.path.join(nested, "file"), "x", encoding="utf8") as f:
+        f.write("foobar")
+
+    assert fscache.FsCache._calculate_size(os.path.join(tmpdir, "dir")) == 12
+
+    # Holes of sparse files are not accounted
+    with open(os.path.join(nested, "sparse"), "xb") as f:
+        f.truncate(1024 * 1024 * 1024)
+        f.write(b"foobar")
+
+    assert fscache.FsCache._calculate_size(os.path.join(tmpdir, "dir")) < 1024 * 1024
+
 
 def test_pathlike(tmpdir):
     #
@@ -385,3 +405,115 @@ def test_size_discard(tmpdir):
         with pytest.raises(fscache.FsCache.MissError):
             with cache.load("foo") as rpath:
                 pass
+
+
+def test_size_evict(tmpdir):
+    #
+    # Verify that committing an entry to a full cache evicts the least
+    # recently used entries, but never entries that are in use.
+    #
+
+    def store(cache, name, data):
+        with cache.store(name) as rpath:
+            with open(os.path.join(tmpdir, rpath, "data"), "x", encoding="utf8") as f:
+                f.write(data)
+
+    def has(cache, name):
+        try:
+            with cache.load(name):
+                return True
+        except fscache.FsCache.MissError:
+            return False
+
+    def set_last_used(cache, name, timestamp):
+        path = cache._path(cache._dirname_objects, name, cache._filename_object_info)
+        os.utime(path, (timestamp, timestamp))
+
+    cache = fscache.FsCache("osbuild-test-appid", tmpdir)
+    with cache:
+        cache.info = cache.info._replace(maximum_size=10)
+
+        store(cache, "a", "aaaa")
+        store(cache, "b", "bbbb")
+        set_last_used(cache, "a", 1)
+        set_last_used(cache, "b", 2)
+        assert cache._last_used_objects() == ["a", "b"]
+
+        # Loading an entry marks it as most recently used
+        assert has(cache, "a")
+        assert cache._last_used_objects() == ["b", "a"]
+
+        # Storing "c" needs space, "b" is the least recently used
+        store(cache, "c", "cccc")
+        assert not has(cache, "b")
+        assert has(cache, "a")
+        assert has(cache, "c")
+        with open(cache._path(cache._filename_cache_size), "r", encoding="utf8") as f:
+            assert json.load(f) == 8
+
+        # Entries that are in use are never evicted, so the new entry is
+        # discarded if no other entry can be evicted
+        with cache.load("a"), cache.load("c"):
+            store(cache, "d", "dddd")
+        assert not has(cache, "d")
+        assert has(cache, "a")
+        assert has(cache, "c")
+
+        # Entries that exceed the cache size on their own never evict others
+        store(cache, "e", "e" * 11)
+        assert not has(cache, "e")
+        assert has(cache, "a")
+        assert has(cache, "c")
+
+        # Several entries are evicted if needed
+        store(cache, "f", "f" * 10)
+        assert has(cache, "f")
+        assert not has(cache, "a")
+        assert not has(cache, "c")
+
+
+def test_retain(tmpdir):
+    #
+    # Verify that loaded entries are kept locked if `retain` is set, and
+    # that `contains_many()` finds entries in one go.
+    #
+
+    def store(cache, name, data):
+        with cache.store(name) as rpath:
+            with open(os.path.join(tmpdir, rpath, "data"), "x", encoding="utf8") as f:
+                f.write(data)
+
+    cache = fscache.FsCache("osbuild-test-appid", tmpdir)
+    other = fscache.FsCache("osbuild-test-appid", tmpdir)
+    with cache, other:
+        cache.info = cache.info._replace(maximum_size=10)
+        cache.retain = True
+
+        store(cache, "a", "aaaa")
+        store(cache, "b", "bbbb")
+
+        assert cache.contains_many(["a", "b", "c", "a"]) == {"a", "b"}
+        assert cache.contains_many([]) == set()
+        assert sorted(cache._handles) == ["a", "b"]
+
+        # loading again neither locks the entry again nor marks it as used
+        with cache.load("a") as rpath:
+            assert os.path.exists(os.path.join(tmpdir, rpath, "data"))
+        assert sorted(cache._handles) == ["a", "b"]
+
+        # the entries stay locked, even after they were loaded
+        assert not other._evict_object("a")
+        store(other, "c", "cccc")
+        with pytest.raises(fscache.FsCache.MissError):
+            with other.load("c"):
+                pass
+
+        with pytest.raises(fscache.FsCache.MissError):
+            with cache.load("c"):
+                pass
+
+    # the locks are released with the context
+    assert not cache._handles
+    with other:
+        assert other._evict_object("a")
+        assert other.contains_many(["a", "b"]) == {"b"}
@@ -6,8 +6,11 @@ import asyncio
 import os
 import pathlib
 import tempfile
+import time
 import unittest
 from concurrent import futures
+from socket import MSG_PEEK
+from unittest import mock
 
 from osbuild.util import jsoncomm
 
@@ -216,3 +219,92 @@ class TestUtilJsonComm(unittest.TestCase):
         self.assertEqual(ping, pong)
         pong, _, _ = a.recv()
         self.assertEqual(ping, pong)
+
+    def test_framed(self):
+        #
+        # Framed messages are received in either mode and the receiver
+        # switches to framing for its replies
+
+        a, b = jsoncomm.Socket.new_pair()
+        a.framed = True
+        self.assertFalse(b.framed)
+
+        b.send({"plain": True})
+        msg, _, _ = a.recv()
+        self.assertEqual(msg, {"plain": True})
+        self.assertTrue(a.framed)
+
+        with open("/dev/null", "r", encoding="utf8") as f:
+            a.send({"framed": True}, fds=[f.fileno()])
+        msg, fds, _ = b.recv()
+        self.assertEqual(msg, {"framed": True})
+        self.assertEqual(len(fds), 1)
+        fds.close()
+        self.assertTrue(b.framed)
+
+        # larger than the initial buffer and then a small one again
+        for size in (1 << 17, 1, 0):
+            data = {"data": "x" * size}
+            b.send(data)
+            msg, _, _ = a.recv()
+            self.assertEqual(msg, data)
+
+        # a frame with a wrong length is rejected
+        header = jsoncomm.FRAME_HEADER.pack(jsoncomm.FRAME_MAGIC, 100)
+        b._socket.sendmsg([header, b"{}"])  # pylint: disable=protected-access
+        with self.assertRaises(BufferError):
+            a.recv()
+
+        a.close()
+        b.close()
+
+    def test_recv_peek(self):
+        #
+        # Only the header of framed messages is peeked at, plain
+        # messages of any size are still received
+
+        a, b = jsoncomm.Socket.new_pair()
+        a.framed = True
+
+        sock = b._socket  # pylint: disable=protected-access
+        with mock.patch.object(b, "_socket", wraps=sock) as wrapped:
+            data = {"data": "x" * (1 << 17)}
+            a.send(data)
+            msg, _, _ = b.recv()
+            self.assertEqual(msg, data)
+
+            peeks = [c for c in wrapped.recvmsg.call_args_list if MSG_PEEK in c[0]]
+            self.assertEqual(peeks, [mock.call(jsoncomm.FRAME_HEADER.size, 0, MSG_PEEK)])
+
+        a.framed = False
+        for data in ({}, {"data": "x" * (1 << 17)}):
+            a.send(data)
+            msg, _, _ = b.recv()
+            self.assertEqual(msg, data)
+
+        a.close()
+        b.close()
+
+    def test_framed_benchmark(self):
+        #
+        # Compare the round-trip of plain and framed messages
+
+        count = 500
+        data = {"data": ["x" * 64] * 1024}
+        results = {}
+
+        for framed in (False, True):
+            a, b = jsoncomm.Socket.new_pair()
+            a.framed = b.framed = framed
+
+            start = time.monotonic()
+            for _ in range(count):
+                a.send(data)
+                msg, _, _ = b.recv()
+            results[framed] = time.monotonic() - start
+
+            self.assertEqual(msg, data)
+            a.close()
+            b.close()
+
+        print(f"{count} messages: {results[False]:.3f}s (plain), {results[True]:.3f}s (framed)")
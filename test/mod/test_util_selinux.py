@@ -4,6 +4,7 @@
 
 import errno
 import io
+import os
 from unittest import mock
 
 from osbuild.util import selinux
@@ -58,3 +59,30 @@ def test_setfilecon():
             setxattr.side_effect = raise_error
 
             selinux.setfilecon("path", "context")
+
+
+def test_setfiles_parallel(tmp_path):
+    for path in ("a/1", "a/2", "a/3", "a/4", "b/x/1", "b/x/2", "b/y/1", "b/y/2", "c/1", "d/1"):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b"")
+    (tmp_path / "file").write_bytes(b"")
+    os.link(tmp_path / "b/y/1", tmp_path / "c/link")
+
+    with mock.patch("subprocess.run") as run:
+        selinux.setfiles_parallel("spec", os.fspath(tmp_path), workers=4, chunk=5)
+
+    calls = sorted(c[0][0] for c in run.call_args_list)
+    root = os.fspath(tmp_path)
+
+    # `b` is split, `b/y` and `c` share a file, hence they are labeled with the rest;
+    # the small subtrees `b/x` and `d` are labeled together
+    assert calls == sorted([
+        ["setfiles", "-F", "-r", root, "spec", f"{root}/a"],
+        ["setfiles", "-F", "-r", root, "spec", f"{root}/b/x", f"{root}/d"],
+        ["setfiles", "-F", "-r", root, "-e", f"{root}/a", "-e", f"{root}/b/x", "-e", f"{root}/d", "spec", root],
+    ])
+
+    with mock.patch("subprocess.run") as run:
+        selinux.setfiles_parallel("spec", os.fspath(tmp_path), workers=1)
+
+    run.assert_called_once_with(["setfiles", "-F", "-r", root, "spec", root], check=True)
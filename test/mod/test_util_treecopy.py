@@ -0,0 +1,130 @@
+#
+# Tests for the 'osbuild.util.treecopy' module.
+#
+
+import os
+import stat
+import subprocess
+import time
+
+import pytest
+
+from osbuild.util import treecopy
+
+
+def make_tree(root):
+    os.makedirs(root / "dir" / "sub")
+    (root / "file").write_bytes(b"data" * 1000)
+    (root / "dir" / "sub" / "file").write_bytes(os.urandom(100000))
+    os.chmod(root / "file", 0o4751)
+    os.chmod(root / "dir" / "sub", 0o750)
+    os.link(root / "file", root / "dir" / "link")
+    os.symlink("../file", root / "dir" / "symlink")
+    os.mkfifo(root / "dir" / "fifo")
+
+    with open(root / "sparse", "wb") as f:
+        f.truncate(16 * 1024 * 1024)
+        f.seek(1024 * 1024)
+        f.write(b"data")
+
+    try:
+        os.setxattr(root / "file", "user.osbuild", b"test")
+    except OSError:
+        pass
+
+    past = time.time() - 3600
+    for path in (root / "dir" / "sub" / "file", root / "dir" / "sub", root / "dir", root):
+        os.utime(path, (past, past))
+    os.utime(root / "dir" / "symlink", (past - 1, past - 1), follow_symlinks=False)
+
+
+def describe(root):
+    result = {}
+    for path, dirs, files in os.walk(root):
+        for name in [""] + dirs + files:
+            full = os.path.join(path, name)
+            st = os.lstat(full)
+            info = {
+                "mode": st.st_mode,
+                "uid": st.st_uid,
+                "mtime": st.st_mtime_ns,
+                "size": st.st_size if not stat.S_ISDIR(st.st_mode) else None,
+                "xattrs": sorted(os.listxattr(full, follow_symlinks=False)),
+            }
+            if stat.S_ISREG(st.st_mode):
+                with open(full, "rb") as f:
+                    info["data"] = f.read()
+            elif stat.S_ISLNK(st.st_mode):
+                info["target"] = os.readlink(full)
+            result[os.path.relpath(full, root)] = info
+    return result
+
+
+def test_copy_tree(tmp_path):
+    source, target = tmp_path / "source", tmp_path / "target"
+    os.makedirs(source)
+    make_tree(source)
+
+    calls = []
+    progress = treecopy.Progress(lambda p: calls.append(p.finished), interval=0)
+    assert treecopy.copy_tree(source, target, progress=progress, workers=4) is progress
+
+    # same as `cp -a`
+    assert describe(target) == describe(source)
+    want = tmp_path / "want"
+    subprocess.run(["cp", "-a", f"{source}/.", want], check=True)
+    assert describe(target) == describe(want)
+
+    # hardlinks within the tree are preserved
+    assert os.stat(target / "file").st_ino == os.stat(target / "dir" / "link").st_ino
+    # holes are not copied
+    assert os.stat(target / "sparse").st_blocks * 512 < 1024 * 1024
+
+    assert progress.total == 4000 + 100000 + 16 * 1024 * 1024
+    assert progress.done <= progress.total
+    assert progress.finished and calls[-1] and not any(calls[:-1])
+
+    # copying again replaces what is there
+    treecopy.copy_tree(source, target)
+    assert describe(target) == describe(source)
+
+
+def test_copy_tree_move(tmp_path):
+    source, target = tmp_path / "source", tmp_path / "target"
+    os.makedirs(source)
+    make_tree(source)
+    want = describe(source)
+    want.pop(".")
+
+    os.makedirs(target / "dir")
+    (target / "dir" / "other").write_bytes(b"")
+
+    progress = treecopy.copy_tree(source, target, move=True)
+    have = describe(target)
+    have.pop(".")
+
+    # the existing directory is merged, everything else is moved
+    assert have.pop("dir/other")["size"] == 0
+    assert have == want
+    assert sorted(os.listdir(source)) == ["dir"]
+    assert progress.moved == 4000 + 16 * 1024 * 1024
+    assert progress.done == progress.total
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="root only")
+def test_copy_tree_owner(tmp_path):
+    source, target = tmp_path / "source", tmp_path / "target"
+    os.makedirs(source / "dir")
+    (source / "dir" / "file").write_bytes(b"data")
+    os.chown(source / "dir" / "file", 1000, 1001)
+    os.chown(source / "dir", 1002, 1003)
+    os.mknod(source / "null", 0o666 | stat.S_IFCHR, os.makedev(1, 3))
+
+    treecopy.copy_tree(source, target)
+
+    st = os.stat(target / "dir" / "file")
+    assert (st.st_uid, st.st_gid) == (1000, 1001)
+    st = os.stat(target / "dir")
+    assert (st.st_uid, st.st_gid) == (1002, 1003)
+    st = os.stat(target / "null")
+    assert stat.S_ISCHR(st.st_mode) and st.st_rdev == os.makedev(1, 3)